@@ -1,10 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import struct
 import sys
-from py4j.java_gateway import JavaGateway, GatewayParameters, CallbackServerParameters
 
 import des_lp
 
+# The batched calls exchange vectors in one message each: the observations
+# as a Java list, an int[] or a string "4,5,6", and the results as the bytes
+# of big-endian doubles (byte[] in Java, read by ByteBuffer.wrap(b).asDoubleBuffer()),
+# since converting a list on either side costs one round trip per element.
+
+def parse_vector(values, cast=float):
+	if isinstance(values, str):
+		return [cast(v) for v in values.split(",") if v.strip()]
+	return [cast(v) for v in values]
+
+def pack_vector(values):
+	return struct.pack(f">{len(values)}d", *values)
+
 class SimulationWrapper(object):
 
 	# constructor for Python
@@ -31,6 +44,13 @@ class SimulationWrapper(object):
 	def performWholeSimulation(self):
 		self.model.performWholeSimulation()
 
+	# batched calls: perform n steps, or steps until the given time
+	def performSteps(self, n):
+		self.model.perform_steps(n)
+
+	def performStepsUntil(self, time):
+		self.model.run_until(time)
+
 	# code to let multivesta ask the simulator the current simulated time
 	def getTime(self):
 		return float(self.model.getTime())
@@ -41,11 +61,24 @@ class SimulationWrapper(object):
 		# print(f"-> rval observation {observation} (s.rval(4) = {self.model.eval(4)})")
 		return self.model.eval(observation)
 
+	# batched call: the values of several observations in the current state
+	def rvals(self, observations):
+		return pack_vector(self.model.eval_many(parse_vector(observations, int)))
+
+	# batched call: a whole new simulation, returning the values of the observations
+	# at each of the increasing times (row by row)
+	def performWholeSimulationAndSample(self, random_seed, observations, times):
+		self.model.init(random_seed)
+		rows = self.model.sample(parse_vector(observations, int), parse_vector(times))
+		return pack_vector([value for row in rows for value in row])
+
 	class Java:
 		implements = ['vesta.python.IPythonSimulatorWrapper']
 
 
 if __name__ == '__main__':
+	from py4j.java_gateway import JavaGateway, GatewayParameters, CallbackServerParameters
+
 	porta = int(sys.argv[1])
 	callback_porta = int(sys.argv[2])
 	print('Python engine: expecting connection with java on port: '+str(porta)+' and callback connection on port '+str(callback_porta))
@@ -0,0 +1,135 @@
+# Batch replay of trace files over a process pool, with an aggregated report
+# Usage: python batch.py PATH... [-j WORKERS] [-o REPORT.json] [--csv REPORT.csv]
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from multiprocessing import Pool
+
+from blockchain import Blockchain
+from numeric import BACKENDS, make_backend
+from stream import to_json
+from trace_utils import compile_trace, parse_trace, run_trace
+
+"""
+Each trace is replayed on a fresh Blockchain in a worker process, and reduced
+to a summary: numbers of steps, reverts and errors, final state, and net worth
+of each address. The summaries are collected in the order of the trace files
+(sorted, for directories), so the report does not depend on the number of
+workers, nor on the scheduling.
+"""
+
+CSV_FIELDS = ["trace", "steps", "reverted", "errors", "address", "net_worth"]
+
+def find_traces(paths):
+    """
+    Returns the trace files of paths: files as given, and the sorted *.txt files under directories.
+    """
+    traces = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, dirs, files in os.walk(path):
+                found += [os.path.join(root, name) for name in files if name.endswith(".txt")]
+            traces += sorted(found)
+        else:
+            traces.append(path)
+    return traces
+
+def summarize(task):
+    """
+    Replays a trace, and returns its summary (task is a tuple (filename, backend, scale, compact, precise)).
+    """
+    filename, backend, scale, compact, precise = task
+    try:
+        steps = compile_trace(parse_trace(filename), Blockchain)
+    except (OSError, UnicodeDecodeError) as e:
+        return {"trace": filename, "error": str(e)}
+    bc = Blockchain(verbose=False, backend=make_backend(backend, scale), compact=compact)
+    counts = {"steps": 0, "reverted": 0}
+
+    def after(step):
+        counts["steps"] += 1
+        counts["reverted"] += bc.lastReverted
+
+    run_trace(steps, bc, after=after)
+    lp = bc.lp
+    value = lambda x: to_json(x, precise)
+    addresses = {}  # in order of appearance
+    for balances in (bc.wallets, lp.minted, lp.debts):
+        for amounts in balances.values():
+            addresses.update(dict.fromkeys(amounts))
+    return {
+        "trace": filename,
+        "steps": counts["steps"],
+        "reverted": counts["reverted"],
+        "errors": len(steps) - counts["steps"],
+        "state": {
+            "wallets": {token: {a: value(x) for a, x in amounts.items()} for token, amounts in bc.wallets.items()},
+            "reserves": {token: value(x) for token, x in lp.reserves.items()},
+            "minted": {token: {a: value(x) for a, x in amounts.items()} for token, amounts in lp.minted.items()},
+            "debts": {token: {a: value(lp.get_debts(token, a)) for a in amounts} for token, amounts in lp.debts.items()},
+            "prices": {token: value(x) for token, x in lp.prices.items()},
+        },
+        "net_worth": {address: value(x) for address, x in bc.net_worths(addresses).items()},
+    }
+
+def run_batch(traces, workers=1, backend="fraction", scale=10**6, compact=False, precise=False):
+    """
+    Replays the trace files with the given number of worker processes, and returns their summaries (in order).
+    """
+    tasks = [(filename, backend, scale, compact, precise) for filename in traces]
+    if workers == 1:
+        return [summarize(task) for task in tasks]
+    with Pool(workers) as pool:
+        return pool.map(summarize, tasks, chunksize=max(1, len(tasks) // (4 * workers)))
+
+def write_csv(summaries, out):
+    """
+    Writes one row per trace and address with its net worth (a trace without addresses has an empty row).
+    """
+    writer = csv.DictWriter(out, CSV_FIELDS, extrasaction="ignore", lineterminator="\n")
+    writer.writeheader()
+    for summary in summaries:
+        row = {field: summary.get(field, "") for field in CSV_FIELDS}
+        net_worth = summary.get("net_worth") or {"": ""}
+        for address, value in net_worth.items():
+            writer.writerow(dict(row, address=address, net_worth=value))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay trace files in parallel, and report their final states.")
+    parser.add_argument("paths", nargs="+", help="Trace files, or directories of *.txt traces.")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs).")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Write the JSON report to FILE (default: standard output).")
+    parser.add_argument("--csv", metavar="FILE", help="Also write the net worths as CSV to FILE.")
+    parser.add_argument("-p", "--precise", action="store_true", help="Write the values as exact strings instead of floats.")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, default="fraction", help="Numeric backend (default: fraction).")
+    parser.add_argument("--scale", type=int, default=10**6, help="Scale of the fixed-point backend (default: 1000000).")
+    parser.add_argument("--compact", action="store_true", help="Use the compact storage for the maps by address (large pools).")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be a positive number")
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.CRITICAL)   # invalid lines are counted as errors
+
+    traces = find_traces(args.paths)
+    summaries = run_batch(traces, args.workers, args.backend, args.scale, args.compact, args.precise)
+    report = {
+        "traces": summaries,
+        "totals": {field: sum(s.get(field, 0) for s in summaries) for field in ("steps", "reverted", "errors")},
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as f:
+            write_csv(summaries, f)
+
+if __name__ == "__main__":
+    main()
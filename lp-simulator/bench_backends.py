@@ -0,0 +1,57 @@
+# Benchmark of the numeric backends of the LP model
+# Usage: python bench_backends.py [-r REPEAT] [--steps N] [--runs K]
+
+import argparse
+import glob
+import os
+import time
+
+import des_lp
+from blockchain import Blockchain
+from numeric import BACKENDS, make_backend
+from trace_utils import compile_trace, parse_trace, run_trace
+
+TRACES = sorted(glob.glob("traces/*.txt") + glob.glob("../examples-lmcs/**/*.txt", recursive=True))
+
+def bench_traces(backend, traces, repeat):
+    """
+    Replays every trace repeat times, and returns the number of operations per second.
+    """
+    n_ops = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for steps in traces:
+            run_trace(steps, Blockchain(verbose=False, backend=backend))
+            n_ops += len(steps)
+    return n_ops / (time.perf_counter() - start)
+
+def bench_model(backend, steps, runs):
+    """
+    Runs des_lp simulations of the given number of steps, and returns the number of steps per second.
+    """
+    model = des_lp.Model(backend=backend)
+    start = time.perf_counter()
+    for seed in range(runs):
+        model.init(seed)
+        model.N_STEPS = steps
+        model.performWholeSimulation()
+    return steps * runs / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the numeric backends on the bundled traces and on des_lp.")
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="Number of replays of each trace (default: 20).")
+    parser.add_argument("--steps", type=int, default=1000, help="Steps of each des_lp simulation (default: 1000).")
+    parser.add_argument("--runs", type=int, default=3, help="Number of des_lp simulations (default: 3).")
+    parser.add_argument("--scale", type=int, default=10**6, help="Scale of the fixed-point backend (default: 1000000).")
+    args = parser.parse_args()
+
+    traces = [compile_trace(parse_trace(filename), Blockchain) for filename in TRACES]
+    print(f"{'backend':<10} {'traces (ops/s)':>16} {'des_lp (steps/s)':>18}")
+    for name in BACKENDS:
+        backend = make_backend(name, args.scale)
+        ops = bench_traces(backend, traces, args.repeat)
+        steps = bench_model(backend, args.steps, args.runs)
+        print(f"{name:<10} {ops:>16.0f} {steps:>18.0f}")
+
+if __name__ == "__main__":
+    main()
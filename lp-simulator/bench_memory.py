@@ -0,0 +1,53 @@
+# Memory benchmark of the storage of the LP and Blockchain models
+# Usage: python bench_memory.py [-n ACCOUNTS]
+
+import argparse
+import gc
+import tracemalloc
+from fractions import Fraction
+
+from blockchain import Blockchain
+from numeric import BACKENDS, make_backend
+
+def populate(bc, n):
+    """
+    Creates n accounts, each with a wallet in two tokens, a deposit in T1 and a debt in T0.
+    """
+    bc.faucet("LP", 10 * n, "T0")
+    bc.deposit("LP", 10 * n, "T0")
+    for i in range(n):
+        address = f"U{i}"
+        amount = 10 + Fraction(i % 1000, 100)
+        bc.faucet(address, amount, "T0")
+        bc.faucet(address, 2 * amount, "T1")
+        bc.deposit(address, amount, "T1")
+        bc.borrow(address, amount / 2, "T0")
+
+def bytes_per_account(backend, compact, n):
+    """
+    Returns the memory allocated by a blockchain with n accounts, in bytes per account.
+    """
+    gc.collect()
+    tracemalloc.start()
+    bc = Blockchain(verbose=False, backend=backend, compact=compact)
+    populate(bc, n)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / n
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory per account of the dict and compact storage.")
+    parser.add_argument("-n", "--accounts", type=int, default=10000, help="Number of accounts (default: 10000).")
+    parser.add_argument("--scale", type=int, default=10**6, help="Scale of the fixed-point backend (default: 1000000).")
+    args = parser.parse_args()
+
+    print(f"{'backend':<10} {'dict (B/account)':>18} {'compact (B/account)':>21}")
+    for name in BACKENDS:
+        backend = make_backend(name, args.scale)
+        plain = bytes_per_account(backend, False, args.accounts)
+        compact = bytes_per_account(backend, True, args.accounts)
+        print(f"{name:<10} {plain:>18.0f} {compact:>21.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# Benchmark of the LP and Blockchain operations across pool sizes
+# Usage: python bench_ops.py [--users 10,1000] [--tokens 2,10] [--depth 0,100] [-n N] [-o results.json]
+#        python bench_ops.py --compare base.json new.json [--threshold 0.1]
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from fractions import Fraction
+
+from blockchain import Blockchain
+from numeric import BACKENDS, make_backend
+
+"""
+Each configuration (users, tokens, depth of the accrual history) builds a pool
+where user i supplies token i % tokens and borrows token (i+1) % tokens,
+followed by depth accruals of interest. Each operation is then timed on its own
+fork of the pool (see state.py), so that all of them start from the same state
+and the setup is paid once. The latencies are measured per call, over n calls
+spread round-robin over the users, keeping the fastest of a few runs to
+reduce the noise of the machine.
+
+The results are JSON records with the throughput (ops/s), the latency
+percentiles (in microseconds) and the fraction of reverted calls (which still
+measures work, but less of it). The compare mode matches the records of two
+result files, and flags the operations whose throughput dropped by more than
+the threshold.
+"""
+
+OPS = ["deposit", "borrow", "repay", "redeem", "liquidate", "accrue_interest", "set_price", "net_worth"]
+KEY = ("backend", "compact", "users", "tokens", "depth", "op")  # fields identifying a record
+
+def setup(users, tokens, depth, backend, compact=False):
+    """
+    Returns a Blockchain with the given numbers of users and tokens, after depth accruals of interest.
+    """
+    bc = Blockchain(verbose=False, backend=backend, compact=compact)
+    bc.set_interest_rate(0, Fraction(1, 1000))
+    for j in range(tokens):
+        bc.faucet("W", 10 * users * 100, f"T{j}")
+        bc.deposit("W", 10 * users * 100, f"T{j}")
+    for i in range(users):
+        supplied, borrowed = f"T{i % tokens}", f"T{(i+1) % tokens}"
+        bc.faucet(f"U{i}", 1000, supplied)
+        bc.deposit(f"U{i}", 100, supplied)
+        bc.borrow(f"U{i}", 50, borrowed)
+    for _ in range(depth):
+        bc.accrue_interest()
+    return bc
+
+def calls(op, users, tokens):
+    """
+    Returns a function k -> (method name, args) for the k-th call of op.
+    """
+    amount = Fraction(1, 10)
+    user = lambda k: (f"U{k % users}", f"T{k % users % tokens}", f"T{(k % users + 1) % tokens}")
+    if op == "deposit":
+        return lambda k: ("deposit", (user(k)[0], amount, user(k)[1]))
+    if op == "borrow":
+        return lambda k: ("borrow", (user(k)[0], amount, user(k)[2]))
+    if op == "repay":
+        return lambda k: ("repay", (user(k)[0], amount, user(k)[2]))
+    if op == "redeem":
+        return lambda k: ("redeem", (user(k)[0], amount, user(k)[1]))
+    if op == "liquidate":
+        # the suppliers of T0 (borrowing T1) are undercollateralized once the price of T0 is halved
+        debtors = max(1, len(range(0, users, tokens)))
+        return lambda k: ("liquidate", ("L", amount, "T1", f"U{k % debtors * tokens}", "T0"))
+    if op == "accrue_interest":
+        return lambda k: ("accrue_interest", ())
+    if op == "set_price":
+        return lambda k: ("set_price", (f"T{k % tokens}", Fraction(1000 + k % 7, 1000)))
+    if op == "net_worth":
+        return lambda k: ("net_worth", (user(k)[0],))
+    raise ValueError(f"Unknown operation '{op}'.")
+
+def bench_op(base, op, users, tokens, n):
+    """
+    Times n calls of op on a fork of base, and returns (ops per second, latencies in microseconds, reverted calls).
+    """
+    bc = base.fork()
+    if op == "liquidate":
+        bc.faucet("L", 10 * n, "T1")
+        bc.set_price("T0", Fraction(1, 2))
+    call = calls(op, users, tokens)
+    prepared = [call(k) for k in range(n)]
+    latencies = []
+    reverted = 0
+    clock = time.perf_counter_ns
+    start = clock()
+    for name, args in prepared:
+        method = getattr(bc, name)
+        t = clock()
+        method(*args)
+        latencies.append((clock() - t) / 1000)
+        reverted += bc.lastReverted
+    elapsed = (clock() - start) / 1e9
+    return n / elapsed, latencies, reverted
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def run(users_list, tokens_list, depths, backends, compact, ops, n, repeat=1):
+    """
+    Runs the benchmark over the grid of configurations, and returns the list of result records
+    (for each operation, the fastest of repeat runs, each on a new fork).
+    """
+    results = []
+    for name, users, tokens, depth in itertools.product(backends, users_list, tokens_list, depths):
+        start = time.perf_counter()
+        base = setup(users, tokens, depth, make_backend(name), compact)
+        setup_s = time.perf_counter() - start
+        for op in ops:
+            ops_s, latencies, reverted = max(bench_op(base, op, users, tokens, n) for _ in range(repeat))
+            results.append({
+                "backend": name, "compact": compact, "users": users, "tokens": tokens, "depth": depth, "op": op,
+                "n": n, "ops_per_s": round(ops_s, 1),
+                "p50_us": round(percentile(latencies, 0.5), 2), "p99_us": round(percentile(latencies, 0.99), 2),
+                "max_us": round(max(latencies), 2), "reverted": round(reverted / n, 3), "setup_s": round(setup_s, 3),
+            })
+            r = results[-1]
+            print(f"{name:<9} {users:>7} {tokens:>4} {depth:>5} {op:<16} {r['ops_per_s']:>12.0f} "
+                  f"{r['p50_us']:>10.1f} {r['p99_us']:>10.1f} {r['reverted']:>9.0%}", flush=True)
+    return results
+
+def compare(base, new, threshold):
+    """
+    Prints the change of throughput of the records of new found in base, flagging the drops beyond threshold.
+    Returns the number of regressions.
+    """
+    old = {tuple(r[k] for k in KEY): r for r in base["results"]}
+    regressions = 0
+    print(f"{'configuration':<44} {'base (ops/s)':>13} {'new (ops/s)':>12} {'change':>8}")
+    for r in new["results"]:
+        key = tuple(r[k] for k in KEY)
+        if key not in old:
+            continue
+        change = r["ops_per_s"] / old[key]["ops_per_s"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        label = f"{r['backend']}{'/compact' if r['compact'] else ''} u={r['users']} t={r['tokens']} d={r['depth']} {r['op']}"
+        print(f"{label:<44} {old[key]['ops_per_s']:>13.0f} {r['ops_per_s']:>12.0f} {change:>+8.1%}{flag}")
+    return regressions
+
+def int_list(text):
+    return [int(x) for x in text.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LP and Blockchain operations across pool sizes.")
+    parser.add_argument("--users", type=int_list, default=[10, 1000, 100000], help="Numbers of users (default: 10,1000,100000).")
+    parser.add_argument("--tokens", type=int_list, default=[2, 10, 50], help="Numbers of tokens (default: 2,10,50).")
+    parser.add_argument("--depth", type=int_list, default=[0, 100], help="Numbers of accruals before the benchmark (default: 0,100).")
+    parser.add_argument("--ops", type=lambda text: text.split(","), default=OPS, help=f"Operations (default: {','.join(OPS)}).")
+    parser.add_argument("-b", "--backend", type=lambda text: text.split(","), default=["fraction"], help=f"Numeric backends, among {', '.join(BACKENDS)} (default: fraction).")
+    parser.add_argument("--compact", action="store_true", help="Use the compact storage for the maps by address.")
+    parser.add_argument("-n", type=int, default=1000, help="Number of calls of each operation (default: 1000).")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs of each operation, keeping the fastest (default: 3).")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Write the results as JSON to FILE.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two result files instead of running the benchmark.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative drop of throughput flagged as a regression (default: 0.1).")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        results = []
+        for filename in args.compare:
+            with open(filename) as f:
+                results.append(json.load(f))
+        regressions = compare(*results, args.threshold)
+        print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+    for op in args.ops:
+        if op not in OPS:
+            parser.error(f"unknown operation '{op}' (expected one of {', '.join(OPS)})")
+    for name in args.backend:
+        if name not in BACKENDS:
+            parser.error(f"unknown backend '{name}' (expected one of {', '.join(BACKENDS)})")
+    print(f"{'backend':<9} {'users':>7} {'tok':>4} {'depth':>5} {'op':<16} {'ops/s':>12} {'p50 (us)':>10} {'p99 (us)':>10} {'reverted':>9}")
+    results = run(args.users, args.tokens, args.depth, args.backend, args.compact, args.ops, args.n, args.repeat)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
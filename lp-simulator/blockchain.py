@@ -1,17 +1,27 @@
 from lp import LP
 from string_utils import *
+from events import Observable, operation
+from numeric import make_backend
+from state import Versioned
+from trace_utils import add_replay_arguments, check_replay_arguments, replay
 import argparse
 import sys
 import logging
-logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 log = logging.getLogger(__name__)
 
-class Blockchain:
+class Blockchain(Versioned, Observable):
+    MAPS = ("wallets", "holdings")
 
-    def __init__(self):
-        self.lp = LP()
+    def __init__(self, debug=False, verbose=True, backend=None, compact=False):
+        self.lp = LP(debug=debug, verbose=verbose, backend=backend, compact=compact)
+        self.num = self.lp.num
         self.wallets = {}  # wallet map  {token: {address: amount}}
+        self.holdings = self.lp.new_map(objects=True)   # tokens in the wallet of each address {address: (token, ...)}
         self.lastReverted = False
+        self.lastRevertReason = None
+
+        # If not verbose, no log message is computed
+        self.verbose = verbose
 
     def pretty_print(self, precise=False):
         """
@@ -24,21 +34,52 @@ class Blockchain:
         print(f"{clean_repr(self.wallets)} | ", end='')
         self.lp.pretty_print(precise)
 
+    def revert(self, msg, reason=None):
+        """
+        Reverts the current operation, recording the reason
+        (by default, the logged message).
+        """
+        if self.verbose:
+            log.warning(msg)
+        self.lastReverted = True
+        self.lastRevertReason = msg if reason is None else reason
+
+    def snapshot(self):
+        """
+        Returns a snapshot of the wallets and of the LP state, that can be passed to restore().
+        """
+        return (Versioned.snapshot(self), self.lp.snapshot())
+
+    def restore(self, snapshot):
+        Versioned.restore(self, snapshot[0])
+        self.lp.restore(snapshot[1])
+
+    def release(self, snapshot):
+        Versioned.release(self, snapshot[0])
+        self.lp.release(snapshot[1])
+
+    def fork(self):
+        """
+        Returns an independent copy of the blockchain (and of its LP), sharing their maps copy-on-write.
+        """
+        child = Versioned.fork(self)
+        child.lp = self.lp.fork()
+        child.num = child.lp.num
+        return child
+
     # Mint tokens to an address
+    @operation
     def faucet(self, address, amount, token):
-        log.info(f"{address}: faucet({amount}:{token})")
+        amount = self.num(amount)
+        if self.verbose:
+            log.info(f"{address}: faucet({amount}:{token})")
 
         # if amount <= 0:
         #     log.warning("Faucet amount must be greater than zero.")
         #     self.lastReverted = True
         #     return
 
-        if token not in self.wallets:
-            self.wallets[token] = {}
-        if address not in self.wallets[token]:
-            self.wallets[token][address] = 0
-    
-        self.wallets[token][address] += amount
+        self.__set_tokens(address, token, self.get_tokens(address, token) + amount)
         self.lastReverted = False
 
     def get_tokens(self, address, token):
@@ -50,89 +91,145 @@ class Blockchain:
 
     def __set_tokens(self, address, token, amount):
         if token not in self.wallets:
-            self.wallets[token] = {}
-        self.wallets[token][address] = amount
+            self._put("wallets", token, self.lp.new_map())
+        if address not in self.wallets[token]:
+            tokens = self.holdings.get(address, ()) + (token,)
+            self._put("holdings", address, self.lp.token_sets.setdefault(tokens, tokens))
+        self._put2("wallets", token, address, amount)
 
     def health_factor(self, address):
         """
         Returns the health factor of an address
         """
         hf = self.lp.health_factor(address)
-        log.info(f"H({address}) = {hf}")
+        if self.verbose:
+            log.info(f"H({address}) = {hf}")
         return hf
 
     def net_worth(self, address):
         """
         Returns the net worth of an address in terms of all tokens.
         """
-        net_worth = 0
+        net_worth = self.__net_worth(address, {}, {})
+        if self.verbose:
+            log.info(f"W({address}) = {net_worth}")
+        return net_worth
 
-        # Value of tokens in address' wallet
-        for token, balance in self.wallets.items():
-            if address in balance:
-                net_worth += balance[address] * self.lp.get_price(token)
+    def net_worths(self, addresses):
+        """
+        Returns the net worths of the given addresses {address: net worth},
+        computing the price and the exchange rate of each token once.
+        """
+        prices, xrs = {}, {}
+        return {address: self.__net_worth(address, prices, xrs) for address in addresses}
 
-        # Value of tokens in credit tokens
-        for token, balance in self.lp.minted.items():
-            if address in balance:
-                net_worth += balance[address] * self.lp.XR(token) * self.lp.get_price(token)
+    def __net_worth(self, address, prices, xrs):
+        # visits only the tokens held by the address (in its wallet, or as credit or debt),
+        # with the prices and exchange rates cached in the given dicts
+        lp = self.lp
+        net_worth = lp.zero
 
-        # Value of tokens in debit tokens
-        for token, balance in self.lp.debts.items():
-            if address in balance:
-                net_worth -= balance[address] * self.lp.get_price(token)
+        # Value of tokens in address' wallet
+        for token in self.holdings.get(address, ()):
+            if token not in prices:
+                prices[token] = lp.get_price(token)
+            net_worth += self.wallets[token][address] * prices[token]
+
+        # Value of tokens in credit tokens, minus the value of debit tokens
+        for token in lp.positions.get(address, ()):
+            if token not in prices:
+                prices[token] = lp.get_price(token)
+            minted = lp.get_minted(token, address)
+            if minted != 0:
+                if token not in xrs:
+                    xrs[token] = lp.XR(token)
+                net_worth += minted * xrs[token] * prices[token]
+            net_worth -= lp.get_debts(token, address) * prices[token]
 
-        log.info(f"W({address}) = {net_worth}")
         return net_worth
     
+    @operation
+    def execute_bundle(self, ops):
+        """
+        Executes the operations ops, pairs (method, args) where method is the name of a method
+        (or the function of one), as a unit: if one of them reverts, the writes of the bundle
+        are undone from the journal (see state.py), and the bundle reverts with its reason.
+        """
+        snapshot = self.snapshot()
+        self.lastReverted = False
+        try:
+            for i, (method, args) in enumerate(ops, 1):
+                if isinstance(method, str):
+                    fn = getattr(type(self), method, None) if not method.startswith('_') else None
+                    if not callable(fn):
+                        raise ValueError(f"Unknown method '{method}'.")
+                else:
+                    fn = method
+                fn(self, *args)
+                if self.lastReverted:
+                    reason = self.lastRevertReason
+                    self.restore(snapshot)
+                    self.revert(f"Bundle reverted at operation {i} ({fn.__name__}).", reason)
+                    return
+        except BaseException:
+            self.restore(snapshot)
+            raise
+        finally:
+            self.release(snapshot)
+        self.lastReverted = False
+
     # Method wrappers for the LP model
 
+    @operation
     def set_liq_threshold(self, tliq):
         self.lp.set_liq_threshold(tliq)
         if self.lp.lastReverted:
-            log.warning("set_liq_threshold failed.")
-            self.lastReverted = True
+            self.revert("set_liq_threshold failed.", self.lp.lastRevertReason)
             return
+        self.lastReverted = False
 
+    @operation
     def set_liq_reward_factor(self, rliq):
         self.lp.set_liq_reward_factor(rliq)
         if self.lp.lastReverted:
-            log.warning("set_liq_reward_factor failed.")
-            self.lastReverted = True
+            self.revert("set_liq_reward_factor failed.", self.lp.lastRevertReason)
             return
+        self.lastReverted = False
 
+    @operation
     def set_interest_rate(self, alpha, beta):
         self.lp.set_interest_rate(alpha, beta)
         if self.lp.lastReverted:
-            log.warning("set_interest_rate failed.")
-            self.lastReverted = True
+            self.revert("set_interest_rate failed.", self.lp.lastRevertReason)
             return
+        self.lastReverted = False
 
+    @operation
     def deposit(self, address, amount, token):
+        amount = self.num(amount)
         if amount <= 0:
-            log.warning("Deposit amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Deposit amount must be greater than zero.")
             return
         
         a_tok = self.get_tokens(address,token)
         
         if a_tok<amount:
-            log.warning(f"Address {address} has insufficient units of {token}")
-            self.lastReverted = True
+            self.revert(f"Address {address} has insufficient units of {token}")
             return
         
         self.lp.deposit(address, amount, token)
 
         if self.lp.lastReverted:
-            log.warning(f"Deposit failed for {address} with {amount}:{token}")
-            self.lastReverted = True
+            self.revert(f"Deposit failed for {address} with {amount}:{token}", self.lp.lastRevertReason)
             return
         self.__set_tokens(address, token, a_tok - amount)
+        self.lastReverted = False
 
+    @operation
     def borrow(self, address, amount, token):
+        amount = self.num(amount)
         if amount <= 0:
-            log.warning("Borrow amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Borrow amount must be greater than zero.")
             return
 
         a_tok = self.get_tokens(address,token)
@@ -140,8 +237,7 @@ class Blockchain:
         out_tok = self.lp.borrow(address, amount, token)
 
         if self.lp.lastReverted:
-            log.warning(f"Borrow failed for {address} with {amount}:{token}")
-            self.lastReverted = True
+            self.revert(f"Borrow failed for {address} with {amount}:{token}", self.lp.lastRevertReason)
             return
         
         # if lp.borrow does not revert, then it must return the amount of token borrowed
@@ -149,46 +245,58 @@ class Blockchain:
 
         # updates the address' wallet
         self.__set_tokens(address, token, a_tok + out_tok)
+        self.lastReverted = False
 
+    @operation
     def repay(self, address, amount, token):
+        amount = self.num(amount)
         if amount <= 0:
-            log.warning("Repay amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Repay amount must be greater than zero.")
             return
         
         a_tok = self.get_tokens(address,token)
 
         if a_tok<amount:
-            log.warning(f"Address {address} has insufficient units of {token}")
-            self.lastReverted = True
+            self.revert(f"Address {address} has insufficient units of {token}")
             return
         
         self.lp.repay(address, amount, token)
 
         if self.lp.lastReverted:
-            log.warning(f"Repay failed for {address} with {amount}:{token}")
-            self.lastReverted = True
+            self.revert(f"Repay failed for {address} with {amount}:{token}", self.lp.lastRevertReason)
             return
         self.__set_tokens(address, token, a_tok - amount)
+        self.lastReverted = False
 
-    def accrue_interest(self):
-        self.lp.accrue_interest()
+    @operation
+    def accrue_interest(self, periods=1):
+        self.lp.accrue_interest(periods)
         if self.lp.lastReverted:
-            log.warning("accrue_interest failed.")
-            self.lastReverted = True
+            self.revert("accrue_interest failed.", self.lp.lastRevertReason)
             return
+        self.lastReverted = False
         
+    @operation
+    def set_block(self, block):
+        self.lp.set_block(block)
+        if self.lp.lastReverted:
+            self.revert("set_block failed.", self.lp.lastRevertReason)
+            return
+        self.lastReverted = False
+
+    @operation
     def set_price(self, token, price):
         self.lp.set_price(token, price)
         if self.lp.lastReverted:
-            log.warning("set_price failed.")
-            self.lastReverted = True
+            self.revert("set_price failed.", self.lp.lastRevertReason)
             return
+        self.lastReverted = False
 
+    @operation
     def redeem(self, address, amount, token):
+        amount = self.num(amount)
         if amount <= 0:
-            log.warning("Borrow amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Borrow amount must be greater than zero.")
             return
 
         a_tok = self.get_tokens(address,token)
@@ -196,8 +304,7 @@ class Blockchain:
         out_tok = self.lp.redeem(address, amount, token)
 
         if self.lp.lastReverted:
-            log.warning(f"Redeem failed for {address} with {amount}:{token}")
-            self.lastReverted = True
+            self.revert(f"Redeem failed for {address} with {amount}:{token}", self.lp.lastRevertReason)
             return
         
         # if lp.redeem does not revert, then it must return the amount of token redeemed
@@ -205,49 +312,52 @@ class Blockchain:
 
         # updates the address' wallet
         self.__set_tokens(address, token, a_tok + out_tok)
+        self.lastReverted = False
 
+    @operation
     def liquidate(self, address, amount, token_debt, address_debtor, token_minted):
+        amount = self.num(amount)
         if amount <= 0:
-            log.warning("Liquidate amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Liquidate amount must be greater than zero.")
             return
         
         a_tok = self.get_tokens(address,token_debt)
         
         if a_tok<amount:
-            log.warning(f"Address {address} has insufficient units of {token_debt}")
-            self.lastReverted = True
+            self.revert(f"Address {address} has insufficient units of {token_debt}")
             return
         
         self.lp.liquidate(address, amount, token_debt, address_debtor, token_minted)
 
         if self.lp.lastReverted:
-            log.warning(f"Liquidate failed for {address} with {amount}:{token_debt}")
-            self.lastReverted = True
+            self.revert(f"Liquidate failed for {address} with {amount}:{token_debt}", self.lp.lastRevertReason)
             return
         
         self.__set_tokens(address, token_debt, a_tok - amount)
+        self.lastReverted = False
 
+    @operation
     def swap(self, address, amount_out, token_out, token_in):
+        amount_out = self.num(amount_out)
         if amount_out <= 0:
-            log.warning("Swap amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Swap amount must be greater than zero.")
             return
         
         a_tout = self.get_tokens(address,token_out)
         a_tin = self.get_tokens(address,token_in)
 
         if a_tout<amount_out:
-            log.warning(f"Address {address} has insufficient units of {token_out}")
-            self.lastReverted = True
+            self.revert(f"Address {address} has insufficient units of {token_out}")
             return
 
         amount_in = amount_out * self.lp.get_price(token_out) / self.lp.get_price(token_in)       
 
-        log.info(f"{address} swaps {amount_out}:{token_out} for {amount_in}:{token_in}")
+        if self.verbose:
+            log.info(f"{address} swaps {amount_out}:{token_out} for {amount_in}:{token_in}")
 
         self.__set_tokens(address, token_out, a_tout - amount_out)
         self.__set_tokens(address, token_in, a_tin + amount_in)
+        self.lastReverted = False
 
 # Run the main function if the script is executed directly
 def main():
@@ -255,97 +365,16 @@ def main():
     Main function to process a file with transaction commands.
     """
     parser = argparse.ArgumentParser(description="Simulate a Lending Pool from a transaction trace file.")
-    parser.add_argument("filename", help="The input file containing transaction trace.")
-    parser.add_argument("-p", "--precise", action="store_true",  help="Use precise fraction representation in output.")
-    
+    add_replay_arguments(parser)
+
     args = parser.parse_args()
-    is_precise = args.precise
-
-    try:
-        with open(args.filename, "r") as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        print(f"Error: File '{args.filename}' not found.")
-        sys.exit(1)
-    
-    # Create an instance of Blockchain
-    bc = Blockchain()
+    check_replay_arguments(parser, args)
 
-    # Process each line
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        try:
-            if line.startswith('#'):
-                # Skip comment lines
-                continue
-
-            # Example input format: A:deposit(1:T)
-            elif ':' in line:
-                address, rest = line.split(':', 1)
-                if '(' in rest:
-                    method, args = rest.split('(', 1)
-                    args = args.strip(')')
-
-                    # Parse arguments
-                    parsed_args = []
-                    for arg in args.split(','):
-                        if ':' in arg:  # For example, "1:T"
-                            amount, token = arg.split(':')
-                            parsed_args.extend([Fraction(amount), token])
-                        else:
-                            parsed_args.append(arg.strip())
-
-                    # Call the method dynamically
-                    if hasattr(bc, method):
-                        getattr(bc, method)(address, *parsed_args)
-                        bc.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in Blockchain class.")
-                else:
-                    method = rest
-                    if hasattr(bc, method):
-                        getattr(bc, method)()
-                        bc.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in Blockchain class.")
-            else:
-                # Non-address-prefixed command, e.g., accrue_interest, set_price(T,2)
-                if '(' in line:
-                    method, args = line.split('(', 1)
-                    args = args.strip(')')
-                    parsed_args = []
-                    for arg in args.split(','):
-                        if arg.replace('.','',1).isdigit(): # arg is a number
-                            parsed_args.append(Fraction(arg))
-                        else:
-                            arg = arg.strip()
-                            try:
-                                # Try to parse as a Fraction (handles both '2/3' and '3.5')
-                                parsed_args.append(Fraction(arg))
-                            except ValueError:
-                            # Fallback to string or other types if not a valid Fraction
-                                parsed_args.append(arg)
-
-                    if hasattr(bc, method):
-                        getattr(bc, method)(*parsed_args)
-                        bc.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in Blockchain class.")
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-                else:
-                    # No arguments, e.g., accrue_interest
-                    method = line
-                    if hasattr(bc, method):
-                        getattr(bc, method)()
-                        bc.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in Blockchain class.")
-
-        except Exception as e:
-            log.error(f"Error processing line '{line}': {e}")
+    # Create an instance of Blockchain
+    bc = Blockchain(verbose=not args.quiet, backend=make_backend(args.backend, args.scale), compact=args.compact)
+    replay(bc, args)
 
 # Run the main function if the script is executed directly
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+import hashlib
+import os
+import pickle
+import time
+from collections.abc import Mapping
+
+from state import ABSENT, Versioned
+
+"""
+Checkpoints of a trace replay, to resume it after an interruption.
+
+A checkpoint directory holds:
+- base.pickle:        the full state of the model (and of its LP), with the
+                      trace offset (number of lines consumed) and the hash of
+                      the consumed lines;
+- deltas-<gen>.pickle: a sequence of pickled deltas, each with the cells
+                      changed since the previous checkpoint and the new offset.
+
+A checkpoint appends a delta, computed from the undo journal since the previous
+checkpoint (see state.py), so its cost is proportional to the writes. When the
+deltas outgrow the base, they are compacted into a new base, of the next
+generation (the deltas of the other generations are ignored). The values are
+pickled as they are, so fractions are stored exactly.
+"""
+
+FORMAT = 2  # version of the checkpoint format
+
+class CheckpointError(Exception):
+    """
+    Raised when a checkpoint cannot be resumed (different model or trace).
+    """
+
+def parts(model):
+    """
+    Returns the versioned objects holding the state of model (a Blockchain includes its LP).
+    """
+    lp = getattr(model, "lp", model)
+    return [model] if model is lp else [model, lp]
+
+def status(model):
+    # the revert status of each part (the LP of a Blockchain has its own)
+    return [(part.lastReverted, part.lastRevertReason) for part in parts(model)]
+
+def set_status(model, status):
+    for part, (reverted, reason) in zip(parts(model), status):
+        part.lastReverted, part.lastRevertReason = reverted, reason
+
+def config(model):
+    lp = getattr(model, "lp", model)
+    return {
+        "model": type(model).__name__,
+        "backend": lp.backend.name,
+        "scale": getattr(lp.backend, "scale", None),
+        "compact": lp.interner is not None,
+    }
+
+def dump_value(value):
+    # inner maps are stored as plain dicts, deleted cells as None
+    if value is ABSENT:
+        return None
+    if isinstance(value, Mapping):
+        return dict(value)
+    return value
+
+def load_value(model, value):
+    if isinstance(value, dict):
+        inner = getattr(model, "lp", model).new_map()
+        inner.update(value)
+        return inner
+    return value
+
+def dump_state(model):
+    return [{
+        "maps": {name: {key: dump_value(value) for key, value in getattr(part, name).items()} for name in part.MAPS},
+        "params": {name: getattr(part, name) for name in part.PARAMS},
+    } for part in parts(model)]
+
+def load_state(model, state):
+    for part, part_state in zip(parts(model), state):
+        for name, cells in part_state["maps"].items():
+            target = getattr(part, name)
+            target.clear()
+            for key, value in cells.items():
+                target[key] = load_value(model, value)
+        for name, value in part_state["params"].items():
+            setattr(part, name, value)
+
+def apply_delta(model, delta):
+    for part, part_delta in zip(parts(model), delta["parts"]):
+        for name, key, value in part_delta["cells"]:
+            if value is None:
+                getattr(part, name).pop(key, None)
+            else:
+                getattr(part, name)[key] = load_value(model, value)
+        for name, key, subkey, value in part_delta["cells2"]:
+            if value is None:
+                getattr(part, name)[key].pop(subkey, None)
+            else:
+                getattr(part, name)[key][subkey] = value
+        for name, value in part_delta["params"].items():
+            setattr(part, name, value)
+    set_status(model, delta["status"])
+
+class Checkpointer:
+    """
+    Writes the checkpoints of the replay of a trace on model, every n steps and/or every given seconds.
+
+    Usage: resume() (optional) and start(), then read the trace through lines(), call step(step)
+    after each executed step (e.g. as the after callback of run_trace), and close() at the end.
+    """
+    def __init__(self, model, directory, every=None, seconds=None):
+        self.model = model
+        self.directory = directory
+        self.every = every
+        self.seconds = seconds
+        self.offset = 0     # number of lines of the trace consumed
+        self.digest = hashlib.sha256()  # hash of the lines consumed
+        self.steps = 0      # number of steps executed
+        self.generation = 0
+        self.base_size = 0
+        self.deltas = None  # file of the deltas of the current generation
+        self.deltas_size = 0
+        self.marks = None   # snapshots of the parts of model, at the last checkpoint
+        self.last_steps = 0
+        self.last_time = time.monotonic()
+
+    def __path(self, name):
+        return os.path.join(self.directory, name)
+
+    def resume(self, lines):
+        """
+        Loads the latest checkpoint into model, if any, and consumes the lines of the trace before its offset.
+        Returns the iterator over the remaining lines (to be passed to lines()), and the number of the next line.
+        """
+        try:
+            with open(self.__path("base.pickle"), "rb") as f:
+                base = pickle.load(f)
+        except FileNotFoundError:
+            return lines, 1
+        if base["format"] != FORMAT or base["config"] != config(self.model):
+            raise CheckpointError(f"The checkpoint in '{self.directory}' is for a different model: {base['config']}.")
+        load_state(self.model, base["state"])
+        set_status(self.model, base["status"])
+        checkpoint = base
+        self.generation = base["generation"]
+        self.base_size = os.path.getsize(self.__path("base.pickle"))
+
+        # applies the complete deltas, and drops a partially written one
+        path = self.__path(f"deltas-{self.generation}.pickle")
+        valid = 0
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    try:
+                        delta = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError):
+                        break
+                    apply_delta(self.model, delta)
+                    checkpoint = delta
+                    valid = f.tell()
+            with open(path, "r+b") as f:
+                f.truncate(valid)
+        except FileNotFoundError:
+            pass
+        self.deltas_size = valid
+        self.steps = self.last_steps = checkpoint["steps"]
+
+        # checks that the trace is the same up to the offset
+        lines = iter(lines)
+        for _ in range(checkpoint["offset"]):
+            line = next(lines, None)
+            if line is None:
+                break
+            self.offset += 1
+            self.digest.update(line.encode())
+        if self.offset != checkpoint["offset"] or self.digest.hexdigest() != checkpoint["digest"]:
+            raise CheckpointError(f"The trace differs from the one of the checkpoint in '{self.directory}'.")
+        return lines, self.offset + 1
+
+    def lines(self, lines):
+        """
+        Yields the lines of the trace, keeping track of the offset and of the hash of the consumed lines.
+        """
+        for line in lines:
+            self.offset += 1
+            self.digest.update(line.encode())
+            yield line
+
+    def start(self):
+        """
+        Writes a base checkpoint (unless resuming from one), and starts tracking the changes.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if self.base_size == 0:
+            self.__write_base()
+            self.deltas = open(self.__path(f"deltas-{self.generation}.pickle"), "wb")
+        else:
+            self.deltas = open(self.__path(f"deltas-{self.generation}.pickle"), "ab")
+        self.marks = [Versioned.snapshot(part) for part in parts(self.model)]
+
+    def __write_base(self):
+        base = {
+            "format": FORMAT,
+            "config": config(self.model),
+            "generation": self.generation,
+            "offset": self.offset,
+            "digest": self.digest.hexdigest(),
+            "steps": self.steps,
+            "status": status(self.model),
+            "state": dump_state(self.model),
+        }
+        tmp = self.__path("base.pickle.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(base, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.__path("base.pickle"))
+        self.base_size = os.path.getsize(self.__path("base.pickle"))
+        for name in os.listdir(self.directory):
+            if name.startswith("deltas-") and name != f"deltas-{self.generation}.pickle":
+                os.remove(self.__path(name))
+
+    def __delta(self):
+        delta = {"offset": self.offset, "digest": self.digest.hexdigest(), "steps": self.steps,
+                 "status": status(self.model), "parts": []}
+        for part, mark in zip(parts(self.model), self.marks):
+            cells, cells2, params = {}, {}, {}
+            for entry in part.journal[mark.mark:]:
+                if len(entry) == 2:
+                    params[entry[0]] = None
+                elif len(entry) == 3:
+                    cells[entry[:2]] = None
+                else:
+                    cells2[entry[:3]] = None
+            delta["parts"].append({
+                "cells": [(name, key, dump_value(getattr(part, name).get(key, ABSENT))) for name, key in cells],
+                "cells2": [(name, key, subkey, dump_value(getattr(part, name).get(key, {}).get(subkey, ABSENT)))
+                           for name, key, subkey in cells2],
+                "params": {name: getattr(part, name) for name in params},
+            })
+            Versioned.release(part, mark)
+        return delta
+
+    def checkpoint(self):
+        """
+        Writes a checkpoint of the current state.
+        """
+        data = pickle.dumps(self.__delta())
+        if self.deltas_size + len(data) > max(self.base_size, 1 << 16):
+            # compacts the deltas into a new base
+            self.deltas.close()
+            self.generation += 1
+            self.__write_base()
+            self.deltas = open(self.__path(f"deltas-{self.generation}.pickle"), "wb")
+            self.deltas_size = 0
+        else:
+            self.deltas.write(data)
+            self.deltas.flush()
+            os.fsync(self.deltas.fileno())
+            self.deltas_size += len(data)
+        self.marks = [Versioned.snapshot(part) for part in parts(self.model)]
+        self.last_steps = self.steps
+        self.last_time = time.monotonic()
+
+    def step(self, step):
+        """
+        To be called after each executed Step: writes a checkpoint when the step or time interval has elapsed.
+        A checkpoint due after a partial Step is delayed to the last Step of its line, since the offset
+        counts whole lines.
+        """
+        self.steps += 1
+        if step.partial:
+            return
+        if self.every is not None and self.steps - self.last_steps >= self.every:
+            self.checkpoint()
+        elif self.seconds is not None and time.monotonic() - self.last_time >= self.seconds:
+            self.checkpoint()
+
+    def close(self):
+        """
+        Writes a last checkpoint, and releases the snapshots.
+        """
+        if self.steps != self.last_steps:
+            self.checkpoint()
+        for part, mark in zip(parts(self.model), self.marks):
+            Versioned.release(part, mark)
+        self.marks = None
+        self.deltas.close()
@@ -0,0 +1,133 @@
+from array import array
+from collections.abc import MutableMapping
+
+"""
+Compact storage for the balance maps of the LP and Blockchain models.
+
+In compact mode, the inner maps {address: amount} are CompactMaps: the
+addresses are interned to small integer ids (shared by all the maps of a
+model), and the amounts are stored in a column indexed by id, with a byte
+per id marking the present cells. The column is a typed array when the
+numeric backend has a fixed-size encoding (backend.typecode, with
+backend.width items per value: e.g. 8 bytes per float, 16 per fraction as
+a pair of 64-bit integers), and a list of objects otherwise. A column falls
+back to a list when a value does not fit its encoding.
+
+A CompactMap behaves as a dict, so the models and the versioned state use it
+unchanged; only the maps are created through LP.new_map().
+"""
+
+class Interner:
+    """
+    Bidirectional map between names and consecutive integer ids.
+    Ids are never reused, so an interner can be shared by forked models.
+    """
+    def __init__(self):
+        self.ids = {}       # {name: id}
+        self.names = []     # [name] by id
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+        return i
+
+    def __len__(self):
+        return len(self.names)
+
+class CompactMap(MutableMapping):
+    """
+    A map {name: value} storing its values in a column indexed by the ids of an Interner.
+    Iterates in the order of the ids (i.e. of first interning), not of insertion.
+    """
+    __slots__ = ("interner", "backend", "width", "column", "present", "count")
+
+    def __init__(self, interner, backend, items=()):
+        self.interner = interner
+        self.backend = backend
+        typecode = getattr(backend, "typecode", None)
+        # each value takes width items of the column (1 in a list of objects)
+        self.width = 1 if typecode is None else backend.width
+        self.column = [] if typecode is None else array(typecode)
+        self.present = bytearray()
+        self.count = 0
+        for name, value in dict(items).items():
+            self[name] = value
+
+    def __grow(self, n):
+        missing = n - len(self.present)
+        if missing > 0:
+            self.present.extend(bytes(missing))
+            if type(self.column) is list:
+                self.column.extend([None] * missing)
+            else:
+                self.column.extend(array(self.column.typecode, bytes(missing * self.width * self.column.itemsize)))
+
+    def __index(self, name):
+        i = self.interner.ids.get(name)
+        if i is None or i >= len(self.present) or not self.present[i]:
+            raise KeyError(name)
+        return i
+
+    def __decode(self, i):
+        if type(self.column) is list:
+            return self.column[i]
+        w = self.width
+        return self.backend.decode(*self.column[i*w:(i+1)*w])
+
+    def __getitem__(self, name):
+        return self.__decode(self.__index(name))
+
+    def __setitem__(self, name, value):
+        i = self.interner.intern(name)
+        self.__grow(i + 1)
+        if type(self.column) is list:
+            self.column[i] = value
+        else:
+            try:
+                w = self.width
+                self.column[i*w:(i+1)*w] = array(self.column.typecode, self.backend.encode(value))
+            except OverflowError:
+                # the value does not fit the typed column: fall back to a list of objects
+                self.column = [self.__decode(j) if self.present[j] else None for j in range(len(self.present))]
+                self.width = 1
+                self.column[i] = value
+        if not self.present[i]:
+            self.present[i] = 1
+            self.count += 1
+
+    def __delitem__(self, name):
+        i = self.__index(name)
+        self.present[i] = 0
+        if type(self.column) is list:
+            self.column[i] = None
+        self.count -= 1
+
+    def __contains__(self, name):
+        i = self.interner.ids.get(name)
+        return i is not None and i < len(self.present) and self.present[i] == 1
+
+    def __iter__(self):
+        names = self.interner.names
+        i = self.present.find(1)
+        while i != -1:
+            yield names[i]
+            i = self.present.find(1, i + 1)
+
+    def __len__(self):
+        return self.count
+
+    def copy(self):
+        other = CompactMap.__new__(CompactMap)
+        other.interner = self.interner
+        other.backend = self.backend
+        other.width = self.width
+        other.column = self.column[:]
+        other.present = bytearray(self.present)
+        other.count = self.count
+        return other
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -1,13 +1,28 @@
+import hashlib
 import random
 from datetime import datetime
 
 from blockchain import *
 from lp import *
 
+def derive_seed(root, *path):
+    """
+    Returns the seed of the stream at path (e.g. the index of a simulation) under the root seed.
+    The derived seeds are hashes of (root, path): each stream is reproducible, and the streams
+    of distinct paths (or roots) are independent, unlike consecutive seeds root + k.
+    """
+    key = ":".join(str(x) for x in (root,) + path)
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:16], "big")
+
 class Model:
 
+    def __init__(self, backend=None):
+        # numeric backend of the simulated blockchain (exact fractions by default)
+        self.backend = backend
+
     def init(self, random_seed):
-        random.seed(random_seed) # ideally, random_seed = datetime.now()
+        # random generator of this model (not the global one, shared by the models of a process)
+        self.rng = random.Random(random_seed) # ideally, random_seed = datetime.now()
 
         # Number of steps in the simulation
         self.t = 0
@@ -15,8 +30,8 @@ class Model:
         # number of steps in the simulation
         self.N_STEPS = 1000
 
-        # Create a new blockchain instance
-        self.bc = Blockchain()
+        # Create a new blockchain instance (without logging, for speed)
+        self.bc = Blockchain(verbose=False, backend=self.backend)
 
         # Liquidator
         self.bc.faucet("A", 1000, "T0")
@@ -36,10 +51,10 @@ class Model:
         # 2 -> A liquidates
         # 3 -> set price
 
-        b = random.randint(0,3)
+        b = self.rng.randint(0,3)
 
         if (b==0):
-            amt = random.randint(1,10)
+            amt = self.rng.randint(1,10)
             self.bc.borrow("B", 5, "T0")
 
         elif b==1:
@@ -55,6 +70,39 @@ class Model:
         while (self.t < self.N_STEPS):
             self.one_step()
 
+    # batched calls, to replace many single steps and observations by one call
+
+    def perform_steps(self, n):
+        """
+        Performs n steps of simulation.
+        """
+        for _ in range(int(n)):
+            self.one_step()
+
+    def run_until(self, time):
+        """
+        Performs steps of simulation until the simulated time reaches time.
+        """
+        while self.t < time:
+            self.one_step()
+
+    def eval_many(self, observations):
+        """
+        Returns the list of the values of the given observations in the current state.
+        """
+        return [self.eval(obs) for obs in observations]
+
+    def sample(self, observations, times):
+        """
+        Runs the simulation through the increasing times, and returns the values
+        of the observations at each of them (one list per time).
+        """
+        rows = []
+        for time in times:
+            self.run_until(time)
+            rows.append(self.eval_many(observations))
+        return rows
+
     def getTime(self):
         return float(self.t)
 
@@ -0,0 +1,82 @@
+import functools
+import inspect
+from collections import namedtuple
+
+"""
+Structured events emitted by the operations of LP and Blockchain.
+
+An event records:
+- op:       the name of the operation (e.g. "borrow")
+- args:     the arguments of the operation, as a dict {parameter: value}
+- reverted: True if the operation reverted
+- reason:   the revert reason (None if the operation did not revert)
+- pre:      the requested metrics before the operation {metric: {address: value}}
+- post:     the requested metrics after the operation  {metric: {address: value}}
+
+The metrics are methods of the observed object taking an address
+(e.g. "health_factor"), and are evaluated on the addresses passed to the
+operation. They are computed only if some subscriber has requested them.
+"""
+Event = namedtuple("Event", ["op", "args", "reverted", "reason", "pre", "post"])
+
+class Observable:
+    """
+    Mixin for classes whose operations notify events to subscribers.
+    """
+    subscribers = ()    # list of pairs (callback, metrics)
+
+    def subscribe(self, callback, metrics=()):
+        """
+        Registers callback(event) to be called after each operation.
+
+        Parameters:
+        - callback: a function taking an Event.
+        - metrics:  names of the methods to evaluate on the addresses of the operation,
+                    before and after its execution (e.g. ["health_factor", "net_worth"]).
+        """
+        for metric in metrics:
+            if not callable(getattr(self, metric, None)):
+                raise ValueError(f"Unknown metric '{metric}'.")
+        self.subscribers = list(self.subscribers) + [(callback, tuple(metrics))]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [(cb, metrics) for cb, metrics in self.subscribers if cb != callback]
+
+    def _eval_metrics(self, metrics, addresses):
+        return {metric: {address: getattr(self, metric)(address) for address in addresses} for metric in metrics}
+
+def operation(method):
+    """
+    Decorates an operation so that its execution is notified to the subscribers.
+    When there are no subscribers, the operation is called directly.
+    """
+    signature = inspect.signature(method)
+    address_params = [name for name in signature.parameters if name.startswith("address")]
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.subscribers:
+            return method(self, *args, **kwargs)
+
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        op_args = dict(bound.arguments)
+        del op_args["self"]
+
+        metrics = []
+        for _, sub_metrics in self.subscribers:
+            metrics += [metric for metric in sub_metrics if metric not in metrics]
+        addresses = list(dict.fromkeys(op_args[name] for name in address_params))
+
+        pre = self._eval_metrics(metrics, addresses)
+        result = method(self, *args, **kwargs)
+        post = self._eval_metrics(metrics, addresses)
+
+        reason = self.lastRevertReason if self.lastReverted else None
+        event = Event(method.__name__, op_args, self.lastReverted, reason, pre, post)
+        for callback, _ in self.subscribers:
+            callback(event)
+        return result
+
+    wrapper.is_operation = True     # see profiling.py
+    return wrapper
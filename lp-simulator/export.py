@@ -0,0 +1,304 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from state import Versioned
+
+"""
+Columnar export of the state of a model (LP or Blockchain) during a trace replay (requires NumPy).
+
+After each recorded step, the exporter stores:
+- per token (steps x tokens):  reserves, supply, debts, xr, utilization, interest_rate
+- per address and token (steps x addresses x tokens): credits (minted tokens times XR),
+  debts and wallets (Blockchain only)
+- per address (steps x addresses): health_factor (+inf without debts)
+- per step: step (number of executed steps), line, op (index in the ops of the schema), reverted
+The tokens and addresses are numbered in order of appearance. The cells of a
+token or address before it appears are NaN. The values are converted to floats.
+
+The output is a directory of .npy files, which can be memory-mapped with
+np.load(path, mmap_mode="r"), described by schema.json; or, if the path ends
+with .npz, a single bundle (with the schema as the JSON string "schema").
+
+The balances by address are kept in float matrices, updated from the undo
+journal (see state.py) with the cells written since the previous record, so
+that recording a step costs vectorized operations instead of one valuation per
+address. The rows are buffered in chunks, spilled to temporary files, and
+assembled at the end, so the history does not need to fit in memory.
+"""
+
+FORMAT = 1  # version of the schema
+TOKEN_FIELDS = ("reserves", "supply", "debts", "xr", "utilization", "interest_rate")
+BALANCES = {"credits": "minted", "debts": "debts", "wallets": "wallets"}   # {field: map}
+
+class Columns:
+    """
+    A float matrix (addresses x tokens) mirroring a map {token: {address: amount}}, growing with them.
+    """
+    def __init__(self):
+        self.data = np.zeros((16, 4))
+
+    def resize(self, n_addresses, n_tokens):
+        rows, cols = self.data.shape
+        if n_addresses > rows or n_tokens > cols:
+            data = np.zeros((rows if n_addresses <= rows else max(n_addresses, 2 * rows),
+                              cols if n_tokens <= cols else max(n_tokens, 2 * cols)))
+            data[:rows, :cols] = self.data
+            self.data = data
+
+class ColumnarWriter:
+    """
+    Records the state of a model every n steps (and at the end), and writes it in columnar form to path.
+
+    Usage: call step(step) after each executed step (e.g. as the after callback of run_trace), and close() at the end.
+    """
+    def __init__(self, model, path, every=1, chunk=1024, chunk_cells=1 << 22):
+        self.model = model
+        self.lp = getattr(model, "lp", model)
+        self.parts = [model] if model is self.lp else [model, self.lp]
+        self.path = path
+        self.every = every
+        self.chunk = chunk              # maximum number of rows of a chunk
+        self.chunk_cells = chunk_cells  # maximum number of values of a chunk (its memory is 8 bytes per value)
+        self.cells = 0                  # number of values in the current chunk
+        self.tokens = {}        # {token: column}
+        self.addresses = {}     # {address: row}
+        self.ops = {}           # {op name: code}
+        self.fields = [name for name, source in BALANCES.items()
+                       if any(source in part.MAPS for part in self.parts)]
+        self.columns = {BALANCES[name]: Columns() for name in self.fields}
+        self.n_steps = 0
+        self.last = None        # the last executed Step
+        self.pending = False    # True if the last steps have not been recorded yet
+        self.rows = []          # rows of the current chunk
+        self.n_rows = 0
+        self.spill = {}         # {array name: temporary file of the chunks}
+        for source in self.columns:
+            for token, amounts in self.__map(source).items():
+                self.__refresh(source, token, amounts)
+        self.marks = [Versioned.snapshot(part) for part in self.parts]
+
+    def __map(self, source):
+        return getattr(self.model if source == "wallets" else self.lp, source)
+
+    def __token(self, token):
+        if token not in self.tokens:
+            self.tokens[token] = len(self.tokens)
+            for columns in self.columns.values():
+                columns.resize(len(self.addresses), len(self.tokens))
+        return self.tokens[token]
+
+    def __address(self, address):
+        if address not in self.addresses:
+            self.addresses[address] = len(self.addresses)
+            for columns in self.columns.values():
+                columns.resize(len(self.addresses), len(self.tokens))
+        return self.addresses[address]
+
+    def __refresh(self, source, token, amounts):
+        # the whole map of token was replaced
+        j = self.__token(token)
+        rows = [self.__address(address) for address in amounts]
+        data = self.columns[source].data
+        data[:, j] = 0
+        data[rows, j] = [float(amount) for amount in amounts.values()]
+
+    def __update(self):
+        # applies the cells written since the previous record
+        written = {}    # {(source, token): {address: None}}, or {(source, token): None} for whole maps
+        for part, mark in zip(self.parts, self.marks):
+            for entry in part.journal[mark.mark:]:
+                if entry[0] == "reserves":
+                    self.__token(entry[1])
+                if entry[0] not in self.columns:
+                    continue
+                key = (entry[0], entry[1])
+                if len(entry) == 3:
+                    written[key] = None
+                elif written.get(key, {}) is not None:
+                    written.setdefault(key, {})[entry[2]] = None
+            Versioned.release(part, mark)
+        self.marks = [Versioned.snapshot(part) for part in self.parts]
+
+        for (source, token), addresses in written.items():
+            amounts = self.__map(source).get(token, {})
+            if addresses is None:
+                self.__refresh(source, token, amounts)
+                continue
+            j = self.__token(token)
+            for address in addresses:
+                i = self.__address(address)
+                self.columns[source].data[i, j] = float(amounts.get(address, 0))
+
+    def step(self, step):
+        """
+        To be called after each executed Step.
+        """
+        self.n_steps += 1
+        self.last = step
+        self.pending = True
+        if self.n_steps % self.every == 0:
+            self.record()
+
+    def record(self):
+        """
+        Records the current state.
+        """
+        self.__update()
+        lp = self.lp
+        n_addresses, n_tokens = len(self.addresses), len(self.tokens)
+        tokens = list(self.tokens)
+        row = {}
+
+        values = {name: np.full(n_tokens, np.nan) for name in TOKEN_FIELDS}
+        xr = np.ones(n_tokens)
+        index = np.ones(n_tokens)
+        prices = np.array([float(lp.get_price(token)) for token in tokens])
+        for j, token in enumerate(tokens):
+            if token not in lp.reserves:
+                continue
+            xr[j] = float(lp.XR(token))
+            index[j] = float(lp.borrow_index[token])
+            values["reserves"][j] = float(lp.reserves[token])
+            values["supply"][j] = float(lp.tok_supply(token))
+            values["debts"][j] = float(lp.tok_debts(token))
+            values["xr"][j] = xr[j]
+            values["utilization"][j] = float(lp.utilization_ratio(token))
+            values["interest_rate"][j] = float(lp.interest_rate(token))
+        for name in TOKEN_FIELDS:
+            row["token_" + name] = values[name]
+
+        credits = self.columns["minted"].data[:n_addresses, :n_tokens] * xr
+        debts = self.columns["debts"].data[:n_addresses, :n_tokens] * index
+        row["address_credits"] = credits
+        row["address_debts"] = debts
+        if "wallets" in self.columns:
+            row["address_wallets"] = self.columns["wallets"].data[:n_addresses, :n_tokens].copy()
+        val_debts = debts @ prices
+        with np.errstate(divide="ignore", invalid="ignore"):
+            row["address_health_factor"] = np.where(val_debts > 0, float(lp.tliq) * (credits @ prices) / val_debts, np.inf)
+
+        step = self.last
+        row["step"] = self.n_steps
+        row["line"] = step.lineno if step is not None else 0
+        row["op"] = self.ops.setdefault(step.fn.__name__, len(self.ops)) if step is not None else -1
+        row["reverted"] = bool(self.model.lastReverted)
+        self.rows.append(row)
+        self.cells += sum(np.size(value) for value in row.values())
+        self.pending = False
+        if len(self.rows) == self.chunk or self.cells >= self.chunk_cells:
+            self.__flush()
+
+    def __flush(self):
+        # spills the rows of the chunk, padded to the current numbers of addresses and tokens
+        if not self.rows:
+            return
+        n_addresses, n_tokens = len(self.addresses), len(self.tokens)
+        for name in self.rows[0]:
+            first = np.asarray(self.rows[0][name])
+            shape = (len(self.rows),)
+            if name.startswith("token_"):
+                shape = (len(self.rows), n_tokens)
+            elif name == "address_health_factor":
+                shape = (len(self.rows), n_addresses)
+            elif name.startswith("address_"):
+                shape = (len(self.rows), n_addresses, n_tokens)
+            chunk = np.full(shape, np.nan) if first.dtype.kind == "f" else np.zeros(shape, dtype=first.dtype)
+            for k, row in enumerate(self.rows):
+                value = np.asarray(row[name])
+                chunk[(k,) + tuple(slice(0, n) for n in value.shape)] = value
+            if name not in self.spill:
+                self.spill[name] = tempfile.TemporaryFile()
+            np.save(self.spill[name], chunk)
+        self.n_rows += len(self.rows)
+        self.rows = []
+        self.cells = 0
+
+    def schema(self):
+        """
+        Returns the description of the arrays written by close().
+        """
+        axes = {"step": [], "line": [], "op": [], "reverted": []}
+        for name in TOKEN_FIELDS:
+            axes["token_" + name] = ["token"]
+        for name in self.fields:
+            axes["address_" + name] = ["address", "token"]
+        axes["address_health_factor"] = ["address"]
+        sizes = {"address": len(self.addresses), "token": len(self.tokens)}
+        dtypes = {"step": "int64", "line": "int64", "op": "int64", "reverted": "bool"}
+        return {
+            "format": FORMAT,
+            "model": type(self.model).__name__,
+            "backend": self.lp.backend.name,
+            "steps": self.n_rows,
+            "tokens": list(self.tokens),
+            "addresses": list(self.addresses),
+            "ops": list(self.ops),
+            "arrays": {name: {"dtype": dtypes.get(name, "float64"),
+                              "axes": ["step"] + names,
+                              "shape": [self.n_rows] + [sizes[axis] for axis in names]}
+                       for name, names in axes.items()},
+        }
+
+    def close(self):
+        """
+        Records the pending steps, and writes the arrays and the schema.
+        """
+        if self.pending:
+            self.record()
+        self.__flush()
+        for part, mark in zip(self.parts, self.marks):
+            Versioned.release(part, mark)
+        self.marks = []
+        schema = self.schema()
+        bundle = self.path.endswith(".npz")
+        directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.path))) if bundle else self.path
+        os.makedirs(directory, exist_ok=True)
+        try:
+            for name, spec in schema["arrays"].items():
+                self.__write_array(os.path.join(directory, name + ".npy"), name, np.dtype(spec["dtype"]), tuple(spec["shape"]))
+            if bundle:
+                arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in schema["arrays"]}
+                np.savez(self.path, schema=json.dumps(schema), **arrays)
+                del arrays
+            else:
+                with open(os.path.join(directory, "schema.json"), "w") as f:
+                    json.dump(schema, f, indent=2)
+        finally:
+            if bundle:
+                shutil.rmtree(directory)
+
+    def __write_array(self, path, name, dtype, shape):
+        # writes the chunks of an array sequentially, padded to its final shape
+        spill = self.spill.pop(name, None)
+        with open(path, "wb") as f:
+            np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                                     "fortran_order": False, "shape": shape})
+            if spill is None:
+                return
+            spill.seek(0)
+            start = 0
+            while start < shape[0]:
+                chunk = np.load(spill)
+                if chunk.shape[1:] != shape[1:]:
+                    padded = np.full((len(chunk),) + shape[1:], np.nan, dtype=dtype)
+                    padded[(slice(None),) + tuple(slice(0, n) for n in chunk.shape[1:])] = chunk
+                    chunk = padded
+                f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+                start += len(chunk)
+            spill.close()
+
+def load(path, mmap_mode="r"):
+    """
+    Loads an export: returns (schema, {name: array}), memory-mapping the .npy files of a directory.
+    """
+    if path.endswith(".npz"):
+        bundle = np.load(path)
+        schema = json.loads(str(bundle["schema"]))
+        return schema, {name: bundle[name] for name in schema["arrays"]}
+    with open(os.path.join(path, "schema.json")) as f:
+        schema = json.load(f)
+    return schema, {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in schema["arrays"]}
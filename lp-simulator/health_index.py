@@ -0,0 +1,185 @@
+import bisect
+import heapq
+import itertools
+
+class HealthIndex:
+    """
+    Index of the borrowers of an LP, sorted by collateralization.
+
+    The collateral of a borrower is val_minted / val_debts: a borrower is
+    liquidatable when its collateral is below 1/tliq.
+
+    Most borrowers have a single exposure: credits in at most one token C and
+    debts in one token D. Their collateral is r * F(C, D), where
+    - r = minted / scaled debt depends only on the positions of the borrower;
+    - F(C, D) = XR(C) * price(C) / (borrow_index(D) * price(D)) is common to all the
+      borrowers of the pair (0 without credits).
+    They are kept in a sorted list of (r, address) per pair, which neither prices nor
+    interest accruals change: the liquidatable ones are a prefix of each list, below
+    the liquidation boundary r < 1 / (tliq * F(C, D)), found by bisection.
+
+    The other borrowers are kept in a sorted list of (collateral, address). Keys are
+    recomputed lazily, on the next query, for the addresses marked as touched:
+    - touch(address):    the positions of the address have changed
+    - touch_token(token): the price of token has changed (touches the other borrowers exposed to token)
+    - touch_all():       all the debts have changed (touches all the other borrowers)
+    When many keys of a list change, the list is sorted again instead of updated in place.
+    """
+    def __init__(self, lp):
+        self.lp = lp
+        self.pairs = {}     # {(C, D): sorted list of (r, address)} of the single-exposure borrowers (C None without credits)
+        self.single = {}    # {address: ((C, D), r)}
+        self.others = []    # sorted list of (collateral, address) of the other borrowers
+        self.keys = {}      # {address: collateral} of the other borrowers
+        self.exposed = {}   # {token: {address: None}} of the other borrowers
+        self.dirty = set()  # addresses whose key must be recomputed
+        self.stale = set()  # other borrowers whose collateral must be recomputed
+        for address in lp.positions:
+            self.touch(address)
+
+    def touch(self, address):
+        self.dirty.add(address)
+
+    def touch_token(self, token):
+        self.stale.update(self.exposed.get(token, ()))
+
+    def touch_all(self):
+        self.stale.update(self.keys)
+
+    def __exposure(self, address):
+        # returns ((C, D), r) for a single-exposure borrower, None for the others, and () without debts
+        lp = self.lp
+        credits, debts = [], []
+        for token in lp.positions.get(address, ()):
+            if lp.minted.get(token, {}).get(address, 0) != 0:
+                credits.append(token)
+            if lp.debts.get(token, {}).get(address, 0) != 0:
+                debts.append(token)
+        if not debts:
+            return ()
+        if len(debts) > 1 or len(credits) > 1:
+            return None
+        debt = debts[0]
+        scaled = lp.debts[debt][address]
+        if not credits:
+            return (None, debt), lp.zero
+        return (credits[0], debt), lp.minted[credits[0]][address] / scaled
+
+    def __remove(self, address):
+        if address in self.single:
+            pair, r = self.single.pop(address)
+            entries = self.pairs[pair]
+            del entries[bisect.bisect_left(entries, (r, address))]
+            if not entries:
+                del self.pairs[pair]
+        elif address in self.keys:
+            del self.others[bisect.bisect_left(self.others, (self.keys.pop(address), address))]
+            for exposed in self.exposed.values():
+                exposed.pop(address, None)
+
+    def refresh(self):
+        """
+        Recomputes the keys of the touched addresses.
+        """
+        lp = self.lp
+        bulk = 8 * len(self.dirty) > len(self.single) + len(self.keys)
+        for address in self.dirty:
+            if bulk:
+                # the lists are sorted again below
+                self.single.pop(address, None)
+                if self.keys.pop(address, None) is not None:
+                    for exposed in self.exposed.values():
+                        exposed.pop(address, None)
+            else:
+                self.__remove(address)
+            self.stale.discard(address)
+            exposure = self.__exposure(address)
+            if exposure is None:
+                self.keys[address] = collateral = lp.collateral(address)
+                for token in lp.positions[address]:
+                    self.exposed.setdefault(token, {})[address] = None
+                if not bulk:
+                    bisect.insort(self.others, (collateral, address))
+            elif exposure != ():
+                self.single[address] = exposure
+                if not bulk:
+                    pair, r = exposure
+                    bisect.insort(self.pairs.setdefault(pair, []), (r, address))
+        if bulk:
+            self.pairs = {}
+            for address, (pair, r) in self.single.items():
+                self.pairs.setdefault(pair, []).append((r, address))
+            for entries in self.pairs.values():
+                entries.sort()
+        self.dirty.clear()
+
+        stale = [address for address in self.stale if address in self.keys]
+        self.stale.clear()
+        if stale:
+            if bulk or 8 * len(stale) > len(self.others):
+                for address in stale:
+                    self.keys[address] = lp.collateral(address)
+                bulk = True
+            else:
+                for address in stale:
+                    del self.others[bisect.bisect_left(self.others, (self.keys[address], address))]
+                    self.keys[address] = lp.collateral(address)
+                    bisect.insort(self.others, (self.keys[address], address))
+        if bulk:
+            self.others = sorted((collateral, address) for address, collateral in self.keys.items())
+
+    def factor(self, pair):
+        """
+        Returns F(C, D), the collateral of a single-exposure borrower of the pair per unit of r.
+        """
+        lp = self.lp
+        credit, debt = pair
+        if credit is None:
+            return lp.zero
+        return lp.XR(credit) * lp.get_price(credit) / (lp.borrow_index[debt] * lp.get_price(debt))
+
+    def below(self, tliq):
+        """
+        Returns the pairs (collateral, address) of the borrowers with collateral * tliq < 1, by increasing collateral.
+        """
+        self.refresh()
+        lp = self.lp
+        exact = lp.backend.exact
+        found = []
+        for pair, entries in self.pairs.items():
+            factor = self.factor(pair)
+            if factor == 0:
+                candidates = entries
+            else:
+                # the prefix of the entries below the liquidation boundary (widened for inexact backends,
+                # whose collaterals are then recomputed as health_factor does)
+                bound = 1 / (tliq * factor)
+                candidates = entries[:bisect.bisect_left(entries, (bound if exact else bound * 101 / 100,))]
+            for r, address in candidates:
+                collateral = r * factor if exact else lp.collateral(address)
+                if collateral * tliq < 1:
+                    found.append((collateral, address))
+        for collateral, address in self.others:
+            if collateral * tliq >= 1:
+                break
+            found.append((collateral, address))
+        found.sort()
+        return found
+
+    def smallest(self, k):
+        """
+        Returns the k pairs (collateral, address) with the smallest collateral.
+        """
+        self.refresh()
+        lp = self.lp
+        lists = [self.others]
+        for pair, entries in self.pairs.items():
+            lists.append(scaled(entries, self.factor(pair)))
+        found = [(lp.collateral(address), address) for _, address in itertools.islice(heapq.merge(*lists), k)]
+        found.sort()
+        return found
+
+def scaled(entries, factor):
+    # the pairs (r * factor, address) of the sorted entries (r, address)
+    for r, address in entries:
+        yield r * factor, address
@@ -1,7 +1,15 @@
+import functools
+import inspect
 import math # For math.inf
 from math import isclose
 from fractions import Fraction
 from string_utils import *
+from events import Observable, operation
+from numeric import make_backend
+from state import ABSENT, Versioned
+from trace_utils import add_replay_arguments, check_replay_arguments, replay
+from health_index import HealthIndex
+from compact import CompactMap, Interner
 
 # from hypothesis import note, assume, settings
 # from hypothesis.strategies import *
@@ -10,33 +18,82 @@ from hypothesis.stateful import rule, RuleBasedStateMachine
 import argparse
 import sys
 import logging
-logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 log = logging.getLogger(__name__)
 
-def revert(msg):
-    log.info(msg)
-    # raise ValueError(msg)
-    return
-
 from fractions import Fraction
 
-class LP(RuleBasedStateMachine):
+def accruing(tokens=(), addresses=()):
+    """
+    Decorates an operation of LP so that, in block mode (see LP.set_block), it first accrues
+    the interest of the tokens it touches: the tokens passed as the given parameters, and the
+    tokens of the positions of the addresses passed as the given parameters.
+    If the operation reverts, the accrual is undone (as a reverted transaction in solidity/LP.sol).
+    """
+    def decorate(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.block is None:
+                return method(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs).arguments
+            touched = [bound[name] for name in tokens]
+            for name in addresses:
+                touched += self.positions.get(bound[name], ())
+            snapshot = Versioned.snapshot(self)
+            self._accrue(touched)
+            result = method(self, *args, **kwargs)
+            if self.lastReverted:
+                self.restore(snapshot)
+            Versioned.release(self, snapshot)
+            return result
+
+        return wrapper
+    return decorate
+
+class LP(Versioned, Observable, RuleBasedStateMachine):
     """
     A Lending Pool module
     """
-    def __init__(self):
+    MAPS = ("reserves", "debts", "minted", "prices", "debts_tot", "borrow_index", "positions", "minted_tot", "accrued")
+    PARAMS = ("tliq", "rliq", "ir_alpha", "ir_beta", "block")
+
+    def __init__(self, debug=False, verbose=True, backend=None, compact=False):
         super(LP, self).__init__()
+
+        # The numeric backend (exact fractions by default): every input is converted by self.num
+        self.backend = make_backend() if backend is None else backend
+        self.num = self.backend.num
+        self.zero = self.backend.zero
+        self.one = self.backend.one
+        # In compact mode, the maps by address are CompactMaps over a shared interner of addresses
+        self.interner = Interner() if compact else None
+
         self.reserves = {}  # reserves map  {token: amount}
-        self.debts  = {}    # debts map     {token: {address: amount}}
+        self.debts  = {}    # scaled debts map {token: {address: principal}}
         self.minted = {}    # minted map    {token: {address: amount}}
         self.prices = {}    # prices map    {token: price}
+        self.debts_tot  = {}    # scaled debts totals {token: principal}
+        self.borrow_index = {}  # borrow index map {token: index}
+        self.positions  = self.new_map(objects=True)    # positions map {address: (token, ...)} (tokens with nonzero credit or debt)
+        self.token_sets = {}    # interned tuples of tokens of the positions
+        self.minted_tot = {}    # minted totals {token: amount}
+        self.block = None       # current block (None: interest accrues only by accrue_interest)
+        self.accrued = {}       # block of the last accrual of interest {token: block} (in block mode)
+        self.health_index = None    # borrowers sorted by health factor (built on the first query)
         self.lastReverted = False
-        self.tliq = Fraction(2, 3)  # tliq = liquidation threshold
-        self.rliq = Fraction(11,10) # rliq = liquidation reward factor
+        self.lastRevertReason = None
+
+        # In debug mode, the running totals are checked against the full sums
+        self.debug = debug
+        # If not verbose, no log message (nor the health factors they display) is computed
+        self.verbose = verbose
+        self.tliq = self.num(Fraction(2, 3))  # tliq = liquidation threshold
+        self.rliq = self.num(Fraction(11,10)) # rliq = liquidation reward factor
 
         # Interest rate parameters: IR(T) = alpha * U(T) + beta
-        self.ir_alpha = 0
-        self.ir_beta = Fraction(12, 100)  # Default interest rate of 12%
+        self.ir_alpha = self.zero
+        self.ir_beta = self.num(Fraction(12, 100))  # Default interest rate of 12%
 
     def pretty_print(self, precise=False):
         """
@@ -48,7 +105,7 @@ class LP(RuleBasedStateMachine):
         """
         state = {
             "Reserves": self.reserves,
-            "Debts": self.debts,
+            "Debts": {token: {address: self.get_debts(token, address) for address in self.debts[token]} for token in self.debts},
             "Minted": self.minted,
             "Prices": self.prices,
             "LastReverted": self.lastReverted
@@ -57,9 +114,9 @@ class LP(RuleBasedStateMachine):
 
     def get_price(self, token):
         if token not in self.prices:
-            return Fraction(1) # default price
+            return self.one # default price
         else:
-            return Fraction(self.prices[token])
+            return self.prices[token]
 
     def get_xr(self):
         xr = {tok: self.XR(tok) for tok in self.reserves}
@@ -81,79 +138,249 @@ class LP(RuleBasedStateMachine):
             return 0
         if address not in self.debts[token]:
             return 0
-        return self.debts[token][address]
+        # the actual debt is the scaled principal times the borrow index
+        return self.debts[token][address] * self.borrow_index[token]
     
     # supply of minted (credit) tokens
     def tok_supply(self, token):
         if token not in self.minted:
             return 0
-        else:
-            return sum(self.minted[token].values())
+        if self.debug:
+            self.check_totals(token)
+        return self.minted_tot[token]
 
     # supply of debt tokens
     def tok_debts(self, token):
-        return sum(self.debts[token].values())
+        if self.debug:
+            self.check_totals(token)
+        return self.debts_tot[token] * self.borrow_index[token]
+
+    def check_totals(self, token=None):
+        """
+        Checks that the running totals of minted and debt tokens agree with
+        the full sums over all addresses (of the given token, or of all tokens).
+        When checking all tokens, also checks the positions index.
+        """
+        tokens = self.reserves if token is None else [token]
+        for tok in tokens:
+            if tok in self.minted:
+                assert self.backend.isclose(self.minted_tot[tok], sum(self.minted[tok].values())), f"minted total of {tok} out of sync"
+            if tok in self.debts:
+                assert self.backend.isclose(self.debts_tot[tok], sum(self.debts[tok].values())), f"debts total of {tok} out of sync"
+        if token is None:
+            positions = {}
+            for balances in (self.minted, self.debts):
+                for tok in balances:
+                    for address, amount in balances[tok].items():
+                        if amount != 0:
+                            positions.setdefault(address, set()).add(tok)
+            assert positions == {address: set(toks) for address, toks in self.positions.items()}, "positions out of sync"
+
+    def __set_minted(self, token, address, amount):
+        """
+        Sets the minted tokens of an address, keeping the minted total in sync.
+        """
+        self._put("minted_tot", token, self.minted_tot[token] + amount - self.minted[token].get(address, 0))
+        self._put2("minted", token, address, amount)
+        self.__update_position(token, address)
+
+    def __set_debts(self, token, address, amount):
+        """
+        Sets the debts of an address, keeping the debts total in sync.
+        The debts are stored as principal scaled by the borrow index of token.
+        """
+        principal = amount / self.borrow_index[token]
+        self._put("debts_tot", token, self.debts_tot[token] + principal - self.debts[token].get(address, 0))
+        self._put2("debts", token, address, principal)
+        self.__update_position(token, address)
+
+    def __update_position(self, token, address):
+        """
+        Adds token to the positions of address if it has nonzero credit or debt in token,
+        and removes it otherwise.
+        The tuples of tokens are interned, so that addresses with the same positions share them.
+        """
+        if self.health_index is not None:
+            self.health_index.touch(address)
+        tokens = self.positions.get(address, ())
+        if self.minted.get(token, {}).get(address, 0) != 0 or self.debts.get(token, {}).get(address, 0) != 0:
+            if token not in tokens:
+                tokens += (token,)
+                self._put("positions", address, self.token_sets.setdefault(tokens, tokens))
+        elif token in tokens:
+            tokens = tuple(tok for tok in tokens if tok != token)
+            self._put("positions", address, self.token_sets.setdefault(tokens, tokens) if tokens else ABSENT)
+
+    def new_map(self, objects=False):
+        """
+        Returns an empty map by address: a dict, or a CompactMap in compact mode
+        (storing objects, or the values of the numeric backend).
+        """
+        if self.interner is None:
+            return {}
+        return CompactMap(self.interner, None if objects else self.backend)
 
     # exchange rate of minted (credit) token
     def XR(self, token):
         if self.tok_supply(token) == 0:
-            return Fraction(1)
+            return self.one
         else:
-            return Fraction(self.reserves[token] + self.tok_debts(token), self.tok_supply(token)) 
+            return (self.reserves[token] + self.tok_debts(token)) / self.tok_supply(token)
+
+    # net worth of minted (credit) and debt tokens of a given address,
+    # computed in a single pass over the tokens where the address has a position
+    def valuation(self, address):
+        val_minted = self.zero
+        val_debts = self.zero
+        for token in self.positions.get(address, ()):
+            price = self.get_price(token)
+            minted = self.get_minted(token, address)
+            if minted != 0:
+                val_minted += minted * self.XR(token) * price
+            val_debts += self.get_debts(token, address) * price
+        return val_minted, val_debts
 
     # net worth of minted (credit) tokens of a given address
     def val_minted(self, address):
-        val = Fraction(0)
-        for token in self.minted:
-            if address in self.minted[token]:
-                val += self.minted[token][address] * self.XR(token) * self.get_price(token)
-        return val
+        return self.valuation(address)[0]
 
     # net worth of debt tokens of a given address
     def val_debts(self, address):
-        val = Fraction(0)
-        for token in self.debts:
-            if address in self.debts[token]:
-                val += self.debts[token][address] * self.get_price(token)
-        return val
+        return self.valuation(address)[1]
 
     def collateral(self, address):
-        if self.val_debts(address) == 0:
+        val_minted, val_debts = self.valuation(address)
+        if val_debts == 0:
             return math.inf # No debts to collateralize (+inf)
-        return Fraction(self.val_minted(address), self.val_debts(address))
+        return val_minted / val_debts
 
     def health_factor(self, address):
-        if self.val_debts(address) == 0:
+        collateral = self.collateral(address)
+        if collateral == math.inf:
             return math.inf # No debts to collateralize (+inf)
-        return self.collateral(address) * self.tliq
+        return collateral * self.tliq
 
+    def undercollateralized(self):
+        """
+        Returns the addresses with health factor < 1, from the least healthy.
+        """
+        if self.health_index is None:
+            self.health_index = HealthIndex(self)
+        return [address for collateral, address in self.health_index.below(self.tliq)]
+
+    def least_healthy(self, k):
+        """
+        Returns the k borrowers with the smallest health factor, as pairs (address, health factor).
+        """
+        if self.health_index is None:
+            self.health_index = HealthIndex(self)
+        return [(address, collateral * self.tliq) for collateral, address in self.health_index.smallest(k)]
+
+    def restore(self, snapshot):
+        if self.health_index is not None:
+            # touches the addresses and tokens whose state is going to be undone
+            for entry in self.journal[snapshot.mark:]:
+                if entry[0] in ("minted", "debts"):
+                    self.health_index.touch(entry[2])
+                elif entry[0] == "prices":
+                    self.health_index.touch_token(entry[1])
+                elif entry[0] == "borrow_index":
+                    self.health_index.touch_all()
+        Versioned.restore(self, snapshot)
+
+    def fork(self):
+        child = Versioned.fork(self)
+        child.health_index = None
+        return child
+
+    def revert(self, reason):
+        """
+        Reverts the current operation, recording the reason.
+        """
+        if self.verbose:
+            log.warning(reason)
+        self.lastReverted = True
+        self.lastRevertReason = reason
+
+    @operation
     def set_liq_threshold(self, tliq):
-        log.info(f"set_liq_threshold({tliq})")
+        tliq = self.num(tliq)
+        if self.verbose:
+            log.info(f"set_liq_threshold({tliq})")
         if tliq < 0 or tliq > 1:
-            log.warning("Liquidation threshold must be between 0 and 1.")
-            self.lastReverted = True
+            self.revert("Liquidation threshold must be between 0 and 1.")
             return
-        self.tliq = tliq
+        self._set_param("tliq", tliq)
         self.lastReverted = False
 
+    @operation
     def set_liq_reward_factor(self, rliq):
-        log.info(f"set_liq_reward_factor({rliq})")
+        rliq = self.num(rliq)
+        if self.verbose:
+            log.info(f"set_liq_reward_factor({rliq})")
         if rliq < 1:
-            log.warning("Liquidation reward factor must be greater than 1.")
-            self.lastReverted = True
+            self.revert("Liquidation reward factor must be greater than 1.")
             return
-        self.rliq = rliq
+        self._set_param("rliq", rliq)
         self.lastReverted = False
 
+    @operation
     def set_interest_rate(self, alpha, beta):
-        log.info(f"set_interest_rate(alpha={alpha},beta={beta})")
+        alpha = self.num(alpha)
+        beta = self.num(beta)
+        if self.verbose:
+            log.info(f"set_interest_rate(alpha={alpha},beta={beta})")
         if alpha < 0 or beta < 0:
-            log.warning("Interest rate parameters must be greater than 0.")
-            self.lastReverted = True
+            self.revert("Interest rate parameters must be greater than 0.")
             return
-        self.ir_alpha = alpha
-        self.ir_beta = beta
+        self._set_param("ir_alpha", alpha)
+        self._set_param("ir_beta", beta)
+        self.lastReverted = False
+
+    @operation
+    def set_block(self, block):
+        """
+        Sets the current block, switching to block mode: interest is then accrued lazily, as in
+        solidity/LP.sol. Each deposit, borrow, repay, redeem and liquidate first accrues simple
+        interest on the tokens it touches (see accruing), for the blocks elapsed since their last
+        accrual, at the current interest rate: index += index * IR(token) * elapsed.
+        The idle tokens (and their borrowers) are not updated until they are touched.
+        The debts opened before block mode is switched on accrue interest from its first block.
 
+        Reverts:
+            If block is not an integer, or is lower than the current block.
+        """
+        if self.verbose:
+            log.info(f"set_block({block})")
+        if block != int(block) or (self.block is not None and block < self.block):
+            self.revert("The block must be an integer not lower than the current block.")
+            return
+        if self.block is None:
+            for token, total in self.debts_tot.items():
+                if total != 0:
+                    self._put("accrued", token, int(block))
+        self._set_param("block", int(block))
+        self.lastReverted = False
+
+    def _accrue(self, tokens):
+        """
+        Accrues the interest of the given tokens up to the current block (in block mode).
+        """
+        for token in dict.fromkeys(tokens):
+            last = self.accrued.get(token)
+            if last == self.block:
+                continue
+            if last is not None and token in self.debts and self.debts_tot[token] != 0:
+                rate = self.interest_rate(token)
+                index = self.borrow_index[token]
+                if self.verbose:
+                    log.info(f"accrue interest on {token} for {self.block - last} blocks at rate {rate}")
+                self._put("borrow_index", token, index + index * rate * (self.block - last))
+                if self.health_index is not None:
+                    self.health_index.touch_token(token)
+            self._put("accrued", token, self.block)
+
+    @operation
     def set_price(self, token, price):
         """
         Sets the price of a specific token.
@@ -172,116 +399,126 @@ class LP(RuleBasedStateMachine):
             self.set_price("BTC", 50000)
             # Sets the price of the 'BTC' token to 50000.
         """
-        log.info(f"set_price({token}, {price})")
+        price = self.num(price)
+        if self.verbose:
+            log.info(f"set_price({token}, {price})")
         if price <= 0:
-            log.warning("Price must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Price must be greater than zero.")
             return
-        self.prices[token] = price
+        self._put("prices", token, price)
+        if self.health_index is not None:
+            self.health_index.touch_token(token)
         self.lastReverted = False
 
+    @operation
+    @accruing(tokens=("token",))
     def deposit(self, address, amount, token):
-        log.info(f"{address}: deposit({amount}:{token})")
+        amount = self.num(amount)
+        if self.verbose:
+            log.info(f"{address}: deposit({amount}:{token})")
 
         if amount <= 0:
-            log.warning("Deposit amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Deposit amount must be greater than zero.")
             return
         
         # If the address is new, initialize its balance
         if token not in self.reserves:
-            self.reserves[token] = amount
+            self._put("reserves", token, amount)
 
-            self.debts[token] = {}
-            self.debts[token][address] = 0
+            self._put("debts", token, self.new_map())
+            self._put("debts_tot", token, self.zero)
+            self._put("borrow_index", token, self.one)
+            self.__set_debts(token, address, self.zero)
 
-            self.minted[token] = {}
-            self.minted[token][address] = Fraction(amount, self.XR(token))
+            self._put("minted", token, self.new_map())
+            self._put("minted_tot", token, self.zero)
+            self.__set_minted(token, address, amount / self.XR(token))
         else:
             xr = self.XR(token)
             
-            self.reserves[token] += amount
-            if address not in self.minted[token]:
-                self.minted[token][address] = Fraction(amount, xr)
-            else:
-                self.minted[token][address] += Fraction(amount, xr)
+            self._put("reserves", token, self.reserves[token] + amount)
+            self.__set_minted(token, address, self.get_minted(token, address) + amount / xr)
 
         self.lastReverted = False
 
+    @operation
+    @accruing(tokens=("token",), addresses=("address",))
     def borrow(self, address, amount, token):
-        log.info(f"{address}: borrow({amount}:{token})")
+        amount = self.num(amount)
+        if self.verbose:
+            log.info(f"{address}: borrow({amount}:{token})")
 
         if amount <= 0:
-            log.warning("Deposit amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Deposit amount must be greater than zero.")
             return
         elif token not in self.reserves:
-            log.warning("Token not found in reserves.")
-            self.lastReverted = True
+            self.revert("Token not found in reserves.")
             return
         elif amount > self.reserves[token]:
-            log.warning("Insufficient reserves to borrow.")
-            self.lastReverted = True
+            self.revert("Insufficient reserves to borrow.")
             return
         
         assert(token in self.reserves)
 
-        log.info(f"pre:  H({address}) = {float(self.health_factor(address))}")
+        if self.verbose:
+            log.info(f"pre:  H({address}) = {float(self.health_factor(address))}")
 
         # Removes amount units of token from the reserves
-        self.reserves[token] -= amount
+        self._put("reserves", token, self.reserves[token] - amount)
 
         if token not in self.debts:
-            self.debts[token] = {}
-        if address not in self.debts[token]:
-            self.debts[token][address] = amount
-        else:
-            self.debts[token][address] += amount
+            self._put("debts", token, self.new_map())
+            self._put("debts_tot", token, self.zero)
+            self._put("borrow_index", token, self.one)
+        self.__set_debts(token, address, self.get_debts(token, address) + amount)
 
-        log.info(f"post: H({address}) = {float(self.health_factor(address))}")
+        hf = self.health_factor(address)
+        if self.verbose:
+            log.info(f"post: H({address}) = {float(hf)}")
 
-        if self.health_factor(address) < 1:
-            log.warning(f"{address} is not collateralized")
+        if hf < 1:
             # reverts the transaction
-            self.reserves[token] += amount
-            self.debts[token][address] -= amount
-            self.lastReverted = True
-            return 
+            self._put("reserves", token, self.reserves[token] + amount)
+            self.__set_debts(token, address, self.get_debts(token, address) - amount)
+            self.revert(f"{address} is not collateralized")
+            return
         
         self.lastReverted = False
         return amount
 
+    @operation
+    @accruing(tokens=("token",))
     def repay(self, address, amount, token):
-        log.info(f"{address}: repay({amount}:{token})")
+        amount = self.num(amount)
+        if self.verbose:
+            log.info(f"{address}: repay({amount}:{token})")
 
         if amount <= 0:
-            log.warning("Repay amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Repay amount must be greater than zero.")
             return
         elif token not in self.debts:
-            log.warning("Token not found in reserves.")
-            self.lastReverted = True
+            self.revert("Token not found in reserves.")
             return
         elif address not in self.debts[token]:
-            log.warning("Address not found in debts.")
-            self.lastReverted = True
-            return 
-        elif amount > self.debts[token][address]:
-            log.warning("Insufficient debts to repay.")
-            self.lastReverted = True
-            return 
+            self.revert("Address not found in debts.")
+            return
+        elif amount > self.get_debts(token, address):
+            self.revert("Insufficient debts to repay.")
+            return
         
         assert(token in self.reserves)
         assert(token in self.debts)
         assert(address in self.debts[token])
 
-        log.info(f"pre:  H({address}) = {float(self.health_factor(address))}")
+        if self.verbose:
+            log.info(f"pre:  H({address}) = {float(self.health_factor(address))}")
 
-        self.reserves[token] += amount
-        self.debts[token][address] -= amount
+        self._put("reserves", token, self.reserves[token] + amount)
+        self.__set_debts(token, address, self.get_debts(token, address) - amount)
         self.lastReverted = False
 
-        log.info(f"post: H({address}) = {float(self.health_factor(address))}")
+        if self.verbose:
+            log.info(f"post: H({address}) = {float(self.health_factor(address))}")
 
     def utilization_ratio(self, token):
         """
@@ -289,135 +526,180 @@ class LP(RuleBasedStateMachine):
         If there are no debts in T, utilization is considered zero.
         """
         if token not in self.reserves or self.tok_debts(token) == 0:
-            return Fraction(0)
-        return Fraction(self.tok_debts(token), self.reserves[token] + self.tok_debts(token))
+            return self.zero
+        return self.tok_debts(token) / (self.reserves[token] + self.tok_debts(token))
         
     def interest_rate(self, token):
         return self.ir_alpha * self.utilization_ratio(token) + self.ir_beta
     
-    def accrue_interest(self):
+    @operation
+    def accrue_interest(self, periods=1):
+        """
+        Accrues interest on all debts for the given number of periods, by updating the borrow index of each token.
+
+        The result is the same as that of periods single accruals. The reserves and the scaled debts
+        do not change between the periods, so the index of each token follows a scalar recurrence:
+        with an exact backend and a constant rate (alpha = 0, or no debts), it is compounded in closed
+        form, and otherwise the recurrence is iterated (in both cases, without touching the borrowers).
+
+        Reverts:
+            If periods is not a positive integer.
+        """
+        if periods != int(periods) or periods < 1:
+            self.revert("The number of periods must be a positive integer.")
+            return
+        periods = int(periods)
         for token in self.debts:
-            log.info(f"accrue_interest on {token}: {self.ir_alpha} * {self.utilization_ratio(token)} + {self.ir_beta} = {self.interest_rate(token)}")
-            for address in self.debts[token]:
-                self.debts[token][address] += self.debts[token][address] * self.interest_rate(token)
+            if periods == 1:
+                rate = self.interest_rate(token)
+                if self.verbose:
+                    log.info(f"accrue_interest on {token}: {self.ir_alpha} * {self.utilization_ratio(token)} + {self.ir_beta} = {rate}")
+                self._put("borrow_index", token, self.borrow_index[token] + self.borrow_index[token] * rate)
+                continue
+            index = self.__compound(token, periods)
+            if self.verbose:
+                log.info(f"accrue_interest on {token} for {periods} periods: borrow index {self.borrow_index[token]} -> {index}")
+            self._put("borrow_index", token, index)
+        if self.health_index is not None:
+            self.health_index.touch_all()
 
         self.lastReverted = False
 
+    def __compound(self, token, periods):
+        """
+        Returns the borrow index of token after the given number of accruals
+        (the same operations as interest_rate and accrue_interest, on local values).
+        """
+        if self.debug:
+            self.check_totals(token)
+        index = self.borrow_index[token]
+        scaled = self.debts_tot[token]
+        alpha, beta = self.ir_alpha, self.ir_beta
+        if token not in self.reserves or scaled == 0:
+            alpha = self.zero   # utilization is zero in all periods
+        if alpha == 0 and self.backend.exact:
+            return index * (self.one + beta) ** periods
+        reserves = self.reserves.get(token)
+        for _ in range(periods):
+            debts = scaled * index
+            utilization = self.zero if alpha == 0 or debts == 0 else debts / (reserves + debts)
+            index = index + index * (alpha * utilization + beta)
+        return index
+
+    @operation
+    @accruing(tokens=("token",), addresses=("address",))
     def redeem(self, address, amount, token):
-        log.info(f"{address}: redeem({amount}:{token})")
+        amount = self.num(amount)
+        if self.verbose:
+            log.info(f"{address}: redeem({amount}:{token})")
 
         amount_rdm = amount * self.XR(token)
-        log.info(f"XR({token}) = {self.XR(token)}")
+        if self.verbose:
+            log.info(f"XR({token}) = {self.XR(token)}")
         # log.info(f"{address}: redeem({amount}:{token} minted)")
         # log.info(f"redeeming {amount_rdm}:{token}")
 
         if amount <= 0:
-            log.warning("Redeem amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Redeem amount must be greater than zero.")
             return
         elif token not in self.reserves:
-            log.warning("Token not found in reserves.")
-            self.lastReverted = True
+            self.revert("Token not found in reserves.")
             return
         elif address not in self.minted[token]:
-            log.warning("Address not found in minted.")
-            self.lastReverted = True
+            self.revert("Address not found in minted.")
             return
         elif amount > self.minted[token][address]:
-            log.warning("Insufficient minted tokens to redeem.")
-            self.lastReverted = True
+            self.revert("Insufficient minted tokens to redeem.")
             return
         elif amount_rdm > self.reserves[token]:
-            log.warning("Insufficient reserves to redeem.")
-            self.lastReverted = True
+            self.revert("Insufficient reserves to redeem.")
             return
         
         assert(token in self.reserves)
         assert(token in self.minted)
         assert(address in self.minted[token])
 
-        log.info(f"pre:  H({address}) = {float(self.health_factor(address))}")
+        if self.verbose:
+            log.info(f"pre:  H({address}) = {float(self.health_factor(address))}")
 
-        self.reserves[token] -= amount_rdm
-        self.minted[token][address] -= amount
+        self._put("reserves", token, self.reserves[token] - amount_rdm)
+        self.__set_minted(token, address, self.minted[token][address] - amount)
 
-        log.info(f"post: H({address}) = {float(self.health_factor(address))}")
+        hf = self.health_factor(address)
+        if self.verbose:
+            log.info(f"post: H({address}) = {float(hf)}")
 
-        if self.health_factor(address) < 1:
-            log.warning(f"Address {address} is under-collateralized (collateral = {self.collateral(address)}).")
+        if hf < 1:
+            reason = f"Address {address} is under-collateralized (collateral = {self.collateral(address)})."
             # reverts the transaction
-            self.reserves[token] += amount_rdm
-            self.minted[token][address] += amount
-            self.lastReverted = True
+            self._put("reserves", token, self.reserves[token] + amount_rdm)
+            self.__set_minted(token, address, self.minted[token][address] + amount)
+            self.revert(reason)
             return
 
-        log.info(f"XR({token}) = {self.XR(token)}")
+        if self.verbose:
+            log.info(f"XR({token}) = {self.XR(token)}")
 
         self.lastReverted = False
         return amount_rdm
 
+    @operation
+    @accruing(tokens=("token_debt", "token_minted"), addresses=("address_debtor",))
     def liquidate(self, address, amount, token_debt, address_debtor, token_minted):
-        log.info(f"{address}: liquidate({amount}:{token_debt}, {address_debtor}, {token_minted})")
+        amount = self.num(amount)
+        if self.verbose:
+            log.info(f"{address}: liquidate({amount}:{token_debt}, {address_debtor}, {token_minted})")
 
-        amount_minted = Fraction(amount,self.XR(token_minted)) * Fraction(self.get_price(token_debt), self.get_price(token_minted)) * Fraction(self.rliq)
+        amount_minted = amount / self.XR(token_minted) * (self.get_price(token_debt) / self.get_price(token_minted)) * self.rliq
 
         if amount <= 0:
-            log.warning("Liquidate amount must be greater than zero.")
-            self.lastReverted = True
+            self.revert("Liquidate amount must be greater than zero.")
             return
         elif token_debt not in self.debts:
-            log.warning(f"Token {token_debt} not found in debts.")
-            self.lastReverted = True
+            self.revert(f"Token {token_debt} not found in debts.")
             return
         elif address_debtor not in self.debts[token_debt]:
-            log.warning(f"Address {address_debtor} not found in debts.")
-            self.lastReverted = True
+            self.revert(f"Address {address_debtor} not found in debts.")
+            return
+        elif amount > self.get_debts(token_debt, address_debtor):
+            self.revert("Insufficient debts to repay.")
             return
-        elif amount > self.debts[token_debt][address_debtor]:
-            log.warning("Insufficient debts to repay.")
-            self.lastReverted = True
-            return 
         elif token_minted not in self.minted:
-            log.warning(f"Token {token_minted} not found in minted.")
-            self.lastReverted = True
+            self.revert(f"Token {token_minted} not found in minted.")
             return
         elif address_debtor not in self.minted[token_minted]:
-            log.warning(f"Address {address_debtor} not found in minted.")
-            self.lastReverted = True
+            self.revert(f"Address {address_debtor} not found in minted.")
             return
         elif amount_minted > self.minted[token_minted][address_debtor]:
-            log.warning("Insufficient minted tokens to redeem.")
-            self.lastReverted = True
+            self.revert("Insufficient minted tokens to redeem.")
             return
-        elif self.health_factor(address_debtor) >= 1:
-            log.warning("Address {address_debtor} is collateralized.")
-            self.lastReverted = True
+
+        hf = self.health_factor(address_debtor)
+        if hf >= 1:
+            self.revert("Address {address_debtor} is collateralized.")
             return
         
-        log.info(f"pre:  H({address_debtor}) = {float(self.health_factor(address_debtor))}")
-
-        self.reserves[token_debt] += amount
-        self.debts[token_debt][address_debtor] -= amount
-
-        if address not in self.minted[token_minted]:
-            self.minted[token_minted][address] = amount_minted
-        else:
-            self.minted[token_minted][address] += amount_minted
+        if self.verbose:
+            log.info(f"pre:  H({address_debtor}) = {float(hf)}")
 
-        self.minted[token_minted][address_debtor] -= amount_minted
+        self._put("reserves", token_debt, self.reserves[token_debt] + amount)
+        self.__set_debts(token_debt, address_debtor, self.get_debts(token_debt, address_debtor) - amount)
 
-        log.info(f"post: H({address_debtor}) = {float(self.health_factor(address_debtor))}")
+        self.__set_minted(token_minted, address, self.get_minted(token_minted, address) + amount_minted)
+        self.__set_minted(token_minted, address_debtor, self.minted[token_minted][address_debtor] - amount_minted)
 
-        if self.health_factor(address_debtor) > 1:
-            log.warning(f"Address {address_debtor} has health factor > 1")
+        hf = self.health_factor(address_debtor)
+        if self.verbose:
+            log.info(f"post: H({address_debtor}) = {float(hf)}")
 
+        if hf > 1:
             # reverts the transaction
-            self.reserves[token_debt] -= amount
-            self.debts[token_debt][address_debtor] += amount
-            self.minted[token_minted][address] -= amount_minted
-            self.minted[token_minted][address_debtor] += amount_minted
+            self._put("reserves", token_debt, self.reserves[token_debt] - amount)
+            self.__set_debts(token_debt, address_debtor, self.get_debts(token_debt, address_debtor) + amount)
+            self.__set_minted(token_minted, address, self.minted[token_minted][address] - amount_minted)
+            self.__set_minted(token_minted, address_debtor, self.minted[token_minted][address_debtor] + amount_minted)
 
-            self.lastReverted = True
+            self.revert(f"Address {address_debtor} has health factor > 1")
             return
         
         self.lastReverted = False
@@ -435,96 +717,16 @@ def main():
     Main function to process a file with transaction commands.
     """
     parser = argparse.ArgumentParser(description="Simulate a Lending Pool from a transaction trace file.")
-    parser.add_argument("filename", help="The input file containing transaction trace.")
-    parser.add_argument("-p", "--precise", action="store_true",  help="Use precise fraction representation in output.")
-    
+    add_replay_arguments(parser)
+
     args = parser.parse_args()
-    is_precise = args.precise
-
-    try:
-        with open(args.filename, "r") as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        print(f"Error: File '{args.filename}' not found.")
-        sys.exit(1)
-    
-    # Create an instance of LP
-    lp = LP()
+    check_replay_arguments(parser, args)
 
-    # Process each line
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        try:
-            if line.startswith('#'):
-                # Skip comment lines
-                continue
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-            # Example input format: A:deposit(1:T)
-            elif ':' in line:
-                address, rest = line.split(':', 1)
-                if '(' in rest:
-                    method, args = rest.split('(', 1)
-                    args = args.strip(')')
-
-                    # Parse arguments
-                    parsed_args = []
-                    for arg in args.split(','):
-                        if ':' in arg:  # For example, "1:T"
-                            amount, token = arg.split(':')
-                            parsed_args.extend([Fraction(amount), token])
-                        else:
-                            parsed_args.append(arg.strip())
-
-                    # Call the method dynamically
-                    if hasattr(lp, method):
-                        getattr(lp, method)(address, *parsed_args)
-                        lp.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in LP class.")
-                else:
-                    method = rest
-                    if hasattr(lp, method):
-                        getattr(lp, method)()
-                        lp.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in LP class.")
-            else:
-                # Non-address-prefixed command, e.g., accrue_interest, set_price(T,2)
-                if '(' in line:
-                    method, args = line.split('(', 1)
-                    args = args.strip(')')
-                    parsed_args = []
-                    for arg in args.split(','):
-                        if arg.replace('.','',1).isdigit(): # arg is a number
-                            parsed_args.append(Fraction(arg))
-                        else:
-                            arg = arg.strip()
-                            try:
-                                # Try to parse as a Fraction (handles both '2/3' and '3.5')
-                                parsed_args.append(Fraction(arg))
-                            except ValueError:
-                            # Fallback to string or other types if not a valid Fraction
-                                parsed_args.append(arg)
-                    if hasattr(lp, method):
-                        getattr(lp, method)(*parsed_args)
-                        lp.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in LP class.")
-
-                else:
-                    # No arguments, e.g., accrue_interest
-                    method = line
-                    if hasattr(lp, method):
-                        getattr(lp, method)()
-                        lp.pretty_print(precise=is_precise)
-                    else:
-                        log.error(f"Error: Method '{method}' not found in LP class.")
-
-        except Exception as e:
-            log.error(f"Error processing line '{line}': {e}")
+    # Create an instance of LP
+    lp = LP(verbose=not args.quiet, backend=make_backend(args.backend, args.scale), compact=args.compact)
+    replay(lp, args)
 
 # Run the main function if the script is executed directly
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+import math
+from fractions import Fraction
+
+"""
+Numeric backends for the LP and Blockchain models.
+
+A backend fixes the representation of all the amounts, prices and rates:
+- FractionBackend: exact rationals (fractions.Fraction), the default
+- FloatBackend:    native floats, for Monte Carlo throughput
+- FixedBackend:    integers scaled by a fixed factor (1e6 by default), with
+                   truncating multiplication and division as in solidity/LP.sol
+
+The models convert every input through backend.num(x), and then use the
+ordinary arithmetic operators. For the compact storage (see compact.py), a
+backend stores its values in typed arrays (of the given typecode), each value
+taking width items: encode(x) returns the items and decode(*items) the value.
+"""
+
+class FractionBackend:
+    name = "fraction"
+    exact = True    # arithmetic is exact (no rounding)
+
+    def __init__(self):
+        self.zero = Fraction(0)
+        self.one = Fraction(1)
+
+    def num(self, x):
+        if type(x) is Fraction:
+            return x
+        return Fraction(x)
+
+    def isclose(self, a, b):
+        return a == b
+
+    typecode = "q"  # numerator and denominator (values beyond 64 bits fall back to objects)
+    width = 2
+
+    def encode(self, x):
+        x = self.num(x)
+        return x.numerator, x.denominator
+
+    def decode(self, numerator, denominator):
+        return Fraction(numerator, denominator)
+
+class FloatBackend:
+    name = "float"
+    exact = False
+
+    def __init__(self):
+        self.zero = 0.0
+        self.one = 1.0
+
+    def num(self, x):
+        if isinstance(x, str):
+            x = Fraction(x)
+        return float(x)
+
+    def isclose(self, a, b):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+
+    typecode = "d"
+    width = 1
+
+    def encode(self, x):
+        return (float(x),)
+
+    def decode(self, v):
+        return v
+
+class Fixed:
+    """
+    A fixed-point number, represented by the integer value * SCALE.
+    Multiplications and divisions truncate the result to the scale.
+    """
+    __slots__ = ("v",)
+    SCALE = 10**6
+
+    def __init__(self, v):
+        self.v = v  # the scaled integer
+
+    @classmethod
+    def of(cls, x):
+        if isinstance(x, cls):
+            return x
+        if isinstance(x, int):
+            return cls(x * cls.SCALE)
+        if isinstance(x, Fixed):
+            x = Fraction(x.v, x.SCALE)
+        elif isinstance(x, str):
+            x = Fraction(x)
+        return cls(int(Fraction(x) * cls.SCALE))
+
+    def __add__(self, other):
+        return type(self)(self.v + self.of(other).v)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return type(self)(self.v - self.of(other).v)
+
+    def __rsub__(self, other):
+        return type(self)(self.of(other).v - self.v)
+
+    def __mul__(self, other):
+        return type(self)(self.v * self.of(other).v // self.SCALE)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return type(self)(self.v * self.SCALE // self.of(other).v)
+
+    def __rtruediv__(self, other):
+        return type(self)(self.of(other).v * self.SCALE // self.v)
+
+    def __pow__(self, n):
+        if not isinstance(n, int) or n < 0:
+            return NotImplemented
+        result = self.of(1)
+        for _ in range(n):
+            result = result * self
+        return result
+
+    def __neg__(self):
+        return type(self)(-self.v)
+
+    def __abs__(self):
+        return type(self)(abs(self.v))
+
+    def __bool__(self):
+        return self.v != 0
+
+    def __float__(self):
+        return self.v / self.SCALE
+
+    def __int__(self):
+        return int(Fraction(self.v, self.SCALE))
+
+    def _cmp_key(self, other):
+        # returns a pair of comparable values for self and other
+        if isinstance(other, type(self)):
+            return self.v, other.v
+        if isinstance(other, int):
+            return self.v, other * self.SCALE
+        if isinstance(other, float) and not math.isfinite(other):
+            return float(self), other
+        return Fraction(self.v, self.SCALE), Fraction(other)
+
+    def __eq__(self, other):
+        try:
+            a, b = self._cmp_key(other)
+        except (TypeError, ValueError):
+            return NotImplemented
+        return a == b
+
+    def __lt__(self, other):
+        a, b = self._cmp_key(other)
+        return a < b
+
+    def __le__(self, other):
+        a, b = self._cmp_key(other)
+        return a <= b
+
+    def __gt__(self, other):
+        a, b = self._cmp_key(other)
+        return a > b
+
+    def __ge__(self, other):
+        a, b = self._cmp_key(other)
+        return a >= b
+
+    def __hash__(self):
+        return hash(Fraction(self.v, self.SCALE))
+
+    def __str__(self):
+        sign = "-" if self.v < 0 else ""
+        int_part, frac_part = divmod(abs(self.v), self.SCALE)
+        if frac_part == 0:
+            return f"{sign}{int_part}"
+        digits = len(str(self.SCALE)) - 1
+        if self.SCALE == 10**digits:
+            return f"{sign}{int_part}." + f"{frac_part:0{digits}d}".rstrip("0")
+        return str(float(self))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self})"
+
+    def __reduce__(self):
+        return make_fixed, (self.SCALE, self.v)
+
+FIXED_TYPES = {}    # {scale: subclass of Fixed}
+
+def fixed_type(scale):
+    """
+    Returns the subclass of Fixed with the given scale (the same class for each scale).
+    """
+    if scale not in FIXED_TYPES:
+        FIXED_TYPES[scale] = type("Fixed", (Fixed,), {"__slots__": (), "SCALE": scale})
+    return FIXED_TYPES[scale]
+
+def make_fixed(scale, v):
+    return fixed_type(scale)(v)
+
+class FixedBackend:
+    name = "fixed"
+    exact = False
+
+    def __init__(self, scale=10**6):
+        if scale < 1:
+            raise ValueError("The scale must be a positive integer.")
+        self.scale = scale
+        self.Fixed = fixed_type(scale)
+        self.zero = self.Fixed(0)
+        self.one = self.Fixed(scale)
+
+    def num(self, x):
+        return self.Fixed.of(x)
+
+    def isclose(self, a, b):
+        return a == b
+
+    typecode = "q"  # the scaled integers (values beyond 64 bits fall back to objects)
+    width = 1
+
+    def encode(self, x):
+        return (self.Fixed.of(x).v,)
+
+    def decode(self, v):
+        return self.Fixed(v)
+
+BACKENDS = {
+    "fraction": FractionBackend,
+    "float": FloatBackend,
+    "fixed": FixedBackend,
+}
+
+def make_backend(name="fraction", scale=10**6):
+    """
+    Returns the numeric backend with the given name (the scale is used by the fixed-point backend).
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown numeric backend '{name}' (expected one of {', '.join(BACKENDS)}).")
+    if name == "fixed":
+        return FixedBackend(scale)
+    return BACKENDS[name]()
@@ -12,7 +12,7 @@ import math
 
 class WrappedLP(LP):
     def __init__(self):
-        super().__init__()
+        super().__init__(debug=True)
         # super(LP, self).__init__()
 
     """
@@ -138,6 +138,15 @@ class WrappedLP(LP):
         for token in xr_pre:
             assert xr_pre[token] < xr_post[token]
 
+    @invariant()
+    def test_totals(self):
+        super().check_totals()
+
+    @invariant()
+    def test_health_index(self):
+        hfs = sorted((self.health_factor(address), address) for address in self.positions)
+        assert self.undercollateralized() == [address for hf, address in hfs if hf < 1]
+
     @invariant()
     def test_XR_geq_1(self):	
         xr = super().get_xr()
@@ -0,0 +1,188 @@
+import functools
+import logging
+import math
+import sys
+import time
+
+"""
+Opt-in profiling of the operations of LP and Blockchain.
+
+A Profiler attached to a model counts the calls of each operation (methods
+decorated with events.operation) and of each revert reason, keeps the
+cumulative wall time and a histogram of the latencies of each operation, and
+counts and times the calls of the internal helpers (XR, tok_supply, ...).
+The times are inclusive: an operation of a Blockchain includes the operation
+of its LP, and an operation includes its helpers. The records logged by the
+model are counted too (they are only produced when it is verbose).
+
+Attaching a profiler changes the class of the model to a subclass whose
+operations and helpers are timed (cached per class), and detaching restores
+it: the models without a profiler run the plain methods, at no cost. The
+methods of traces compiled for the class of the model before attaching it
+(see trace_utils.py) are not profiled. The forks of a profiled model share
+its profiler.
+"""
+
+HELPERS = {
+    "LP": ("XR", "tok_supply", "tok_debts", "valuation", "val_minted", "val_debts", "health_factor",
+           "utilization_ratio", "interest_rate", "undercollateralized"),
+    "Blockchain": ("net_worth", "net_worths", "health_factor"),
+}
+BUCKETS = 8     # histogram buckets per octave of latency (percentiles within ~5%)
+
+class Timing:
+    """
+    Number of calls, total time and histogram of the latencies (in ns) of a method.
+    """
+    __slots__ = ("calls", "total", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0
+        self.buckets = {}   # {bucket: count}, bucket = floor(BUCKETS * log2(latency))
+
+    def add(self, ns):
+        self.calls += 1
+        self.total += ns
+        b = int(BUCKETS * math.log2(ns)) if ns > 0 else 0
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def percentile(self, p):
+        """
+        Returns the approximate p-quantile of the latencies, in ns.
+        """
+        rank = p * self.calls
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return 2 ** ((b + 0.5) / BUCKETS)
+        return 0
+
+class LogCounter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.records = 0
+
+    def filter(self, record):
+        self.records += 1
+        return True
+
+def timed_operation(fn, key):
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.profiler
+        start = time.perf_counter_ns()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            profiler.operations[key].add(time.perf_counter_ns() - start)
+            if self.lastReverted:
+                reasons = profiler.reverts.setdefault(key, {})
+                reasons[self.lastRevertReason] = reasons.get(self.lastRevertReason, 0) + 1
+    return wrapper
+
+def timed_helper(fn, key):
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            self.profiler.helpers[key].add(time.perf_counter_ns() - start)
+    return wrapper
+
+PROFILED = {}   # {class: profiled subclass}
+
+def profiled_class(cls):
+    """
+    Returns the subclass of cls whose operations and helpers are timed.
+    """
+    if cls not in PROFILED:
+        namespace = {"__module__": cls.__module__, "__qualname__": cls.__qualname__, "profiled": cls}
+        for name in dir(cls):
+            fn = getattr(cls, name)
+            if getattr(fn, "is_operation", False):
+                namespace[name] = timed_operation(fn, f"{cls.__name__}.{name}")
+            elif name in HELPERS.get(cls.__name__, ()):
+                namespace[name] = timed_helper(fn, f"{cls.__name__}.{name}")
+        PROFILED[cls] = type(cls.__name__, (cls,), namespace)
+    return PROFILED[cls]
+
+class Profiler:
+    """
+    Collects the profile of the models it is attached to.
+    """
+    def __init__(self):
+        self.operations = {}    # {"Class.operation": Timing}
+        self.helpers = {}       # {"Class.helper": Timing}
+        self.reverts = {}       # {"Class.operation": {reason: count}}
+        self.logged = {}        # {logger name: LogCounter}
+
+    def attach(self, model):
+        """
+        Profiles model (and its LP, for a Blockchain).
+        """
+        for part in (model, getattr(model, "lp", None)):
+            if part is None or getattr(part, "profiler", None) is not None:
+                continue
+            cls = profiled_class(type(part))
+            for key in HELPERS.get(cls.__name__, ()):
+                self.helpers.setdefault(f"{cls.__name__}.{key}", Timing())
+            for name in dir(cls):
+                if getattr(getattr(cls, name), "is_operation", False):
+                    self.operations.setdefault(f"{cls.__name__}.{name}", Timing())
+            log = getattr(sys.modules[cls.__module__], "log", None)
+            if log is not None and log.name not in self.logged:
+                self.logged[log.name] = LogCounter()
+                log.addFilter(self.logged[log.name])
+            part.profiler = self
+            part.__class__ = cls
+        return model
+
+    def detach(self, model):
+        """
+        Stops profiling model (and its LP).
+        """
+        for part in (model, getattr(model, "lp", None)):
+            if part is not None and getattr(part, "profiler", None) is self:
+                part.__class__ = part.profiled
+                del part.profiler
+        for name, counter in self.logged.items():
+            logging.getLogger(name).removeFilter(counter)
+
+    def report(self):
+        """
+        Returns the profile as a dict: the operations called (with calls, reverts, total_ms,
+        mean_us, p50_us, p99_us), the helpers called (with calls, total_ms), the revert
+        reasons of each operation, and the numbers of logged records.
+        """
+        def stats(timing):
+            return {"calls": timing.calls, "total_ms": timing.total / 1e6, "mean_us": timing.total / timing.calls / 1e3}
+        return {
+            "operations": {key: dict(stats(t), reverts=sum(self.reverts.get(key, {}).values()),
+                                     p50_us=t.percentile(0.5) / 1e3, p99_us=t.percentile(0.99) / 1e3)
+                           for key, t in self.operations.items() if t.calls},
+            "helpers": {key: stats(t) for key, t in self.helpers.items() if t.calls},
+            "reverts": {key: dict(reasons) for key, reasons in self.reverts.items()},
+            "logged": {name: counter.records for name, counter in self.logged.items()},
+        }
+
+    def print_report(self, out=sys.stderr):
+        """
+        Prints the profile as tables, from the most expensive operations and helpers.
+        """
+        report = self.report()
+        by_time = lambda items: sorted(items.items(), key=lambda item: -item[1]["total_ms"])
+        print(f"{'operation':<32} {'calls':>8} {'reverts':>8} {'total (ms)':>11} {'mean (us)':>10} {'p50 (us)':>9} {'p99 (us)':>9}", file=out)
+        for key, s in by_time(report["operations"]):
+            print(f"{key:<32} {s['calls']:>8} {s['reverts']:>8} {s['total_ms']:>11.1f} {s['mean_us']:>10.1f} {s['p50_us']:>9.1f} {s['p99_us']:>9.1f}", file=out)
+        print(f"\n{'helper':<32} {'calls':>8} {'total (ms)':>11} {'mean (us)':>10}", file=out)
+        for key, s in by_time(report["helpers"]):
+            print(f"{key:<32} {s['calls']:>8} {s['total_ms']:>11.1f} {s['mean_us']:>10.1f}", file=out)
+        if report["reverts"]:
+            print(f"\n{'revert reason':<64} {'count':>8}", file=out)
+            for key, reasons in report["reverts"].items():
+                for reason, count in sorted(reasons.items(), key=lambda item: -item[1]):
+                    print(f"{key + ': ' + str(reason):<64} {count:>8}", file=out)
+        print("\nlogged records: " + ", ".join(f"{name} {n}" for name, n in report["logged"].items()), file=out)
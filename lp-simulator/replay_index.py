@@ -0,0 +1,129 @@
+from trace_utils import compile_trace, parse_trace, run_trace
+
+"""
+Time-travel queries over the replay of a trace.
+
+A ReplayIndex replays a compiled trace once, keeping a fork of the model
+(sharing its maps copy-on-write, see state.py) every stride steps. The state
+after k steps is then rebuilt by forking the nearest checkpoint and replaying
+at most stride - 1 steps, instead of re-running the trace from the start.
+
+Step k is the state after the first k executed steps of the trace (k = 0 is
+the initial state); invalid lines of the trace are not steps.
+"""
+
+class ReplayIndex:
+    def __init__(self, steps, model, stride=64):
+        """
+        Replays the Steps on model (which is left in the final state), keeping a checkpoint every stride steps.
+        """
+        if stride < 1:
+            raise ValueError("The stride must be a positive integer.")
+        self.steps = [step for step in steps if step.error is None]
+        self.stride = stride
+        self.checkpoints = []   # forks of the model at steps 0, stride, 2 * stride, ...
+        for i in range(0, len(self.steps), stride):
+            self.checkpoints.append(model.fork())
+            run_trace(self.steps[i:i+stride], model)
+        if len(self.steps) % stride == 0:
+            self.checkpoints.append(model.fork())
+
+    @classmethod
+    def from_file(cls, filename, model, stride=64):
+        """
+        Builds the index of the replay of a trace file on model.
+        """
+        return cls(compile_trace(parse_trace(filename), type(model)), model, stride)
+
+    def __len__(self):
+        """
+        Returns the number of steps (the last state is state_at(len(index))).
+        """
+        return len(self.steps)
+
+    def line_of(self, k):
+        """
+        Returns the line of the trace of the k-th step (k >= 1).
+        """
+        return self.steps[k-1].lineno
+
+    def __check(self, k):
+        if not 0 <= k <= len(self.steps):
+            raise IndexError(f"Step {k} out of range [0, {len(self.steps)}].")
+
+    def state_at(self, k):
+        """
+        Returns an independent copy of the model after k steps.
+        """
+        self.__check(k)
+        c = k // self.stride
+        model = self.checkpoints[c].fork()
+        run_trace(self.steps[c*self.stride:k], model)
+        return model
+
+    def states(self, ks):
+        """
+        Yields the pairs (k, state after k steps) for the increasing steps ks, replaying each gap once.
+        The yielded model is reused (it moves forward): copy it with fork() to keep it.
+        """
+        model, at = None, None
+        for k in ks:
+            self.__check(k)
+            if model is None or k < at or k % self.stride < k - at:
+                model, at = self.state_at(k), k
+            else:
+                run_trace(self.steps[at:k], model)
+                at = k
+            yield k, model
+
+    def metric_series(self, metric, addresses, steps=None):
+        """
+        Returns {address: [metric at each step]}, where metric is the name of a method of the
+        model taking an address or a token (e.g. "health_factor", "net_worth"), or a function (model, address).
+        By default, the metric is computed at all the steps.
+        """
+        if steps is None:
+            steps = range(len(self.steps) + 1)
+        if isinstance(metric, str):
+            name = metric
+            metric = lambda model, address: getattr(model, name)(address)
+        series = {address: [] for address in addresses}
+        for _, model in self.states(steps):
+            for address in addresses:
+                series[address].append(metric(model, address))
+        return series
+
+    def first_step_where(self, predicate, start=0, monotone=False):
+        """
+        Returns the first step k >= start whose state satisfies predicate(model), or None.
+        If the predicate is monotone (once true, it remains true), the step is found
+        by binary search: first over the checkpoints, then within the gap.
+        The predicate is evaluated on copies, so it may modify the model.
+        """
+        self.__check(start)
+        n = len(self.steps)
+        if not monotone:
+            for k, model in self.states(range(start, n + 1)):
+                if predicate(model):
+                    return k
+            return None
+
+        if not predicate(self.state_at(n)):
+            return None
+        # binary search for the first checkpoint after start satisfying the predicate (or the end)
+        lo, hi = start // self.stride + 1, len(self.checkpoints)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if predicate(self.checkpoints[mid].fork()):
+                hi = mid
+            else:
+                lo = mid + 1
+        # then for the first step since the previous checkpoint
+        lo, hi = max(start, (hi - 1) * self.stride), min(hi * self.stride, n)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if predicate(self.state_at(mid)):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
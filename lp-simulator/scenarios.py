@@ -0,0 +1,82 @@
+from collections import namedtuple
+
+import numpy as np
+
+"""
+Vectorized price-shock scenarios over the positions of an LP (requires NumPy).
+
+The positions are exported once into dense matrices (addresses x tokens); the
+health factors of all the addresses under a batch of price vectors are then
+computed with two matrix products, instead of one LP valuation per address
+and scenario. The computation uses floats, whatever the backend of the LP.
+
+A shortfall follows the Compound convention: the value of the debts of an
+address exceeding its collateral value weighted by tliq.
+"""
+
+"""
+Result of a batch of price scenarios:
+- liquidatable: number of addresses with health factor < 1, for each scenario
+- shortfall:    sum over the addresses of max(0, val_debts - tliq * val_minted), for each scenario
+"""
+ScenarioResult = namedtuple("ScenarioResult", ["liquidatable", "shortfall"])
+
+class Exposure:
+    """
+    The positions of an LP as NumPy matrices, with one row per address and one column per token:
+    - credits[i,j]: minted tokens of address i in token j, times XR(token j) (i.e. in units of token j)
+    - debts[i,j]:   debts of address i in token j
+    The values are converted to floats.
+    """
+    def __init__(self, lp, addresses=None):
+        self.tokens = list(lp.reserves)
+        self.addresses = list(lp.positions) if addresses is None else list(addresses)
+        self.tliq = float(lp.tliq)
+        self.prices = np.array([float(lp.get_price(token)) for token in self.tokens])
+
+        col = {token: j for j, token in enumerate(self.tokens)}
+        xr = {token: lp.XR(token) for token in self.tokens}
+        self.credits = np.zeros((len(self.addresses), len(self.tokens)))
+        self.debts = np.zeros((len(self.addresses), len(self.tokens)))
+        for i, address in enumerate(self.addresses):
+            for token in lp.positions.get(address, ()):
+                self.credits[i, col[token]] = float(lp.get_minted(token, address) * xr[token])
+                self.debts[i, col[token]] = float(lp.get_debts(token, address))
+
+    def __values(self, prices):
+        prices = np.atleast_2d(np.asarray(prices, dtype=float))
+        if prices.shape[1] != len(self.tokens):
+            raise ValueError(f"Expected prices for {len(self.tokens)} tokens ({', '.join(self.tokens)}).")
+        # val_minted and val_debts of each address in each scenario (scenarios x addresses)
+        return prices @ self.credits.T, prices @ self.debts.T
+
+    def health_factors(self, prices):
+        """
+        Returns the health factors of all the addresses (scenarios x addresses)
+        under the given prices (scenarios x tokens). Addresses without debts have +inf.
+        """
+        val_minted, val_debts = self.__values(prices)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hf = np.where(val_debts > 0, self.tliq * val_minted / val_debts, np.inf)
+        return hf
+
+    def evaluate(self, prices, chunk=1024):
+        """
+        Evaluates a batch of price scenarios (scenarios x tokens), processing
+        chunk scenarios at a time to bound the memory used.
+        """
+        prices = np.atleast_2d(np.asarray(prices, dtype=float))
+        liquidatable = np.zeros(len(prices), dtype=np.int64)
+        shortfall = np.zeros(len(prices))
+        for start in range(0, len(prices), chunk):
+            val_minted, val_debts = self.__values(prices[start:start+chunk])
+            gap = val_debts - self.tliq * val_minted
+            liquidatable[start:start+chunk] = np.count_nonzero((gap > 0) & (val_debts > 0), axis=1)
+            shortfall[start:start+chunk] = np.clip(gap, 0, None).sum(axis=1)
+        return ScenarioResult(liquidatable, shortfall)
+
+    def evaluate_shocks(self, shocks, chunk=1024):
+        """
+        Evaluates scenarios given as multipliers of the current prices (scenarios x tokens).
+        """
+        return self.evaluate(np.asarray(shocks, dtype=float) * self.prices, chunk)
@@ -0,0 +1,197 @@
+# In-process statistical model checking of des_lp simulations (without MultiVeStA)
+# Usage: python smc.py q1.multiquatex [-j WORKERS] [-a ALPHA] [-d DELTA] [--block N] [--seed S]
+
+import argparse
+import math
+import os
+import re
+from collections import namedtuple
+from multiprocessing import Pool
+from statistics import NormalDist
+
+import des_lp
+from numeric import BACKENDS, make_backend
+
+"""
+Estimates expected values of observations of des_lp.Model at given steps, as
+MultiVeStA does for the queries q1-q3.multiquatex, but running the simulations
+in this process (or in a pool of worker processes) instead of stepping them
+one RPC at a time over py4j.
+
+A Query is the value of an observation (see des_lp.Model.eval) after a number of
+steps, i.e. the MultiQuaTEx operator
+    tWliq (x) = if ( s.rval(4) == x ) then s.rval(6) else #tWliq (x) fi ;
+evaluated by eval E[tWliq(100)] is Query("tWliq(100)", 6, 100).
+
+The simulations are run in blocks (30 by default, as -bs 30 in MultiVeStA),
+until the (1 - alpha) confidence interval of the mean, from the Student t
+distribution, is at most delta wide. Simulation k is seeded with
+des_lp.derive_seed(seed, k), and each model has its own random generator, so
+the simulations are independent and reproducible; the blocks are collected in
+order, so the result does not depend on the number of workers.
+
+By default, each query is estimated on its own simulations, as MultiVeStA does,
+even for the points of a parametric query. With --single-pass, each simulation
+observes all the queries at their times, so a parametric sweep costs one set of
+simulations (as long as the one its widest interval needs), and its points are
+reported together.
+"""
+
+Query = namedtuple("Query", ["name", "observation", "time"])    # value of an observation after time steps
+
+OPERATOR = re.compile(r"(\w+)\s*\(\s*(\w+)\s*\)\s*=\s*if\s*\(\s*s\.rval\(\s*4\s*\)\s*==\s*\2\s*\)\s*then\s*s\.rval\(\s*(\d+)\s*\)"
+                      r"\s*else\s*#\s*\1\s*\(\s*\2\s*\)\s*fi")
+EVAL = re.compile(r"E\[\s*(\w+)\s*\(\s*([^)\s]+)\s*\)\s*\]")
+PARAMETRIC = re.compile(r"parametric\s*\(\s*E\[\s*(\w+)\s*\(\s*(\w+)\s*\)\s*\]\s*,\s*\2\s*,\s*([^,\s]+)\s*,\s*([^,\s]+)\s*,\s*([^)\s]+)\s*\)")
+
+def steps(value):
+    # a time of a query, which must be a whole number of steps
+    time = float(value)
+    if time < 0 or time != int(time):
+        raise ValueError(f"Invalid time '{value}' (expected a whole number of steps).")
+    return int(time)
+
+def parse_queries(text):
+    """
+    Parses the expected-value queries of a MultiQuaTEx text into a list of Queries.
+    Only the operators observing s.rval(K) when s.rval(4) (the step) reaches their parameter are supported,
+    evaluated by E[op(time)] or parametric(E[op(x)], x, start, step, end).
+    """
+    operators = {}  # {name: observation}
+    queries = []
+    for statement in text.split(";"):
+        statement = " ".join(statement.split())
+        if not statement:
+            continue
+        if not statement.startswith("eval "):
+            match = OPERATOR.fullmatch(statement)
+            if match is None:
+                raise ValueError(f"Unsupported operator: '{statement}'.")
+            operators[match.group(1)] = int(match.group(3))
+            continue
+        expression = statement[len("eval "):].strip()
+        match = PARAMETRIC.fullmatch(expression)
+        if match is not None:
+            name, start, step, end = match.group(1), float(match.group(3)), float(match.group(4)), float(match.group(5))
+            if step <= 0:
+                raise ValueError(f"Invalid step of '{expression}'.")
+            times = [start + i * step for i in range(int((end - start) / step + 1e-9) + 1)]
+        else:
+            match = EVAL.fullmatch(expression)
+            if match is None:
+                raise ValueError(f"Unsupported query: '{expression}'.")
+            name, times = match.group(1), [match.group(2)]
+        if name not in operators:
+            raise ValueError(f"Unknown operator '{name}'.")
+        queries += [Query(f"{name}({steps(time)})", operators[name], steps(time)) for time in times]
+    return queries
+
+def t_quantile(p, df):
+    """
+    Returns the p-quantile of the Student t distribution with df degrees of freedom
+    (Cornish-Fisher expansion of the normal quantile, accurate to 1e-3 for df >= 5).
+    """
+    z = NormalDist().inv_cdf(p)
+    g1 = (z**3 + z) / 4
+    g2 = (5*z**5 + 16*z**3 + 3*z) / 96
+    g3 = (3*z**7 + 19*z**5 + 17*z**3 - 15*z) / 384
+    g4 = (79*z**9 + 776*z**7 + 1482*z**5 - 1920*z**3 - 945*z) / 92160
+    return z + g1/df + g2/df**2 + g3/df**3 + g4/df**4
+
+def simulate(task):
+    """
+    Runs a simulation, and returns the values of the Queries, each observed after its number of steps
+    (task is a tuple (queries, seed, backend, scale)).
+    """
+    queries, seed, backend, scale = task
+    model = des_lp.Model(backend=make_backend(backend, scale))
+    model.init(seed)
+    values = [None] * len(queries)
+    for i in sorted(range(len(queries)), key=lambda i: queries[i].time):
+        model.run_until(queries[i].time)
+        values[i] = model.eval(queries[i].observation)
+    return values
+
+def estimate(query, alpha=0.05, delta=10, workers=1, block=30, seed=0, backend="fraction", scale=10**6, max_runs=None, pool=None):
+    """
+    Estimates the expected value of a Query, running blocks of simulations until the (1 - alpha)
+    confidence interval is at most delta wide (or max_runs simulations have been run).
+    Returns a dict with the query, mean, the bounds of the interval (low, high), the number of runs,
+    and converged (False if max_runs was reached first).
+    """
+    return estimate_all([query], alpha, delta, workers, block, seed, backend, scale, max_runs, pool)[0]
+
+def estimate_all(queries, alpha=0.05, delta=10, workers=1, block=30, seed=0, backend="fraction", scale=10**6, max_runs=None, pool=None):
+    """
+    Estimates the expected values of Queries on the same simulations, each observing all the queries
+    (e.g. all the points of a parametric query) in one run, until all the confidence intervals
+    are at most delta wide. Returns the list of the results of the queries (see estimate).
+    """
+    if pool is None and workers > 1:
+        with Pool(workers) as pool:
+            return estimate_all(queries, alpha, delta, workers, block, seed, backend, scale, max_runs, pool)
+    queries = list(queries)
+    n = 0
+    total, squares = [0.0] * len(queries), [0.0] * len(queries)
+    while True:
+        size = block if max_runs is None else min(block, max_runs - n)
+        tasks = [(queries, des_lp.derive_seed(seed, n + k), backend, scale) for k in range(size)]
+        runs = pool.map(simulate, tasks, chunksize=max(1, size // (4 * workers))) if pool is not None else map(simulate, tasks)
+        for values in runs:
+            n += 1
+            for i, value in enumerate(values):
+                total[i] += value
+                squares[i] += value * value
+        results = []
+        for i, query in enumerate(queries):
+            mean = total[i] / n
+            half = math.inf
+            if n > 1:
+                variance = max(0.0, (squares[i] - n * mean * mean) / (n - 1))
+                half = t_quantile(1 - alpha / 2, n - 1) * math.sqrt(variance / n)
+            results.append({"query": query.name, "mean": mean, "low": mean - half, "high": mean + half,
+                            "runs": n, "converged": 2 * half <= delta})
+        if all(r["converged"] for r in results) or (max_runs is not None and n >= max_runs):
+            return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate MultiQuaTEx expected values on des_lp simulations, in process.")
+    parser.add_argument("query", help="MultiQuaTEx file (e.g. q1.multiquatex).")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs).")
+    parser.add_argument("-a", "--alpha", type=float, default=0.05, help="Confidence level 1 - alpha of the intervals (default: 0.05).")
+    parser.add_argument("-d", "--delta", type=float, default=10, help="Maximum width of the confidence intervals (default: 10).")
+    parser.add_argument("--block", type=int, default=30, help="Simulations between two checks of the intervals (default: 30).")
+    parser.add_argument("--max-runs", type=int, metavar="N", help="Stop after N simulations even if the interval is wider than delta.")
+    parser.add_argument("--single-pass", action="store_true", help="Estimate all the queries (e.g. all the points of a parametric query) on the same simulations.")
+    parser.add_argument("--seed", type=int, default=0, help="Root seed of the simulations (default: 0).")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, default="fraction", help="Numeric backend (default: fraction).")
+    parser.add_argument("--scale", type=int, default=10**6, help="Scale of the fixed-point backend (default: 1000000).")
+    args = parser.parse_args()
+    if args.workers < 1 or args.block < 2:
+        parser.error("--workers must be positive, and --block at least 2")
+    if not 0 < args.alpha < 1 or args.delta <= 0:
+        parser.error("--alpha must be in (0, 1), and --delta positive")
+
+    with open(args.query) as f:
+        try:
+            queries = parse_queries(f.read())
+        except ValueError as e:
+            parser.error(f"{args.query}: {e}")
+    pool = Pool(args.workers) if args.workers > 1 else None
+    try:
+        print(f"{'query':<16} {'mean':>14} {'interval':>31} {'runs':>7}")
+        options = (args.alpha, args.delta, args.workers, args.block, args.seed, args.backend, args.scale, args.max_runs, pool)
+        if args.single_pass:
+            results = estimate_all(queries, *options)
+        else:
+            results = (estimate(query, *options) for query in queries)
+        for r in results:
+            interval = f"[{r['low']:.6g}, {r['high']:.6g}]"
+            print(f"{r['query']:<16} {r['mean']:>14.6g} {interval:>31} {r['runs']:>7}{'' if r['converged'] else '  (max runs)'}", flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+if __name__ == "__main__":
+    main()
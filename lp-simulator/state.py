@@ -0,0 +1,242 @@
+import copy
+from collections.abc import MutableMapping
+
+"""
+Versioned state for the LP and Blockchain models.
+
+The state of a model is made of maps (attributes holding dicts, possibly nested
+one level, e.g. {token: {address: amount}}) and of parameters (plain attributes).
+A map may be any mutable mapping with a copy() method (e.g. a compact.CompactMap).
+All the writes to the state go through _put, _put2 and _set_param, which:
+- record the overwritten values in an undo journal while there are live
+  snapshots, so that restore() costs time proportional to the writes to undo;
+- after a fork(), copy a map on its first write (copy-on-write), so that the
+  forked models share all the maps they do not modify.
+A large shared map is not copied, but wrapped in an Overlay holding the cells
+written by the model over the shared map, so that the first write of a fork to
+a map of n cells costs O(1) instead of O(n).
+"""
+
+ABSENT = object()   # value of a missing cell (writing it deletes the cell)
+SMALL = 64          # maps with at most SMALL cells are copied instead of overlaid
+
+class Overlay(MutableMapping):
+    """
+    A map made of the cells written over a base map, which is never modified.
+    Iterates as the dict it stands for: the cells of the base in place, then the added ones.
+    When the written cells outnumber the cells of the base, they are merged into a copy of it.
+    """
+    __slots__ = ("base", "changed", "removed", "added")
+
+    def __init__(self, base, changed=None, removed=None, added=None):
+        self.base = base                                    # shared map
+        self.changed = {} if changed is None else changed   # {key: value} overwritten cells of the base
+        self.removed = set() if removed is None else removed    # deleted cells of the base
+        self.added = {} if added is None else added         # {key: value} cells not in the base, in insertion order
+
+    def __getitem__(self, key):
+        if key in self.added:
+            return self.added[key]
+        if key in self.changed:
+            return self.changed[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+
+    def get(self, key, default=None):
+        if key in self.added:
+            return self.added[key]
+        if key in self.changed:
+            return self.changed[key]
+        if key in self.removed:
+            return default
+        return self.base.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.added or (key in self.base and key not in self.removed)
+
+    def __setitem__(self, key, value):
+        if key in self.added or key in self.removed or key not in self.base:
+            self.added[key] = value
+        else:
+            self.changed[key] = value
+        if len(self.changed) + len(self.removed) + len(self.added) > len(self.base):
+            self.__merge()
+
+    def __delitem__(self, key):
+        if key in self.added:
+            del self.added[key]
+        elif key in self.base and key not in self.removed:
+            self.changed.pop(key, None)
+            self.removed.add(key)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        removed = self.removed
+        for key in self.base:
+            if key not in removed:
+                yield key
+        yield from self.added
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + len(self.added)
+
+    def __merge(self):
+        # copies the base with the written cells, and overlays nothing
+        base = self.base.copy()
+        for key, value in self.changed.items():
+            base[key] = value
+        for key in self.removed:
+            del base[key]
+        for key, value in self.added.items():
+            base[key] = value
+        self.base, self.changed, self.removed, self.added = base, {}, set(), {}
+
+    def copy(self):
+        """
+        Returns an overlay of the same base, copying only the written cells.
+        """
+        return Overlay(self.base, dict(self.changed), set(self.removed), dict(self.added))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def shared_copy(d):
+    """
+    Returns a copy of a shared map d, to be written by one of the models sharing it.
+    """
+    if isinstance(d, Overlay):
+        return d.copy()
+    return Overlay(d) if len(d) > SMALL else d.copy()
+
+class Snapshot:
+    __slots__ = ("mark",)
+
+    def __init__(self, mark):
+        self.mark = mark    # position in the undo journal
+
+class Versioned:
+    """
+    Mixin for models with a versioned state.
+    """
+    MAPS = ()           # names of the maps of the state
+    PARAMS = ()         # names of the parameters of the state
+    journal = None      # undo journal, while there are live snapshots
+    snapshots = ()      # stack of live snapshots
+    shared = False      # True if the maps may be shared with a fork
+    owned = ()          # ids of the maps that can be written in place (after a fork)
+
+    def _own(self, name, key=ABSENT):
+        """
+        Returns the map self.name (or its inner map at key), copying it first if it is shared.
+        """
+        outer = self.__dict__[name]
+        if id(outer) not in self.owned:
+            outer = shared_copy(outer)
+            self.__dict__[name] = outer
+            self.owned.add(id(outer))
+        if key is ABSENT:
+            return outer
+        inner = outer[key]
+        if id(inner) not in self.owned:
+            inner = shared_copy(inner)
+            outer[key] = inner
+            self.owned.add(id(inner))
+        return inner
+
+    def _put(self, name, key, value):
+        """
+        Sets self.name[key] = value (or deletes it, if value is ABSENT).
+        """
+        d = self._own(name) if self.shared else self.__dict__[name]
+        old = d.get(key, ABSENT)
+        if self.journal is not None:
+            self.journal.append((name, key, old))
+        if value is ABSENT:
+            del d[key]
+        else:
+            d[key] = value
+        if self.shared:
+            self.owned.discard(id(old))
+
+    def _put2(self, name, key, subkey, value):
+        """
+        Sets self.name[key][subkey] = value (or deletes it, if value is ABSENT).
+        """
+        d = self._own(name, key) if self.shared else self.__dict__[name][key]
+        if self.journal is not None:
+            self.journal.append((name, key, subkey, d.get(subkey, ABSENT)))
+        if value is ABSENT:
+            del d[subkey]
+        else:
+            d[subkey] = value
+
+    def _set_param(self, name, value):
+        if self.journal is not None:
+            self.journal.append((name, self.__dict__[name]))
+        self.__dict__[name] = value
+
+    def snapshot(self):
+        """
+        Returns a snapshot of the current state, that can be passed to restore().
+        """
+        if self.journal is None:
+            self.journal = []
+        snapshot = Snapshot(len(self.journal))
+        self.snapshots = list(self.snapshots) + [snapshot]
+        return snapshot
+
+    def restore(self, snapshot):
+        """
+        Restores the state at the given snapshot, undoing all the writes performed after it.
+        The snapshot remains valid, while the ones taken after it are released.
+        """
+        i = self.__index(snapshot)
+        del self.snapshots[i+1:]
+        journal = self.journal
+        self.journal = None     # the undo writes are not journaled
+        while len(journal) > snapshot.mark:
+            entry = journal.pop()
+            if len(entry) == 2:
+                self._set_param(*entry)
+            elif len(entry) == 3:
+                self._put(*entry)
+            else:
+                self._put2(*entry)
+        self.journal = journal
+
+    def release(self, snapshot):
+        """
+        Releases the given snapshot (the other ones remain valid).
+        The journal entries older than all the live snapshots are dropped.
+        """
+        i = self.__index(snapshot)
+        del self.snapshots[i]
+        if not self.snapshots:
+            self.journal = None
+        elif i == 0:
+            start = self.snapshots[0].mark
+            del self.journal[:start]
+            for s in self.snapshots:
+                s.mark -= start
+
+    def __index(self, snapshot):
+        for i, s in enumerate(self.snapshots):
+            if s is snapshot:
+                return i
+        raise ValueError("Unknown or released snapshot.")
+
+    def fork(self):
+        """
+        Returns an independent copy of the model, sharing its maps copy-on-write.
+        The copy has no snapshots and no subscribers.
+        """
+        child = copy.copy(self)
+        for model in (self, child):
+            model.shared = True
+            model.owned = set()
+        child.journal = None
+        child.snapshots = ()
+        child.subscribers = ()
+        return child
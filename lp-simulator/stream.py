@@ -0,0 +1,163 @@
+import json
+import math
+from fractions import Fraction
+
+from numeric import Fixed
+from state import Versioned
+
+"""
+Diff-only output of the state of a model (LP or Blockchain) during a trace replay.
+
+The changed cells are read from the undo journal of the model (see state.py):
+after each step, the tracker folds the entries written by the step into the set
+of changed cells and drops them, so that collecting the changes costs time
+proportional to the writes, and memory proportional to the changed cells,
+not to the size of the state nor to the number of steps.
+
+Each output is a JSON line:
+  {"step": 3, "line": 7, "op": "borrow", "reverted": false, "reason": null,
+   "changes": {"debts": {"T0": {"B": "30"}}, "reserves": {"T0": "20"}}}
+where changes holds the new value of each changed cell (null if deleted) of
+the maps reserves, minted, debts (the actual debts), prices and wallets, and
+of the parameters tliq, rliq, ir_alpha and ir_beta.
+"""
+
+HIDDEN = {"debts_tot", "minted_tot", "positions", "borrow_index", "accrued", "holdings"}  # internal maps, not output
+
+def cadence(text):
+    """
+    Parses an output cadence: "step", "revert", "end", or a number of steps N.
+    """
+    if text in ("step", "revert", "end"):
+        return text
+    try:
+        n = int(text)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise ValueError(f"Invalid cadence '{text}' (expected step, revert, end, or a positive number of steps).")
+    return n
+
+def to_json(value, precise=False):
+    """
+    Converts a number to a JSON value: a string if precise (exact fraction or decimal), a float otherwise.
+    """
+    if isinstance(value, (Fraction, Fixed)):
+        return str(value) if precise else float(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    return value
+
+class ChangeTracker:
+    """
+    Collects the cells of a model changed since the last call to changes().
+    """
+    def __init__(self, model):
+        self.lp = getattr(model, "lp", model)
+        self.models = [model] if model is self.lp else [model, self.lp]
+        self.cells = [{} for m in self.models]  # per model {name: {key: {subkey: None}}}, or {name: {key: None}} for flat maps (in order of writes)
+        self.params = {}    # {name: model}
+        self.indexed = set()    # tokens whose debts have all been marked since the last output
+        self.marks = [Versioned.snapshot(m) for m in self.models]
+
+    def fold(self):
+        """
+        Adds the cells written since the previous call to the changed cells, and drops their journal entries,
+        so that the memory is bounded by the number of changed cells (to be called after each step).
+        """
+        for model, mark, cells in zip(self.models, self.marks, self.cells):
+            for entry in model.journal[mark.mark:]:
+                name = entry[0]
+                if len(entry) == 2:
+                    self.params[name] = model
+                elif name == "borrow_index":
+                    # all the debts in the token have changed (the later writes are marked by their own entries)
+                    if entry[1] not in self.indexed:
+                        self.indexed.add(entry[1])
+                        cells.setdefault("debts", {}).setdefault(entry[1], {}).update(dict.fromkeys(self.lp.debts.get(entry[1], ())))
+                elif name in HIDDEN:
+                    continue
+                elif len(entry) == 4:
+                    cells.setdefault(name, {}).setdefault(entry[1], {})[entry[2]] = None
+                elif name in ("reserves", "prices"):
+                    cells.setdefault(name, {})[entry[1]] = None
+            Versioned.release(model, mark)
+        self.marks = [Versioned.snapshot(m) for m in self.models]
+
+    def changes(self, precise=False):
+        self.fold()
+        cells, params = {}, self.params
+        for model_cells in self.cells:
+            cells.update(model_cells)
+        self.cells, self.params, self.indexed = [{} for m in self.models], {}, set()
+
+        out = {}
+        for name, keys in cells.items():
+            if name in ("reserves", "prices"):
+                values = getattr(self.lp, name)
+                out[name] = {key: to_json(values[key], precise) if key in values else None for key in keys}
+                continue
+            out[name] = {}
+            for key, subkeys in keys.items():
+                out[name][key] = {subkey: self.__value(name, key, subkey, precise) for subkey in subkeys}
+        for name, model in params.items():
+            out[name] = to_json(getattr(model, name), precise)
+        return out
+
+    def __value(self, name, key, subkey, precise):
+        model = self.models[0] if name == "wallets" else self.lp
+        values = getattr(model, name).get(key, {})
+        if subkey not in values:
+            return None
+        if name == "debts":
+            return to_json(self.lp.get_debts(key, subkey), precise)
+        return to_json(values[subkey], precise)
+
+class DiffWriter:
+    """
+    Writes the changes of a model as JSON lines, on the given cadence
+    (see cadence()): after every step, every N steps, after each reverted step, or at the end.
+    """
+    def __init__(self, model, out, cadence="step", precise=False):
+        self.model = model
+        self.out = out
+        self.every = 1 if cadence == "step" else cadence
+        self.precise = precise
+        self.tracker = ChangeTracker(model)
+        self.n_steps = 0
+        self.last = None        # the last executed Step
+        self.pending = False    # True if some steps have not been output yet
+
+    def step(self, step):
+        """
+        To be called after each executed Step (e.g. as the after callback of run_trace).
+        """
+        self.n_steps += 1
+        self.last = step
+        self.pending = True
+        self.tracker.fold()
+        if self.every == "revert":
+            if self.model.lastReverted:
+                self.write()
+        elif self.every != "end" and self.n_steps % self.every == 0:
+            self.write()
+
+    def close(self):
+        """
+        Writes the pending changes (except with the revert cadence).
+        """
+        if self.pending and self.every != "revert":
+            self.write()
+
+    def write(self):
+        step = self.last
+        record = {
+            "step": self.n_steps,
+            "line": step.lineno,
+            "op": step.fn.__name__,
+            "reverted": self.model.lastReverted,
+            "reason": self.model.lastRevertReason if self.model.lastReverted else None,
+            "changes": self.tracker.changes(self.precise),
+        }
+        self.out.write(json.dumps(record) + "\n")
+        self.pending = False
@@ -1,11 +1,13 @@
+from collections.abc import Mapping
 from fractions import Fraction
+from numeric import Fixed
 
 def clean_repr(obj, precise=False):
      """
      Recursively converts objects to a string representation
      with custom formatting for dictionaries, lists, and fractions.
      """
-     if isinstance(obj, dict):
+     if isinstance(obj, Mapping):
          return "{" + ", ".join(f"{k}: {clean_repr(v)}" for k, v in obj.items()) + "}"
      elif isinstance(obj, list):
          return "[" + ", ".join(clean_repr(v) for v in obj) + "]"
@@ -13,6 +15,8 @@ def clean_repr(obj, precise=False):
          return f"{obj.numerator}/{obj.denominator}" if precise else format_float(float(obj))
      elif isinstance(obj, float):
          return format_float(obj)
+     elif isinstance(obj, Fixed):
+         return str(obj) if precise else format_float(float(obj))
      elif isinstance(obj, str):
          return obj  # Return strings without quotes
      else:
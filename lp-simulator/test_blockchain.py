@@ -1,10 +1,22 @@
 # Unit tests for the Blockchain model
 # Usage: pytest test_blockchain.py
 
+import io
+import json
+import os
 import pytest
 from math import isclose
+from fractions import Fraction
 
+from batch import find_traces, run_batch, write_csv
 from blockchain import Blockchain
+from lp import LP
+from checkpoint import CheckpointError, Checkpointer
+from numeric import make_backend
+from profiling import Profiler
+from replay_index import ReplayIndex
+from stream import DiffWriter
+from trace_utils import TraceError, compile_trace, iter_calls, iter_steps, parse_lines, parse_trace, run_trace
 
 """
 Deposit tests
@@ -26,3 +38,472 @@ def test_deposit2():
     b.faucet("A", 100, "ETH")
     b.deposit("A", 101, "ETH")
     assert(b.lastReverted == True)
+
+"""
+Events tests
+"""
+
+def test_events1():
+    b = Blockchain(verbose=False)
+    events = []
+    b.subscribe(events.append, metrics=["net_worth"])
+
+    b.faucet("A", 100, "ETH")
+    b.deposit("A", 101, "ETH")
+    assert(b.lastReverted == True)
+    b.deposit("A", 100, "ETH")
+    assert(b.lastReverted == False)
+
+    assert([e.op for e in events] == ["faucet", "deposit", "deposit"])
+    assert(events[1].reverted and events[1].reason == "Address A has insufficient units of ETH")
+    assert(not events[2].reverted)
+    assert(events[2].pre["net_worth"] == events[2].post["net_worth"] == {"A": 100})
+
+def test_events2():
+    b = Blockchain(verbose=False)
+    events = []
+    b.subscribe(events.append)
+    b.faucet("A", 100, "ETH")
+    b.deposit("A", 100, "ETH")
+    b.borrow("A", 100, "ETH")
+    assert(b.lastReverted == True)
+    # the reason is the one of the LP
+    assert(events[-1].reason == "A is not collateralized")
+
+"""
+Snapshot and fork tests
+"""
+
+def test_fork1():
+    b = Blockchain(verbose=False)
+    b.faucet("A", 100, "ETH")
+    b.deposit("A", 50, "ETH")
+
+    c = b.fork()
+    c.redeem("A", 50, "ETH")
+    assert(c.get_tokens("A","ETH") == 100)
+    assert(b.get_tokens("A","ETH") == 50)
+    assert(b.lp.get_reserves("ETH") == 50)
+
+    s = b.snapshot()
+    b.deposit("A", 50, "ETH")
+    b.restore(s)
+    assert(b.get_tokens("A","ETH") == 50)
+    assert(b.lp.get_minted("ETH","A") == 50)
+
+"""
+Bundle tests
+"""
+
+def test_bundle1():
+    b = Blockchain(verbose=False)
+    b.faucet("A", 100, "ETH")
+    b.execute_bundle([("deposit", ("A", 50, "ETH")), ("borrow", ("A", 10, "ETH"))])
+    assert(not b.lastReverted and b.get_tokens("A","ETH") == 60)
+    minted, wallets = b.lp.minted["ETH"], b.wallets["ETH"]
+    events = []
+    b.subscribe(events.append)
+    b.execute_bundle([("faucet", ("B", 10, "BTC")), ("repay", ("A", 5, "ETH")), ("redeem", ("A", 100, "ETH"))])
+    assert(b.lastReverted and b.lastRevertReason == b.lp.lastRevertReason)
+    assert(b.get_tokens("A","ETH") == 60 and b.lp.get_debts("ETH", "A") == 10 and "BTC" not in b.wallets)
+    assert(b.lp.minted["ETH"] is minted and b.wallets["ETH"] is wallets and b.journal is None and b.lp.journal is None)
+    assert([e.op for e in events] == ["faucet", "repay", "redeem", "execute_bundle"] and events[-1].reverted)
+    with pytest.raises(ValueError):
+        b.execute_bundle([("faucet", ("A", 1, "ETH")), ("_put", ("wallets", "ETH", {}))])
+    assert(b.get_tokens("A","ETH") == 60 and b.journal is None)
+
+"""
+Compact storage tests
+"""
+
+def test_compact1():
+    b = Blockchain(verbose=False, compact=True)
+    b.faucet("A", 100, "ETH")
+    b.faucet("B", 100, "BTC")
+    b.deposit("A", 50, "ETH")
+    b.deposit("B", 50, "BTC")
+    b.borrow("B", 20, "ETH")
+    assert(b.get_tokens("A","ETH") == 50)
+    assert(b.get_tokens("B","ETH") == 20)
+    assert(b.net_worth("B") == 100)
+    assert(b.wallets["ETH"].interner is b.lp.minted["ETH"].interner)
+
+"""
+Net worth tests
+"""
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_net_worths1(compact):
+    b = Blockchain(verbose=False, compact=compact)
+    run_trace(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), b)
+    addresses = ["A"] + [f"U{i}" for i in range(10)] + ["Z"]
+    assert(b.net_worths(addresses) == {address: b.net_worth(address) for address in addresses})
+    assert(b.net_worth("Z") == 0 and tuple(b.holdings["A"]) == ("ETH",))
+    f = b.fork()
+    f.faucet("A", 10, "BTC")
+    f.set_price("BTC", 2)
+    assert(f.net_worth("A") == b.net_worth("A") + 20 and tuple(f.holdings["A"]) == ("ETH", "BTC"))
+    assert(tuple(b.holdings["A"]) == ("ETH",))
+
+"""
+Trace tests
+"""
+
+TRACE = """
+# comment
+A:faucet(100:ETH)
+A:deposit(50:ETH)   # inline comment
+set_price(ETH, 3/2)
+net_worth(A)
+"""
+
+def test_trace1():
+    calls = parse_lines(TRACE.splitlines())
+    assert([(c.lineno, c.method, c.args) for c in calls] == [
+        (3, "faucet", ["A", 100, "ETH"]),
+        (4, "deposit", ["A", 50, "ETH"]),
+        (5, "set_price", ["ETH", Fraction(3,2)]),
+        (6, "net_worth", ["A"])])
+    steps = compile_trace(calls, Blockchain, strict=True)
+    for b in (Blockchain(verbose=False), Blockchain(verbose=False)):
+        run_trace(steps, b)
+        assert(b.net_worth("A") == 150)
+
+def test_trace_blocks():
+    calls = parse_lines(["@3", "@5 A:faucet(100:ETH)  # at block 5", "@x A:faucet(1:ETH)"])
+    assert([(c.lineno, c.method, c.args) for c in calls[:3]] ==
+           [(1, "set_block", [3]), (2, "set_block", [5]), (2, "faucet", ["A", 100, "ETH"])])
+    assert(calls[3].lineno == 3 and calls[3].error is not None)
+    b = Blockchain(verbose=False)
+    run_trace(compile_trace(calls, Blockchain), b)
+    assert(b.lp.block == 5 and b.get_tokens("A", "ETH") == 100)
+
+def test_trace_bundles():
+    lines = ["A:faucet(100:ETH)", "{", "A:deposit(50:ETH)", "{", "A:borrow(10:ETH)", "}", "}",
+             "{", "A:deposit(10:ETH)", "A:borrow(1000:ETH)", "}", "}", "{", "A:swap(1:ETH)", "}", "{", "A:faucet(1:ETH)"]
+    calls = parse_lines(lines)
+    assert([(c.lineno, c.method) for c in calls] == [(1, "faucet"), (2, "execute_bundle"), (8, "execute_bundle"),
+                                                      (12, None), (13, "execute_bundle"), (16, None)])
+    assert([c.method for c in calls[1].args[0]] == ["deposit", "execute_bundle"])
+    steps = compile_trace(calls, Blockchain)
+    assert([step.error is None for step in steps] == [True, True, True, False, False, False])
+    b = Blockchain(verbose=False)
+    reverted = []
+    run_trace(steps, b, after=lambda step: reverted.append(b.lastReverted))
+    assert(reverted == [False, False, True])
+    assert(b.get_tokens("A","ETH") == 60 and b.lp.reserves["ETH"] == 40 and b.journal is None)
+
+def test_trace2():
+    calls = parse_lines(["A:deposit(x:ETH)", "A:swap(1:ETH)", "set_price(ETH)", "A:faucet(1:ETH)"])
+    with pytest.raises(TraceError) as e:
+        compile_trace(calls, Blockchain, strict=True)
+    assert([line.split(":")[0] for line in str(e.value).splitlines()] == ["line 1", "line 2", "line 3"])
+    steps = compile_trace(calls, Blockchain)
+    b = Blockchain(verbose=False)
+    run_trace(steps, b)
+    assert(b.get_tokens("A","ETH") == 1)
+
+def test_trace3(tmp_path):
+    trace = tmp_path / "trace.txt"
+    trace.write_text(TRACE)
+    cache = tmp_path / "cache"
+    calls = parse_trace(trace, cache_dir=cache)
+    assert(len(list(cache.iterdir())) == 1)
+    assert(parse_trace(trace, cache_dir=cache) == calls == parse_trace(trace))
+    trace.write_text(TRACE + "accrue_interest\n")
+    assert(len(parse_trace(trace, cache_dir=cache)) == len(calls) + 1)
+    assert(len(list(cache.iterdir())) == 2)
+
+def apply_diff(state, changes):
+    for name, cells in changes.items():
+        if not isinstance(cells, dict):
+            state[name] = cells
+            continue
+        for key, value in cells.items():
+            if isinstance(value, dict):
+                state.setdefault(name, {}).setdefault(key, {}).update(value)
+            else:
+                state.setdefault(name, {})[key] = value
+
+@pytest.mark.parametrize("cadence", ["step", 2, "end"])
+def test_stream1(cadence):
+    trace = TRACE + "A:borrow(10:ETH)\naccrue_interest\nA:redeem(100:ETH)\n"
+    b = Blockchain(verbose=False)
+    out = io.StringIO()
+    writer = DiffWriter(b, out, cadence, precise=True)
+    run_trace(iter_steps(iter_calls(io.StringIO(trace)), Blockchain), b, after=writer.step)
+    writer.close()
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert(len(records) == {"step": 7, 2: 4, "end": 1}[cadence])
+    assert(records[-1]["step"] == 7 and records[-1]["op"] == "redeem" and records[-1]["reverted"])
+
+    state = {}
+    for record in records:
+        apply_diff(state, record["changes"])
+    assert(state["wallets"]["ETH"] == {"A": str(b.get_tokens("A", "ETH"))})
+    assert(state["debts"]["ETH"] == {"A": str(b.lp.get_debts("ETH", "A"))})
+    assert(state["reserves"]["ETH"] == str(b.lp.get_reserves("ETH")))
+    assert(state["prices"]["ETH"] == "3/2")
+
+def test_stream2():
+    b = Blockchain(verbose=False)
+    out = io.StringIO()
+    writer = DiffWriter(b, out, "revert")
+    run_trace(compile_trace(parse_lines(TRACE.splitlines() + ["A:redeem(100:ETH)"]), Blockchain), b, after=writer.step)
+    writer.close()
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert([r["line"] for r in records] == [7])
+    assert(records[0]["reason"] is not None)
+
+def test_stream3():
+    # the journal is folded after each step, whatever the cadence
+    b = Blockchain(verbose=False)
+    out = io.StringIO()
+    writer = DiffWriter(b, out, "end", precise=True)
+    journals = []
+
+    def after(step):
+        writer.step(step)
+        journals.append(len(b.journal) + len(b.lp.journal))
+
+    run_trace(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), b, after=after)
+    writer.close()
+    assert(max(journals) == 0)
+    state = {}
+    apply_diff(state, json.loads(out.getvalue())["changes"])
+    assert(state["debts"]["ETH"] == {"A": str(b.lp.get_debts("ETH", "A"))})
+    assert(state["minted"]["ETH"] == {a: str(x) for a, x in b.lp.minted["ETH"].items()})
+
+"""
+Checkpoint tests
+"""
+
+CHECKPOINT_TRACE = TRACE + "".join(f"U{i}:faucet(10:ETH)\nU{i}:deposit(10:ETH)\nA:borrow(1:ETH)\naccrue_interest\n" for i in range(10))
+
+def run_checkpointed(b, directory, lines, resume=False, stop=None, every=3):
+    checkpointer = Checkpointer(b, directory, every=every)
+    start = 1
+    if resume:
+        lines, start = checkpointer.resume(lines)
+    checkpointer.start()
+    for step in iter_steps(iter_calls(checkpointer.lines(lines), start), Blockchain):
+        if step.lineno == stop and not step.partial:
+            return  # interrupted (after the set_block of a line with a block), without a last checkpoint
+        if step.error is None:
+            step.fn(b, *step.args)
+            checkpointer.step(step)
+    checkpointer.close()
+
+@pytest.mark.parametrize("name, compact", [("fraction", False), ("fixed", True)])
+def test_checkpoint1(tmp_path, name, compact):
+    backend = make_backend(name)
+    lines = CHECKPOINT_TRACE.splitlines()
+    b = Blockchain(verbose=False, backend=backend, compact=compact)
+    run_trace(compile_trace(parse_lines(lines), Blockchain), b)
+
+    c = Blockchain(verbose=False, backend=backend, compact=compact)
+    run_checkpointed(c, tmp_path, lines, stop=30)
+    d = Blockchain(verbose=False, backend=backend, compact=compact)
+    run_checkpointed(d, tmp_path, lines, resume=True)
+    assert(d.wallets == b.wallets)
+    assert({t: dict(m) for t, m in d.lp.debts.items()} == {t: dict(m) for t, m in b.lp.debts.items()})
+    assert(d.lp.borrow_index == b.lp.borrow_index and d.lp.prices == b.lp.prices)
+    assert(d.net_worth("A") == b.net_worth("A"))
+    d.lp.check_totals()
+
+def test_checkpoint2(tmp_path):
+    lines = CHECKPOINT_TRACE.splitlines()
+    run_checkpointed(Blockchain(verbose=False), tmp_path, lines, stop=20)
+    with pytest.raises(CheckpointError):
+        run_checkpointed(Blockchain(verbose=False), tmp_path, ["# other"] + lines, resume=True)
+    with pytest.raises(CheckpointError):
+        run_checkpointed(Blockchain(verbose=False, backend=make_backend("float")), tmp_path, lines, resume=True)
+
+def test_checkpoint3(tmp_path):
+    # the status of the LP is restored too (the last step reverts in the wallet, not in the LP)
+    lines = ["A:faucet(100:ETH)", "A:deposit(50:ETH)", "A:borrow(1000:ETH)", "A:deposit(500:ETH)"]
+    b = Blockchain(verbose=False)
+    run_trace(compile_trace(parse_lines(lines), Blockchain), b)
+    run_checkpointed(Blockchain(verbose=False), tmp_path, lines, stop=4)
+    d = Blockchain(verbose=False)
+    run_checkpointed(d, tmp_path, lines, resume=True)
+    assert(d.lastReverted and d.lp.lastReverted and d.lp.lastRevertReason is not None)
+    assert((d.lastRevertReason, d.lp.lastRevertReason) == (b.lastRevertReason, b.lp.lastRevertReason))
+
+def test_checkpoint4(tmp_path):
+    # a checkpoint is never written between the set_block and the call of a line
+    lines = ["A:faucet(100:T0)", "A:deposit(100:T0)", "B:faucet(100:T1)", "B:deposit(100:T1)",
+             "@1 B:borrow(30:T0)", "@101 B:repay(1:T0)", "@201"]
+    b = Blockchain(verbose=False)
+    run_trace(compile_trace(parse_lines(lines), Blockchain), b)
+    run_checkpointed(Blockchain(verbose=False), tmp_path, lines, stop=5, every=1)
+    d = Blockchain(verbose=False)
+    run_checkpointed(d, tmp_path, lines, resume=True, every=1)
+    assert(not d.lastReverted and d.lp.block == 201)
+    assert(d.lp.get_debts("T0", "B") == b.lp.get_debts("T0", "B") > 29)
+    assert(d.net_worth("B") == b.net_worth("B"))
+
+"""
+Replay index tests
+"""
+
+def replay_prefix(k):
+    b = Blockchain(verbose=False)
+    steps = [step for step in compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain) if step.error is None]
+    run_trace(steps[:k], b)
+    return b
+
+@pytest.mark.parametrize("stride", [1, 4, 64])
+def test_replay_index1(stride):
+    b = Blockchain(verbose=False)
+    index = ReplayIndex(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), b, stride)
+    assert(len(index) == 44 and index.line_of(1) == 3)
+    for k in [0, 3, 4, 17, 44]:
+        assert(index.state_at(k).wallets == replay_prefix(k).wallets)
+    assert(index.state_at(44).net_worth("A") == b.net_worth("A"))
+    series = index.metric_series("net_worth", ["A", "U3"], steps=[10, 20, 0, 44])
+    assert(series["A"] == [replay_prefix(k).net_worth("A") for k in [10, 20, 0, 44]])
+    assert(series["U3"][0] == 0 and series["U3"][3] > 10)
+    with pytest.raises(IndexError):
+        index.state_at(45)
+
+@pytest.mark.parametrize("stride", [1, 4, 64])
+def test_replay_index2(stride):
+    index = ReplayIndex(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), Blockchain(verbose=False), stride)
+    # the debt of A only grows
+    has_debt = lambda k: lambda b: b.lp.get_debts("ETH", "A") > k
+    for threshold in [0, 30, 31, 100]:
+        first = index.first_step_where(has_debt(threshold))
+        assert(index.first_step_where(has_debt(threshold), monotone=True) == first)
+        if first is not None:
+            assert(has_debt(threshold)(index.state_at(first)) and not has_debt(threshold)(index.state_at(first - 1)))
+    assert(index.first_step_where(has_debt(0), start=20, monotone=True) == 20)
+    assert(index.first_step_where(lambda b: b.get_tokens("U9", "ETH") == 10) == 41)
+
+"""
+Columnar export tests
+"""
+
+@pytest.mark.parametrize("path, chunk", [("out", 1024), ("out", 3), ("out.npz", 5)])
+def test_export1(tmp_path, path, chunk):
+    np = pytest.importorskip("numpy")
+    from export import ColumnarWriter, load
+    b = Blockchain(verbose=False)
+    writer = ColumnarWriter(b, str(tmp_path / path), chunk=chunk)
+    expected = []
+
+    def after(step):
+        writer.step(step)
+        expected.append({address: (b.health_factor(address), b.lp.get_debts("ETH", address), b.get_tokens(address, "ETH"))
+                         for address in ["A", "U0"]})
+
+    run_trace(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), b, after=after)
+    writer.close()
+    schema, arrays = load(str(tmp_path / path))
+    assert(schema["steps"] == 44 and schema["tokens"] == ["ETH"] and schema["addresses"][:2] == ["A", "U0"])
+    assert(arrays["address_debts"].shape == (44, 11, 1) and list(arrays["step"]) == list(range(1, 45)))
+    assert(schema["ops"][arrays["op"][-1]] == "accrue_interest")
+    for k, values in enumerate(expected):
+        for i, address in enumerate(["A", "U0"]):
+            hf, debts, wallet = values[address]
+            if k < 4 and address == "U0":
+                assert(np.isnan(arrays["address_debts"][k, i, 0]))    # before U0 appears
+                continue
+            assert(isclose(arrays["address_health_factor"][k, i], float(hf)))
+            assert(isclose(arrays["address_debts"][k, i, 0], float(debts)))
+            assert(arrays["address_wallets"][k, i, 0] == float(wallet))
+    assert(isclose(arrays["token_xr"][-1, 0], float(b.lp.XR("ETH"))))
+    assert(isclose(arrays["token_utilization"][-1, 0], float(b.lp.utilization_ratio("ETH"))))
+
+def test_export2(tmp_path):
+    # LP only: no wallets, and every 4 steps (and at the end)
+    np = pytest.importorskip("numpy")
+    from export import ColumnarWriter
+    lp = LP(verbose=False)
+    writer = ColumnarWriter(lp, str(tmp_path / "out"), every=4)
+    run_trace(compile_trace(parse_lines(["A:deposit(10:T0)", "B:deposit(10:T1)", "B:borrow(5:T0)", "set_price(T0, 3/2)", "accrue_interest"]), LP), lp, after=writer.step)
+    writer.close()
+    with open(tmp_path / "out" / "schema.json") as f:
+        schema = json.load(f)
+    arrays = {name: np.load(tmp_path / "out" / f"{name}.npy", mmap_mode="r") for name in schema["arrays"]}
+    assert("address_wallets" not in arrays and list(arrays["step"]) == [4, 5])
+    assert(arrays["token_reserves"].tolist() == [[5, 10], [5, 10]])
+    assert(isclose(arrays["address_health_factor"][1, 1], float(lp.health_factor("B"))))
+    assert(arrays["address_health_factor"][1, 0] == np.inf)
+
+def test_export3(tmp_path):
+    pytest.importorskip("numpy")
+    from export import ColumnarWriter, load
+    b = Blockchain(verbose=False)
+    writer = ColumnarWriter(b.lp, str(tmp_path / "export.npz"), every=10)
+    run_trace(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), b, after=writer.step)
+    writer.close()
+    schema, arrays = load(str(tmp_path / "export.npz"))
+    assert(list(arrays["step"]) == [10, 20, 30, 40, 44] and "address_wallets" not in arrays)
+    assert(isclose(arrays["token_interest_rate"][-1, 0], b.lp.interest_rate("ETH")))
+
+"""
+Batch tests
+"""
+
+def test_batch1(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "b.txt").write_text(TRACE)
+    (tmp_path / "sub" / "a.txt").write_text(CHECKPOINT_TRACE + "A:unknown\n")
+    (tmp_path / "empty.txt").write_text("")
+    traces = find_traces([str(tmp_path)])
+    assert([os.path.relpath(t, tmp_path) for t in traces] == ["b.txt", "empty.txt", os.path.join("sub", "a.txt")])
+    summaries = run_batch(traces + [str(tmp_path / "missing.txt")], workers=1)
+    assert(run_batch(traces + [str(tmp_path / "missing.txt")], workers=3) == summaries)
+    assert([s["steps"] for s in summaries[:3]] == [4, 0, 44] and summaries[2]["errors"] == 1)
+    assert("error" in summaries[3])
+    b = Blockchain(verbose=False)
+    run_trace(compile_trace(parse_lines(CHECKPOINT_TRACE.splitlines()), Blockchain), b)
+    assert(summaries[2]["net_worth"]["A"] == float(b.net_worth("A")))
+    out = io.StringIO()
+    write_csv(summaries, out)
+    rows = out.getvalue().splitlines()
+    assert(rows[0] == "trace,steps,reverted,errors,address,net_worth" and len(rows) == 1 + 1 + 1 + 11 + 1)
+
+def test_batch2(tmp_path):
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "t2.txt").write_text(TRACE + "A:redeem(100:ETH)\nA:swap(1:ETH)\n")
+    (tmp_path / "b" / "t1.txt").write_text(CHECKPOINT_TRACE)
+    (tmp_path / "a.txt").write_text(TRACE)
+    traces = find_traces([str(tmp_path / "b"), str(tmp_path / "a.txt")])
+    assert([t[len(str(tmp_path))+1:] for t in traces] == ["b/t1.txt", "b/t2.txt", "a.txt"])
+    summaries = run_batch(traces, workers=2, precise=True)
+    assert(summaries == run_batch(traces, workers=1, precise=True))
+    assert([(s["steps"], s["reverted"], s["errors"]) for s in summaries] == [(44, 0, 0), (5, 1, 1), (4, 0, 0)])
+    assert(summaries[2]["net_worth"] == {"A": "150"} and summaries[2]["state"]["prices"] == {"ETH": "3/2"})
+    out = io.StringIO()
+    write_csv(summaries, out)
+    assert(out.getvalue().splitlines()[-1].endswith("a.txt,4,0,0,A,150"))
+
+"""
+Profiling tests
+"""
+
+def test_profile1():
+    b = Blockchain(verbose=False)
+    profiler = Profiler()
+    profiler.attach(b)
+    assert(type(b).__name__ == "Blockchain" and isinstance(b, Blockchain))
+    run_trace(compile_trace(parse_lines(TRACE.splitlines() + ["A:borrow(40:ETH)"]), type(b)), b)
+    f = b.fork()
+    f.net_worth("A")
+    report = profiler.report()
+    assert(report["operations"]["Blockchain.deposit"]["calls"] == 1 and report["operations"]["LP.deposit"]["calls"] == 1)
+    assert(report["operations"]["Blockchain.borrow"]["calls"] == 1 and report["operations"]["Blockchain.borrow"]["reverts"] == 1)
+    assert(report["reverts"]["LP.borrow"] == {"A is not collateralized": 1})
+    assert(report["helpers"]["Blockchain.net_worth"]["calls"] == 2 and report["helpers"]["LP.XR"]["calls"] > 0)
+    s = report["operations"]["LP.borrow"]
+    assert(0 < s["p50_us"] <= s["p99_us"] and isclose(s["mean_us"] * s["calls"], s["total_ms"] * 1000))
+
+    profiler.detach(b)
+    assert(type(b) is Blockchain and type(b.lp).deposit is LP.deposit)
+    b.deposit("A", 1, "ETH")
+    assert(profiler.report()["operations"]["Blockchain.deposit"]["calls"] == 1)
+    out = io.StringIO()
+    profiler.print_report(out)
+    assert("LP.borrow: A is not collateralized" in out.getvalue())
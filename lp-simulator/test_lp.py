@@ -1,10 +1,13 @@
 # Unit tests for the LP model
 # Usage: pytest test_lp.py
 
+import math
 import pytest
 from math import isclose
+from fractions import Fraction
 
 from lp import LP
+from numeric import make_backend
 
 """
 Deposit tests
@@ -237,6 +240,94 @@ def test_accrue2():
     for token in xr_pre:
         assert xr_pre[token] < xr_post[token]
 
+def accrue_lp(backend, alpha):
+    g = LP(verbose=False, backend=backend)
+    g.set_interest_rate(alpha, Fraction(1, 10))
+    g.deposit("A", 100, "T0")
+    g.deposit("B", 100, "T1")
+    g.borrow("B", 30, "T0")
+    g.deposit("C", 10, "T2")
+    g.borrow("C", 1, "T2")
+    g.repay("C", 1, "T2")     # no debts in T2
+    return g
+
+@pytest.mark.parametrize("name", ["fraction", "float", "fixed"])
+@pytest.mark.parametrize("alpha", [0, Fraction(1, 2)])
+def test_accrue3(name, alpha):
+    # n accruals at once are the same as n single accruals
+    backend = make_backend(name)
+    for n in [1, 2, 7]:
+        g, h = accrue_lp(backend, alpha), accrue_lp(backend, alpha)
+        for _ in range(n):
+            g.accrue_interest()
+        h.accrue_interest(n)
+        assert(h.lastReverted == False)
+        assert(h.borrow_index == g.borrow_index and h.get_debts("T0", "B") == g.get_debts("T0", "B"))
+        assert(h.XR("T0") == g.XR("T0"))
+
+def test_accrue4():
+    g = accrue_lp(make_backend(), 0)
+    g.accrue_interest(3)
+    assert(g.get_debts("T0", "B") == 30 * Fraction(11, 10) ** 3)
+    for periods in [0, -1, Fraction(3, 2)]:
+        g.accrue_interest(periods)
+        assert(g.lastReverted == True)
+    assert(g.get_debts("T0", "B") == 30 * Fraction(11, 10) ** 3)
+
+def test_block1():
+    # interest accrues lazily on the touched tokens, for the elapsed blocks (simple interest, as in LP.sol)
+    g = LP(verbose=False)
+    g.set_interest_rate(0, Fraction(1, 100))
+    g.set_block(1)
+    g.deposit("A", 100, "T0")
+    g.deposit("B", 100, "T1")
+    g.deposit("C", 100, "T2")
+    g.borrow("B", 30, "T0")
+    g.borrow("C", 10, "T1")
+    g.set_block(11)
+    assert(g.get_debts("T0", "B") == 30)    # not accrued yet
+    g.repay("B", 1, "T0")
+    assert(g.get_debts("T0", "B") == 30 * Fraction(110, 100) - 1)
+    assert(g.get_debts("T1", "C") == 10 and g.accrued["T1"] == 1)   # idle token
+    g.set_block(21)
+    g.repay("B", 1, "T0")
+    assert(g.borrow_index["T0"] == Fraction(110, 100) * Fraction(110, 100))
+    g.redeem("C", 1, "T2")  # accrues the tokens of the positions of C
+    assert(g.get_debts("T1", "C") == 10 * Fraction(120, 100) and g.accrued["T1"] == 21)
+
+def test_block2():
+    g = LP(verbose=False)
+    g.deposit("A", 100, "T0")
+    g.deposit("B", 100, "T1")
+    g.borrow("B", 50, "T0")
+    g.set_block(5)
+    g.borrow("B", 1, "T0")
+    index = g.borrow_index["T0"]
+    g.set_block(105)
+    g.borrow("B", 30, "T0")     # reverts, and so does its accrual
+    assert(g.lastReverted == True and g.borrow_index["T0"] == index and g.accrued["T0"] == 5)
+    g.set_block(104)
+    assert(g.lastReverted == True and g.block == 105)
+    g.accrue_interest()         # explicit accruals are still possible
+    assert(g.borrow_index["T0"] == index * Fraction(112, 100))
+
+def test_block3():
+    # the debts opened before block mode accrue interest from its first block
+    debts = []
+    for enable_first in (True, False):
+        g = LP(verbose=False)
+        g.set_interest_rate(0, Fraction(1, 100))
+        if enable_first:
+            g.set_block(1)
+        g.deposit("A", 100, "T0")
+        g.deposit("B", 100, "T1")
+        g.borrow("B", 30, "T0")
+        g.set_block(1)
+        g.set_block(101)
+        g.repay("B", 1, "T0")
+        debts.append(g.get_debts("T0", "B"))
+    assert(debts == [59, 59])
+
 """
 Repay tests
 """
@@ -324,3 +415,477 @@ def test_liquidate2():
     assert(g.lastReverted == False)
     g.redeem("A", 10, "T0")
     assert(g.lastReverted == False)
+
+
+"""
+Running totals tests
+"""
+
+def test_totals1():
+    g = LP(debug=True)
+
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.borrow ("B", 30, "T0")
+    g.accrue_interest()
+    g.repay  ("B",  5, "T0")
+    g.set_price("T0",1.3)
+    g.liquidate("A", 11, "T0", "B", "T1")
+    g.redeem("A", 10, "T0")
+    g.check_totals()
+
+    assert(g.tok_supply("T0") == g.get_minted("T0","A") + g.get_minted("T0","B"))
+    assert(g.tok_supply("T1") == g.get_minted("T1","A") + g.get_minted("T1","B"))
+    assert(g.tok_debts("T0") == g.get_debts("T0","A") + g.get_debts("T0","B"))
+
+def test_totals2():
+    g = LP(debug=True)
+    g.deposit("A", 10, "T0")
+    g.borrow ("A", 8, "T0")
+    assert(g.lastReverted)
+    assert(g.tok_debts("T0") == 0)
+    g.check_totals()
+
+"""
+Borrow index tests
+"""
+
+def test_index1():
+    g = LP(debug=True)
+    g.deposit("A", 100, "T0")
+    g.deposit("B", 100, "T1")
+    g.borrow ("B", 30, "T0")
+    g.accrue_interest()
+    g.accrue_interest()
+    assert(g.get_debts("T0","B") == 30 * Fraction(112,100)**2)
+    g.repay  ("B", 10, "T0")
+    g.borrow ("B", 10, "T0")
+    assert(g.get_debts("T0","B") == 30 * Fraction(112,100)**2)
+    assert(g.tok_debts("T0") == g.get_debts("T0","B"))
+
+def test_index2():
+    # the interest rate is the same for all the borrowers of a token
+    g = LP(debug=True)
+    g.set_interest_rate(1, Fraction(1,2))
+    g.deposit("A", 10, "T0")
+    g.deposit("A", 10, "T1")
+    g.deposit("B", 10, "T1")
+    g.borrow ("A", 2, "T0")
+    g.borrow ("B", 3, "T0")
+    rate = g.interest_rate("T0")
+    g.accrue_interest()
+    assert(g.get_debts("T0","A") == 2 * (1 + rate))
+    assert(g.get_debts("T0","B") == 3 * (1 + rate))
+
+"""
+Positions tests
+"""
+
+def test_positions1():
+    g = LP(debug=True)
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.deposit("C", 50, "T2")
+    g.borrow ("B", 30, "T0")
+    assert(set(g.positions["A"]) == {"T0"})
+    assert(set(g.positions["B"]) == {"T0", "T1"})
+    g.repay  ("B", 30, "T0")
+    assert(set(g.positions["B"]) == {"T1"})
+    g.redeem ("C", 50, "T2")
+    assert("C" not in g.positions)
+    assert(g.valuation("C") == (0, 0))
+    g.check_totals()
+
+def test_positions2():
+    g = LP()
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.borrow ("B", 30, "T0")
+    g.set_price("T0", 2)
+    assert(g.valuation("B") == (g.val_minted("B"), g.val_debts("B")))
+    assert(g.val_minted("B") == 50)
+    assert(g.val_debts("B") == 60)
+    assert(g.health_factor("B") == g.collateral("B") * g.tliq)
+
+"""
+Logging and events tests
+"""
+
+def test_quiet1():
+    # in quiet mode, the health factor is computed only to check collateralization
+    g = LP(verbose=False)
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    calls = []
+    health_factor = g.health_factor
+    g.health_factor = lambda address: calls.append(address) or health_factor(address)
+    g.borrow ("B", 30, "T0")
+    assert(g.lastReverted == False)
+    assert(calls == ["B"])
+
+def test_events1():
+    g = LP(verbose=False)
+    events = []
+    g.subscribe(events.append, metrics=["health_factor"])
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.borrow ("B", 40, "T0")
+    assert(len(events) == 3)
+    e = events[2]
+    assert(e.op == "borrow")
+    assert(e.args == {"address": "B", "amount": 40, "token": "T0"})
+    assert(e.reverted)
+    assert(e.reason == "B is not collateralized")
+    assert(e.pre["health_factor"]["B"] == e.post["health_factor"]["B"])
+
+    g.borrow ("B", 30, "T0")
+    e = events[3]
+    assert(not e.reverted and e.reason is None)
+    assert(e.pre["health_factor"]["B"] > e.post["health_factor"]["B"])
+
+    g.unsubscribe(events.append)
+    g.accrue_interest()
+    assert(len(events) == 4)
+
+def test_events2():
+    g = LP(verbose=False)
+    with pytest.raises(ValueError):
+        g.subscribe(print, metrics=["no_such_metric"])
+
+"""
+Numeric backends tests
+"""
+
+def run_liquidate(g):
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.borrow ("B", 30, "T0")
+    g.accrue_interest()
+    g.repay  ("B",  5, "T0")
+    g.set_price("T0", Fraction(13,10))
+    g.liquidate("A", 11, "T0", "B", "T1")
+    assert(g.lastReverted == False)
+    g.redeem("A", 10, "T0")
+    assert(g.lastReverted == False)
+
+def test_backend_float():
+    g = LP(debug=True, backend=make_backend("float"))
+    run_liquidate(g)
+    h = LP()
+    run_liquidate(h)
+    assert(isinstance(g.get_reserves("T0"), float))
+    assert(isclose(g.get_reserves("T0"), h.get_reserves("T0")))
+    assert(isclose(g.get_minted("T1","A"), h.get_minted("T1","A")))
+    assert(isclose(g.health_factor("B"), h.health_factor("B")))
+
+def test_backend_fixed():
+    g = LP(debug=True, backend=make_backend("fixed", 10**6))
+    run_liquidate(g)
+    h = LP()
+    run_liquidate(h)
+    assert(isclose(g.get_debts("T0","B"), h.get_debts("T0","B"), abs_tol=1e-5))
+    assert(isclose(g.get_minted("T1","A"), h.get_minted("T1","A"), abs_tol=1e-6))
+
+def test_fixed1():
+    Fixed = make_backend("fixed", 1000).Fixed
+    x = Fixed.of(Fraction(2, 3))
+    assert(x.v == 666)
+    assert(x * 3 == Fraction(1998, 1000))
+    assert(1 / Fixed.of(3) == Fraction(333, 1000))
+    assert(str(Fixed.of("1.5")) == "1.5")
+    assert(Fixed.of(1) < 2 and Fixed.of(1) < math.inf)
+
+"""
+Snapshot and fork tests
+"""
+
+def state(g):
+    return (dict(g.reserves), {t: g.get_debts(t, a) for t in g.debts for a in g.debts[t]},
+            {t: dict(m) for t, m in g.minted.items()}, dict(g.prices), g.tliq, g.ir_beta)
+
+def test_snapshot1():
+    g = LP(debug=True)
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.borrow ("B", 30, "T0")
+    pre = state(g)
+    s = g.snapshot()
+
+    g.accrue_interest()
+    g.set_price("T0", Fraction(13,10))
+    g.set_interest_rate(0, Fraction(1,10))
+    g.liquidate("A", 11, "T0", "B", "T1")
+    g.deposit("C", 10, "T2")
+    assert(state(g) != pre)
+
+    g.restore(s)
+    assert(state(g) == pre)
+    assert("C" not in g.positions)
+    g.check_totals()
+
+    # the snapshot can be restored again
+    g.repay("B", 30, "T0")
+    g.restore(s)
+    assert(state(g) == pre)
+    g.release(s)
+    assert(g.journal is None)
+
+def test_snapshot2():
+    g = LP()
+    g.deposit("A", 50, "T0")
+    s1 = g.snapshot()
+    g.deposit("A", 50, "T0")
+    s2 = g.snapshot()
+    g.deposit("A", 50, "T0")
+    g.restore(s1)
+    assert(g.get_reserves("T0") == 50)
+    with pytest.raises(ValueError):
+        g.restore(s2)
+
+def test_snapshot3():
+    g = LP()
+    g.deposit("A", 50, "T0")
+    s1 = g.snapshot()
+    g.deposit("A", 50, "T0")
+    s2 = g.snapshot()
+    g.deposit("A", 50, "T0")
+    g.release(s1)
+    assert(s2.mark == 0)
+    g.restore(s2)
+    assert(g.get_reserves("T0") == 100)
+    g.release(s2)
+    assert(g.journal is None)
+
+def test_fork1():
+    g = LP(debug=True)
+    g.deposit("A", 50, "T0")
+    g.deposit("B", 50, "T1")
+    g.borrow ("B", 30, "T0")
+    pre = state(g)
+
+    h = g.fork()
+    h.accrue_interest()
+    h.set_price("T0", Fraction(13,10))
+    h.liquidate("A", 11, "T0", "B", "T1")
+    assert(h.lastReverted == False)
+    assert(state(g) == pre)
+    h.check_totals()
+
+    # maps not written by the fork are shared
+    assert(g.minted["T0"] is h.minted["T0"])
+
+    g.repay("B", 10, "T0")
+    assert(h.get_debts("T0","B") == Fraction(336,10) - 11)
+    g.check_totals()
+
+def test_fork2():
+    # restoring a snapshot taken before a fork does not affect the fork
+    g = LP()
+    g.deposit("A", 50, "T0")
+    s = g.snapshot()
+    g.deposit("B", 50, "T0")
+    h = g.fork()
+    g.restore(s)
+    assert(g.get_minted("T0","B") == 0)
+    assert(h.get_minted("T0","B") == 50)
+    assert(h.get_reserves("T0") == 100)
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_fork3(compact):
+    # the first write of a fork to a large map overlays it instead of copying it
+    from state import Overlay
+    g = LP(verbose=False, compact=compact)
+    for i in range(200):
+        g.deposit(f"U{i}", 10, "T0")
+    pre = state(g)
+    h = g.fork()
+    h.deposit("U7", 5, "T0")
+    h.deposit("V", 5, "T0")
+    for name in ("minted", "positions"):
+        m = getattr(h, name)["T0"] if name == "minted" else h.positions
+        assert(isinstance(m, Overlay) and m.base is (getattr(g, name)["T0"] if name == "minted" else g.positions))
+        assert(len(m.changed) + len(m.removed) + len(m.added) <= 2)
+    assert(state(g) == pre)
+    assert(h.get_minted("T0", "U7") == 15 and h.get_minted("T0", "V") == 5 and len(h.minted["T0"]) == 201)
+
+    # a fork of the fork copies the written cells only, and the overlays behave as dicts
+    k = h.fork()
+    k.redeem("U7", 15, "T0")
+    k.deposit("U7", 1, "T0")
+    assert(k.minted["T0"].base is g.minted["T0"] and h.get_minted("T0", "U7") == 15)
+    plain = LP(verbose=False, compact=compact)
+    for i in range(200):
+        plain.deposit(f"U{i}", 10, "T0")
+    for op, address, amount in [("deposit", "U7", 5), ("deposit", "V", 5), ("redeem", "U7", 15), ("deposit", "U7", 1)]:
+        getattr(plain, op)(address, amount, "T0")
+    assert(list(k.minted["T0"].items()) == list(plain.minted["T0"].items()) and state(k) == state(plain))
+
+    # the overlay is merged into a copy of the base when it outgrows it
+    for i in range(200):
+        k.deposit(f"U{i}", 1, "T0")
+    assert(k.minted["T0"].base is not g.minted["T0"] and len(k.minted["T0"].changed) < 200 and state(g) == pre)
+    k.check_totals()
+
+"""
+Compact storage tests
+"""
+
+def run_compact(g):
+    g.deposit("Z", 1000, "T0")
+    for i, a in enumerate("ABCDE"):
+        g.deposit(a, 10 + i, "T1")
+        g.borrow (a, 6, "T0")
+    g.accrue_interest()
+    g.repay("B", 3, "T0")
+    g.set_price("T0", Fraction(13,10))
+    g.liquidate("Z", 2, "T0", "A", "T1")
+    g.redeem("E", 14, "T1")
+
+@pytest.mark.parametrize("name", ["fraction", "float", "fixed"])
+def test_compact1(name):
+    backend = make_backend(name)
+    g = LP(verbose=False, debug=True, backend=backend)
+    h = LP(verbose=False, debug=True, backend=backend, compact=True)
+    run_compact(g)
+    run_compact(h)
+    assert(state(g) == state(h))
+    assert({a: set(t) for a, t in g.positions.items()} == {a: set(t) for a, t in h.positions.items()})
+    assert(g.undercollateralized() == h.undercollateralized())
+    h.check_totals()
+
+    s = h.snapshot()
+    k = h.fork()
+    pre = state(h)
+    h.borrow("F", 1, "T0")
+    h.deposit("F", 10, "T1")
+    k.repay("C", 6, "T0")
+    assert(state(h) != pre)
+    h.restore(s)
+    assert(state(h) == pre)
+    assert(k.get_debts("T0", "C") < h.get_debts("T0", "C"))
+
+def test_compact2():
+    from compact import CompactMap, Interner
+    backend = make_backend("fraction")
+    m = CompactMap(Interner(), backend, {"A": Fraction(1,3), "B": Fraction(5)})
+    m["C"] = Fraction(2**70, 3)
+    assert(dict(m) == {"A": Fraction(1,3), "B": 5, "C": Fraction(2**70, 3)})
+    del m["B"]
+    assert("B" not in m and len(m) == 2 and list(m) == ["A", "C"])
+    with pytest.raises(KeyError):
+        m["B"]
+
+"""
+Health index tests
+"""
+
+def brute_undercollateralized(g):
+    hfs = [(g.health_factor(a), a) for a in g.positions]
+    return [a for hf, a in sorted(hfs) if hf < 1]
+
+def test_health_index1():
+    g = LP(verbose=False)
+    g.deposit("Z", 1000, "T0")
+    g.deposit("Z", 1000, "T1")
+    for i, a in enumerate("ABCDEFGH"):
+        g.deposit(a, 10 + i, "T1")
+        g.borrow (a, 6, "T0")
+    assert(g.undercollateralized() == [])
+
+    g.set_price("T0", Fraction(13,10))
+    assert(g.undercollateralized() == brute_undercollateralized(g) == ["A", "B"])
+    g.accrue_interest()
+    assert(g.undercollateralized() == brute_undercollateralized(g))
+    assert(len(g.undercollateralized()) == 4)
+
+    g.repay("B", 6, "T0")
+    assert(g.undercollateralized() == brute_undercollateralized(g))
+    assert("B" not in g.undercollateralized())
+    assert([a for a, hf in g.least_healthy(3)] == ["A", "C", "D"])
+    assert(g.least_healthy(1)[0][1] == g.health_factor("A"))
+
+    g.set_liq_threshold(Fraction(1,2))
+    assert(g.undercollateralized() == brute_undercollateralized(g))
+
+def test_health_index2():
+    g = LP(verbose=False)
+    g.deposit("Z", 1000, "T0")
+    g.deposit("A", 10, "T1")
+    g.borrow ("A", 6, "T0")
+    assert(g.undercollateralized() == [])
+    s = g.snapshot()
+    g.set_price("T0", 2)
+    assert(g.undercollateralized() == ["A"])
+    g.restore(s)
+    assert(g.undercollateralized() == [])
+    h = g.fork()
+    h.set_price("T1", Fraction(1,2))
+    assert(h.undercollateralized() == ["A"])
+    assert(g.undercollateralized() == [])
+
+@pytest.mark.parametrize("name", ["fraction", "float", "fixed"])
+def test_health_index3(name):
+    # single-exposure borrowers (by pair of tokens, including a single token), and the others
+    g = LP(verbose=False, backend=make_backend(name))
+    g.set_interest_rate(0, Fraction(1,10))
+    for token in ("T0", "T1", "T2"):
+        g.deposit("Z", 10000, token)
+    for i in range(100):
+        a = f"U{i}"
+        g.deposit(a, 10 + i % 7, "T1" if i % 3 else "T0")
+        g.borrow (a, 6, "T0")
+        if i % 10 == 0:
+            g.deposit(a, 1, "T2")
+    assert(g.undercollateralized() == brute_undercollateralized(g))
+    assert(len(g.health_index.single) == 90 and len(g.health_index.keys) == 10)
+    for action in [lambda: g.set_price("T0", Fraction(13,10)), g.accrue_interest, lambda: g.set_price("T2", Fraction(1,10)),
+                   lambda: g.borrow("U4", 1, "T2"), lambda: g.repay("U4", 1, "T2"), lambda: g.set_price("T1", Fraction(7,10)),
+                   lambda: g.liquidate("Z", 3, "T0", "U1", "T1"), lambda: g.set_liq_threshold(Fraction(1,2))]:
+        action()
+        assert(g.undercollateralized() == brute_undercollateralized(g))
+        hfs = sorted((g.health_factor(a), a) for a in g.positions if g.health_factor(a) != math.inf)
+        assert([a for a, hf in g.least_healthy(5)] == [a for hf, a in hfs[:5]])
+
+"""
+Price scenario tests
+"""
+
+def scenario_lp():
+    g = LP(verbose=False)
+    g.deposit("Z", 1000, "T0")
+    g.deposit("Z", 1000, "T1")
+    for i, a in enumerate("ABCDEFGH"):
+        g.deposit(a, 10 + i, "T1")
+        g.borrow (a, 6, "T0")
+    g.accrue_interest()
+    return g
+
+def test_scenarios1():
+    pytest.importorskip("numpy")
+    from scenarios import Exposure
+    g = scenario_lp()
+    e = Exposure(g)
+    prices = [[1, 1], [Fraction(13,10), 1], [1, Fraction(1,2)], [2, 1]]
+    hf = e.health_factors(prices)
+    result = e.evaluate(prices, chunk=3)
+    for s, (p0, p1) in enumerate(prices):
+        h = g.fork()
+        h.set_price("T0", p0)
+        h.set_price("T1", p1)
+        for i, a in enumerate(e.addresses):
+            assert(isclose(hf[s, i], float(h.health_factor(a))))
+        assert(result.liquidatable[s] == len(h.undercollateralized()))
+        shortfall = sum(max(0, h.val_debts(a) - h.tliq * h.val_minted(a)) for a in h.positions)
+        assert(isclose(result.shortfall[s], float(shortfall)))
+    assert(g.get_price("T0") == 1)
+    assert(math.isinf(hf[0, e.addresses.index("Z")]))
+
+def test_scenarios2():
+    pytest.importorskip("numpy")
+    from scenarios import Exposure
+    g = scenario_lp()
+    e = Exposure(g)
+    shocks = e.evaluate_shocks([[1, 1], [2, 1]])
+    assert(list(shocks.liquidatable) == [len(g.undercollateralized()), 8])
+    with pytest.raises(ValueError):
+        e.evaluate([[1, 1, 1]])
@@ -0,0 +1,79 @@
+# Unit tests for the statistical model checking runner and the des_lp simulator
+# Usage: pytest test_smc.py
+
+import random
+import struct
+import pytest
+from math import isclose
+
+import des_lp
+from MV_python_integrator import SimulationWrapper
+from smc import Query, estimate, estimate_all, parse_queries, t_quantile
+
+"""
+Statistical model checking tests
+"""
+
+def test_smc1():
+    queries = {}
+    for name in ("q1", "q2", "q3"):
+        with open(f"{name}.multiquatex") as f:
+            queries[name] = parse_queries(f.read())
+    assert(queries["q1"] == [Query("tWliq(100)", 6, 100)] and queries["q2"] == [Query("tHB(200)", 5, 200)])
+    assert([q.time for q in queries["q3"]] == [50, 100, 150])
+    with pytest.raises(ValueError):
+        parse_queries("f (x) = if ( s.rval(4) == x ) then s.rval(6) else #f (x) fi ; eval E[g(10)];")
+    assert(isclose(t_quantile(0.975, 29), 2.0452, abs_tol=1e-3))
+
+def test_smc2():
+    query = Query("tWliq(20)", 6, 20)
+    r = estimate(query, delta=1e9, block=10, seed=7)
+    assert(r["runs"] == 10 and r["converged"] and r["low"] <= r["mean"] <= r["high"])
+    r = estimate(query, delta=1e-9, block=10, seed=7, max_runs=25)
+    assert(r["runs"] == 25 and not r["converged"])
+    assert(estimate(query, delta=1e-9, workers=3, block=10, seed=7, max_runs=25) == r)
+
+def test_smc3():
+    queries = [Query(f"tWliq({t})", 6, t) for t in (30, 10, 20)] + [Query("tHB(20)", 5, 20)]
+    results = estimate_all(queries, delta=1e-9, block=10, seed=3, max_runs=20)
+    assert([r["query"] for r in results] == [q.name for q in queries] and all(r["runs"] == 20 for r in results))
+    assert(results == [estimate(query, delta=1e-9, block=10, seed=3, max_runs=20) for query in queries])
+    assert(estimate_all(queries, delta=1e-9, workers=2, block=10, seed=3, max_runs=20) == results)
+
+def test_batched_simulation1():
+    model = des_lp.Model()
+    model.init(3)
+    expected = []
+    for t in range(1, 61):
+        model.one_step()
+        if t % 20 == 0:
+            expected.append([model.eval(obs) for obs in (4, 5, 6)])
+    model.init(3)
+    assert(model.sample([4, 5, 6], [20, 40, 60]) == expected)
+    model.init(3)
+    model.perform_steps(15)
+    model.run_until(40)
+    assert(model.getTime() == 40 and model.eval_many([5, 6]) == expected[1][1:])
+    wrapper = SimulationWrapper(model)
+    data = wrapper.performWholeSimulationAndSample(3, "4,5,6", [20, 40, 60])
+    assert(list(struct.unpack(">9d", data)) == [v for row in expected for v in row])
+    assert(struct.unpack(">2d", wrapper.rvals([4, 6])) == (60.0, expected[2][2]))
+
+def test_rng1():
+    assert(des_lp.derive_seed(1, 0) == des_lp.derive_seed(1, 0) != des_lp.derive_seed(0, 1))
+    def trace(model):
+        return model.sample([4, 5, 6], [10, 20, 30])
+    models = [des_lp.Model() for _ in range(3)]
+    expected = []
+    for k, model in enumerate(models):
+        model.init(des_lp.derive_seed(5, k))
+        expected.append(trace(model))
+    state = random.getstate()
+    for k, model in enumerate(models):
+        model.init(des_lp.derive_seed(5, k))
+    for _ in range(30):     # interleaved steps do not share the random stream
+        for model in models:
+            model.one_step()
+    models[0].init(des_lp.derive_seed(5, 0))
+    assert(trace(models[0]) == expected[0] and random.getstate() == state)
+    assert([m.eval_many([4, 5, 6]) for m in models[1:]] == [e[-1] for e in expected[1:]])
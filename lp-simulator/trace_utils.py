@@ -0,0 +1,330 @@
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import sys
+from collections import namedtuple
+from fractions import Fraction
+
+from checkpoint import CheckpointError, Checkpointer
+from numeric import BACKENDS
+from profiling import Profiler
+from stream import DiffWriter, cadence
+
+log = logging.getLogger(__name__)
+
+"""
+Parsing, compilation and replay of transaction trace files.
+
+A trace has one call per line:
+- A:method(1:T0, B, T1)  method called with the address A, then the arguments
+                         (an argument amount:token gives two arguments)
+- A:method               method called without arguments
+- method(T0, 3/2)        method called with the arguments (numbers are parsed as fractions)
+- method                 method called without arguments
+- @12 A:method(...)      call executed at block 12: set_block(12), then the call
+                         (a line with only @12 just sets the block)
+- {                      the calls up to the matching } form a bundle, executed
+                         as a unit by execute_bundle (bundles may be nested)
+Blank lines are skipped, and '#' starts a comment.
+
+A trace is parsed once into Calls (possibly cached on disk, keyed by the hash
+of the file), then compiled against a model class (LP or Blockchain) into
+Steps, whose methods are resolved and whose arities are checked up front.
+The compiled Steps can be run on any number of instances of the class.
+"""
+
+CACHE_VERSION = 4   # version of the parsed form, part of the cache key
+
+# partial: other Calls of the same line follow (the set_block of a line with a block and a call)
+Call = namedtuple("Call", ["lineno", "line", "method", "args", "error", "partial"], defaults=[False])
+Step = namedtuple("Step", ["lineno", "line", "fn", "args", "error", "partial"], defaults=[False])
+
+class TraceError(Exception):
+    """
+    Raised by compile_trace in strict mode, listing all the invalid lines of a trace.
+    """
+
+def parse_line(line):
+    """
+    Parses a line of a trace into a pair (method, args), or returns None for blank and comment lines.
+    Raises ValueError if an amount is not a number.
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    if ':' in line:
+        address, rest = line.split(':', 1)
+        if '(' not in rest:
+            return rest.strip(), []
+        method, args = rest.split('(', 1)
+        parsed_args = [address.strip()]
+        for arg in args.strip(')').split(','):
+            if ':' in arg:  # For example, "1:T"
+                amount, token = arg.split(':')
+                parsed_args += [Fraction(amount), token.strip()]
+            else:
+                parsed_args.append(arg.strip())
+        return method.strip(), parsed_args
+    if '(' not in line:
+        return line, []
+    method, args = line.split('(', 1)
+    parsed_args = []
+    for arg in args.strip(')').split(','):
+        arg = arg.strip()
+        try:
+            # handles both '2/3' and '3.5'
+            parsed_args.append(Fraction(arg))
+        except ValueError:
+            parsed_args.append(arg)
+    return method.strip(), parsed_args
+
+def iter_calls(lines, start=1):
+    """
+    Parses the lines of a trace lazily, yielding Calls (start is the number of the first line).
+    A line that cannot be parsed gives a Call with method None and the error message.
+    A bundle gives a single Call of execute_bundle (at its opening line), whose argument
+    is the list of its Calls; it is invalid if one of them is, or if it is not closed.
+    """
+    bundles = []    # stack of the open bundles [opening Call, Calls]
+    for call in iter_line_calls(lines, start):
+        if call.method == "{":
+            bundles.append([call, []])
+            continue
+        if call.method == "}":
+            if not bundles:
+                yield Call(call.lineno, call.line, None, [], f"Error processing line '{call.line}': no bundle to close")
+                continue
+            opening, calls = bundles.pop()
+            errors = [c.error for c in calls if c.error is not None]
+            call = Call(opening.lineno, opening.line, "execute_bundle", [calls], errors[0] if errors else None)
+        if bundles:
+            bundles[-1][1].append(call)
+        else:
+            yield call
+    if bundles:
+        opening = bundles[0][0]
+        yield Call(opening.lineno, opening.line, None, [], f"Error processing line '{opening.line}': unclosed bundle")
+
+def iter_line_calls(lines, start=1):
+    # parses each line into Calls (two for a line with a block)
+    for lineno, line in enumerate(lines, start):
+        line = line.strip()
+        rest = line
+        try:
+            if line.startswith('@'):
+                block, _, rest = line[1:].partition(' ')
+                partial = rest.split('#', 1)[0].strip() != ""
+                yield Call(lineno, line, "set_block", [Fraction(block)], None, partial)
+            parsed = parse_line(rest)
+        except ValueError as e:
+            yield Call(lineno, line, None, [], f"Error processing line '{line}': {e}")
+            continue
+        if parsed is not None:
+            yield Call(lineno, line, *parsed, None)
+
+def parse_lines(lines):
+    """
+    Parses the lines of a trace into a list of Calls.
+    """
+    return list(iter_calls(lines))
+
+def parse_trace(filename, cache_dir=None):
+    """
+    Parses a trace file into a list of Calls.
+    If cache_dir is given, the parsed trace is cached there, keyed by the hash of the file.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if cache_dir is None:
+        return parse_lines(data.decode().splitlines())
+
+    key = hashlib.sha256(f"{CACHE_VERSION}:".encode() + data).hexdigest()
+    path = os.path.join(cache_dir, key + ".pickle")
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    calls = parse_lines(data.decode().splitlines())
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        pickle.dump(calls, f)
+    os.replace(tmp, path)
+    return calls
+
+def iter_steps(calls, cls):
+    """
+    Compiles Calls lazily into Steps calling the methods of cls, checking the method names and arities.
+    Invalid calls give Steps with fn None and the error message.
+    """
+    table = {}  # {method: (function, signature)}, or {method: None} if not found
+
+    def compile_call(call):
+        fn, args, error = None, call.args, call.error
+        if error is None:
+            if call.method not in table:
+                fn = getattr(cls, call.method, None) if not call.method.startswith('_') else None
+                table[call.method] = (fn, inspect.signature(fn)) if inspect.isfunction(fn) else None
+            if table[call.method] is None:
+                error = f"Error: Method '{call.method}' not found in {cls.__name__} class."
+            else:
+                fn, signature = table[call.method]
+                try:
+                    signature.bind(None, *call.args)
+                except TypeError as e:
+                    fn, error = None, f"Error processing line '{call.line}': {e}"
+        if error is None and call.method == "execute_bundle" and args and isinstance(args[0], list):
+            # a bundle: compiles its calls into the pairs (function, args) of execute_bundle
+            steps = [compile_call(c) for c in args[0]]
+            errors = [step.error for step in steps if step.error is not None]
+            if errors:
+                fn, error = None, errors[0]
+            args = [[(step.fn, step.args) for step in steps]]
+        return Step(call.lineno, call.line, fn, args, error, call.partial)
+
+    for call in calls:
+        yield compile_call(call)
+
+def check_trace(steps):
+    """
+    Raises a TraceError listing the invalid Steps, if any.
+    """
+    errors = [f"line {step.lineno}: {step.error}" for step in steps if step.error is not None]
+    if errors:
+        raise TraceError("\n".join(errors))
+
+def compile_trace(calls, cls, strict=False):
+    """
+    Compiles Calls into a list of Steps calling the methods of cls.
+    In strict mode, invalid calls raise a TraceError.
+    """
+    steps = list(iter_steps(calls, cls))
+    if strict:
+        check_trace(steps)
+    return steps
+
+def run_trace(steps, model, after=None):
+    """
+    Executes the compiled Steps on model, calling after(step) after each successful call.
+    Invalid steps and exceptions are logged, and the execution continues.
+    """
+    for step in steps:
+        if step.error is not None:
+            log.error(step.error)
+            continue
+        try:
+            step.fn(model, *step.args)
+            if after is not None:
+                after(step)
+        except Exception as e:
+            log.error(f"Error processing line '{step.line}': {e}")
+
+def add_replay_arguments(parser):
+    """
+    Adds the trace file and the options of replay to the command line parser of lp.py and blockchain.py.
+    """
+    parser.add_argument("filename", help="The input file containing transaction trace.")
+    parser.add_argument("-p", "--precise", action="store_true",  help="Use precise fraction representation in output.")
+    parser.add_argument("-q", "--quiet", action="store_true",  help="Do not log the operations (fast mode).")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, default="fraction", help="Numeric backend (default: fraction).")
+    parser.add_argument("--scale", type=int, default=10**6, help="Scale of the fixed-point backend (default: 1000000).")
+    parser.add_argument("--compact", action="store_true", help="Use the compact storage for the maps by address (large pools).")
+    parser.add_argument("--strict", action="store_true", help="Check the whole trace before executing it, and stop on invalid lines.")
+    parser.add_argument("--cache", nargs="?", const="__tracecache__", metavar="DIR", help="Cache the parsed trace in DIR (default: __tracecache__).")
+    parser.add_argument("--stream", nargs="?", const="step", type=cadence, metavar="CADENCE",
+                        help="Read the trace lazily and write the changed state as JSON lines: after every step (default), every N steps, on revert, or at the end.")
+    parser.add_argument("--export", metavar="PATH", help="Export the state after each step as columnar .npy files in PATH (or a .npz bundle).")
+    parser.add_argument("--export-every", type=int, default=1, metavar="N", help="Export the state every N steps (default: 1).")
+    parser.add_argument("--profile", action="store_true", help="Print the calls, reverts and times of the operations and helpers on stderr at the end.")
+    parser.add_argument("--checkpoint", metavar="DIR", help="Write checkpoints of the replay in DIR (reads the trace lazily).")
+    parser.add_argument("--checkpoint-every", type=int, metavar="N", help="Write a checkpoint every N steps (default: 10000, unless --checkpoint-seconds).")
+    parser.add_argument("--checkpoint-seconds", type=float, metavar="S", help="Write a checkpoint every S seconds.")
+    parser.add_argument("--resume", action="store_true", help="Resume the replay from the latest checkpoint in the --checkpoint directory.")
+
+def check_replay_arguments(parser, args):
+    """
+    Checks the parsed options of replay, and sets the default checkpoint interval.
+    """
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint DIR")
+    if args.export_every < 1:
+        parser.error("--export-every must be a positive number of steps")
+    if args.checkpoint_every is None and args.checkpoint_seconds is None:
+        args.checkpoint_every = 10000
+
+def replay(model, args):
+    """
+    Replays the trace file args.filename on model, with the command line options of lp.py and blockchain.py:
+    - by default, the whole trace is compiled first, and the state is pretty-printed after each step;
+    - with args.stream, the changes are written as JSON lines on the given cadence instead;
+    - with args.export, the state is recorded in columnar form in the given path, every args.export_every steps;
+    - with args.checkpoint, checkpoints are written in the given directory (and resumed with args.resume).
+    The trace is read lazily with args.stream, args.export or args.checkpoint.
+    With args.profile, the profile of the operations is printed on stderr at the end.
+    """
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.attach(model)
+    cls = type(model)
+    try:
+        if args.stream is None and args.export is None and args.checkpoint is None:
+            steps = compile_trace(parse_trace(args.filename, cache_dir=args.cache), cls, strict=args.strict)
+            run_trace(steps, model, after=lambda step: model.pretty_print(precise=args.precise))
+            return
+        with open(args.filename, "r") as f:
+            if args.strict:
+                check_trace(iter_steps(iter_calls(f), cls))
+                f.seek(0)
+            lines, start = f, 1
+            checkpointer = None
+            if args.checkpoint is not None:
+                checkpointer = Checkpointer(model, args.checkpoint, args.checkpoint_every, args.checkpoint_seconds)
+                if args.resume:
+                    lines, start = checkpointer.resume(lines)
+                    log.info(f"Resuming from line {start} (step {checkpointer.steps})")
+                checkpointer.start()
+                lines = checkpointer.lines(lines)
+            n_steps = checkpointer.steps if checkpointer is not None else 0
+            callbacks = []
+            writer = exporter = None
+            if args.stream is not None:
+                writer = DiffWriter(model, sys.stdout, args.stream, precise=args.precise)
+                writer.n_steps = n_steps
+                callbacks.append(writer.step)
+            if args.export is not None:
+                from export import ColumnarWriter   # requires NumPy
+                exporter = ColumnarWriter(model, args.export, args.export_every)
+                exporter.n_steps = n_steps
+                callbacks.append(exporter.step)
+            if writer is None and exporter is None:
+                callbacks.append(lambda step: model.pretty_print(precise=args.precise))
+            if checkpointer is not None:
+                callbacks.append(checkpointer.step)
+
+            def after(step):
+                for callback in callbacks:
+                    callback(step)
+
+            run_trace(iter_steps(iter_calls(lines, start), cls), model, after=after)
+            if writer is not None:
+                writer.close()
+            if exporter is not None:
+                exporter.close()
+            if checkpointer is not None:
+                checkpointer.close()
+    except FileNotFoundError:
+        print(f"Error: File '{args.filename}' not found.")
+        sys.exit(1)
+    except TraceError as e:
+        print(f"Error: invalid trace '{args.filename}':\n{e}")
+        sys.exit(1)
+    except CheckpointError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        if profiler is not None:
+            profiler.print_report()